@@ -4,7 +4,6 @@ log = logging.getLogger(__file__)
 
 from ott.utils.dao.base import BaseDao
 from ..gtfsrdb import query
-from ott.utils import object_utils
 from ott.utils import date_utils
 
 
@@ -67,14 +66,32 @@ class AlertsDao(BaseDao):
                 self.pretty_end_time = date_utils.pretty_time(self.end)
 
     def init_via_alert(self, session, alert):
-        ''' init this object via this 
+        ''' init this object via this EntitySelector (and its Alert) ... copies just the query.ALERT_ROW_COLUMNS (see
+            query.alert_row()), so a detached selector (e.g., from the query.AlertIndex) never needs a lazy load
         '''
-        object_utils.update_object(self, src=alert)
-        object_utils.update_object(self, src=alert.Alert)
-        self.set_dates(alert.Alert.start, alert.Alert.end)
+        self.init_via_row(query.alert_row(alert))
 
+    def init_via_row(self, row):
+        ''' init this object via a row of query.ALERT_ROW_COLUMNS (see query.alert_rows()) ... plain attribute copies,
+            rather than the reflective copies from the ORM objects that init_via_alert() does
+        '''
+        self.alert_id = row.alert_id
+        self.route_id = row.route_id
+        self.stop_id = row.stop_id
+        self.trip_id = row.trip_id
+        self.url = row.url
+        self.header_text = row.header_text
+        self.description_text = row.description_text
+        self.cause = row.cause
+        self.effect = row.effect
+        self.route_short_names = row.route_short_names
+        self.route_ids = row.route_ids
+        self.set_dates(row.start, row.end)
+        self.fix_url()
+
+    def fix_url(self):
         # TODO: trimet hack (eliminate me)
-        if "trimet.org" in self.url:
+        if self.url and "trimet.org" in self.url:
             self.url = "http://trimet.org/#alerts/"
             if self.route_id:
                 self.url = "{0}{1}".format(self.url, self.route_id)
@@ -124,3 +141,107 @@ class AlertsDao(BaseDao):
         except Exception, e:
             log.warn(e)
         return ret_val
+
+    @classmethod
+    def get_active_alerts(cls, session, route_id=None, stop_id=None, when=None):
+        ''' query GTFSrDB, and return a list of AlertResponse objects for the alerts active at this time (default now),
+            optionally just for a route and/or stop
+        '''
+        ret_val = []
+        try:
+            alerts = query.active_at(session, when, route_id, stop_id)
+            for a in alerts:
+                r = AlertsDao()
+                r.init_via_alert(session, a)
+                ret_val.append(r)
+            if len(ret_val) > 0:
+                ret_val.sort(key=lambda x: x.start, reverse=False)
+        except Exception, e:
+            log.warn(e)
+        return ret_val
+
+    @classmethod
+    def make_alerts(cls, session, alerts):
+        ''' @return: a list of AlertResponse objects (sorted by start) for these (queried) alerts
+        '''
+        ret_val = []
+        for a in alerts:
+            r = AlertsDao()
+            r.init_via_alert(session, a)
+            ret_val.append(r)
+        ret_val.sort(key=lambda x: x.start, reverse=False)
+        return ret_val
+
+    @classmethod
+    def get_alerts_via_route_ids(cls, session, route_ids):
+        ''' query GTFSrDB once for many routes, and return a {route_id: [AlertResponse objects]} dict
+        '''
+        ret_val = {}
+        try:
+            for route_id, alerts in query.via_route_ids(session, route_ids).items():
+                ret_val[route_id] = cls.make_alerts(session, alerts)
+        except Exception, e:
+            log.warn(e)
+        return ret_val
+
+    @classmethod
+    def get_alerts_via_stop_ids(cls, session, stop_ids):
+        ''' query GTFSrDB once for many stops, and return a {stop_id: [AlertResponse objects]} dict
+        '''
+        ret_val = {}
+        try:
+            for stop_id, alerts in query.via_stop_ids(session, stop_ids).items():
+                ret_val[stop_id] = cls.make_alerts(session, alerts)
+        except Exception, e:
+            log.warn(e)
+        return ret_val
+
+    @classmethod
+    def get_stop_and_route_alerts(cls, session, stop_id, route_ids):
+        ''' query GTFSrDB once for a stop and the routes serving it
+            @return: ([the stop's AlertResponse objects], {route_id: [AlertResponse objects]})
+        '''
+        stop_alerts = []
+        route_alerts = {}
+        try:
+            stops, routes = query.via_stop_and_route_ids(session, stop_id, route_ids)
+            stop_alerts = cls.make_alerts(session, stops)
+            for route_id, alerts in routes.items():
+                route_alerts[route_id] = cls.make_alerts(session, alerts)
+        except Exception, e:
+            log.warn(e)
+        return stop_alerts, route_alerts
+
+    @classmethod
+    def from_rows(cls, rows):
+        ''' @return: a list of AlertResponse objects (sorted by start) for these query.alert_rows()
+        '''
+        ret_val = []
+        for row in rows:
+            r = AlertsDao()
+            r.init_via_row(row)
+            ret_val.append(r)
+        ret_val.sort(key=lambda x: x.start, reverse=False)
+        return ret_val
+
+    @classmethod
+    def get_route_alerts_via_columns(cls, session, route_id, agency_id='NotUsed-AssumesSingleAgencyAlaTriMet'):
+        ''' get_route_alerts() that just selects the columns it needs (no ORM objects), and has one AlertResponse per alert
+        '''
+        ret_val = []
+        try:
+            ret_val = cls.from_rows(query.alert_rows(session, route_id=route_id))
+        except Exception, e:
+            log.warn(e)
+        return ret_val
+
+    @classmethod
+    def get_stop_alerts_via_columns(cls, session, stop_id, agency_id='NotUsed-AssumesSingleAgencyAlaTriMet'):
+        ''' get_stop_alerts() that just selects the columns it needs (no ORM objects), and has one AlertResponse per alert
+        '''
+        ret_val = []
+        try:
+            ret_val = cls.from_rows(query.alert_rows(session, stop_id=stop_id))
+        except Exception, e:
+            log.warn(e)
+        return ret_val
@@ -55,8 +55,15 @@ class RouteListDao(BaseDao):
         log.info("query Route table")
         route_list = []
         routes = cls.active_routes(session)
+
+        # the alerts for all the routes, in one query
+        route_alerts = {}
+        if show_alerts:
+            route_alerts = AlertsDao.get_alerts_via_route_ids(session, [r.route_id for r in routes])
+
         for r in routes:
-            rte = RouteDao.from_route_orm(route=r, agency=agency, detailed=detailed, show_alerts=show_alerts, show_geo=show_geo)
+            rte = RouteDao.from_route_orm(route=r, agency=agency, detailed=detailed, show_alerts=show_alerts, show_geo=show_geo,
+                                          alerts=route_alerts.get(r.route_id))
             route_list.append(rte)
 
         ret_val = RouteListDao(route_list)
@@ -107,13 +114,16 @@ class RouteDao(BaseDao):
         self.direction_1 = dir1
 
     @classmethod
-    def from_route_orm(cls, route, agency="TODO", detailed=False, show_alerts=False, show_geo=False):
-        alerts = []
+    def from_route_orm(cls, route, agency="TODO", detailed=False, show_alerts=False, show_geo=False, alerts=None):
+        ''' @param alerts: (optional) the route's alerts, when they've already been queried (e.g., for a whole list of routes)
+        '''
         try:
-            if show_alerts:
+            if show_alerts and alerts is None:
                 alerts = AlertsDao.get_route_alerts(object_session(route), route.route_id)
         except Exception, e:
             log.warn(e)
+        if not show_alerts or alerts is None:
+            alerts = []
         ret_val = RouteDao(route, alerts, show_geo)
         return ret_val
 
@@ -5,6 +5,7 @@ from sqlalchemy.orm import joinedload, joinedload_all
 
 from ott.utils.dao.base import BaseDao
 from .route_dao  import RouteDao
+from .alerts_dao import AlertsDao
 
 from gtfsdb import Stop
 from gtfsdb import RouteStop
@@ -228,12 +229,19 @@ class StopDao(BaseDao):
 
             # step 3a: get the routes for a stop
             route_stops = RouteStop.active_unique_routes_at_stop(stop_orm.session, stop_id=stop_orm.stop_id, date=date)
+
+            # step 3a': get the alerts for the stop, and all the routes serving it, in one query
+            route_alerts = {}
+            if show_alerts:
+                alerts, route_alerts = AlertsDao.get_stop_and_route_alerts(stop_orm.session, stop_orm.stop_id, [r.route_id for r in route_stops])
+
             for r in route_stops:
                 rs = None
 
                 # step 3b: build the route object for the stop's route (could be detailed and with alerts)
                 try:
-                    rs = RouteDao.from_route_orm(route=r, agency=agency, detailed=detailed, show_alerts=show_alerts)
+                    rs = RouteDao.from_route_orm(route=r, agency=agency, detailed=detailed, show_alerts=show_alerts,
+                                                 alerts=route_alerts.get(r.route_id))
                 except Exception, e:
                     log.info(e)
                     # step 3c: we got an error above, so let's try to get minimal route information
@@ -248,9 +256,7 @@ class StopDao(BaseDao):
                     routes.append(rs)
             routes.sort(key=lambda x: x.sort_order, reverse=False)
 
-        # TODO: shut off, as TriMet doesn't use route alerts right now (and I can't afford more /q)
-        #if show_alerts:
-        #    alerts = AlertsDao.get_stop_alerts(object_session(stop), stop.stop_id)
+        # NOTE: detailed stops get their alerts along with their routes' alerts (step 3a' ... one query for the lot)
 
         # step 4: query db for route ids serving this stop...
         ret_val = StopDao(stop_orm, amenities, routes, alerts, distance, order, date, show_geo)
@@ -5,6 +5,7 @@ log = logging.getLogger(__file__)
 from ott.utils.dao.base import BaseDao
 from .stop_dao import StopDao
 from .headsign_dao import StopHeadsignDao
+from ..gtfsrdb import query
 
 from ott.utils import date_utils
 
@@ -36,9 +37,10 @@ class StopScheduleDao(BaseDao):
         return ret_val
 
     @classmethod
-    def get_stop_schedule(cls, session, stop_id, date=None, route_id=None, agency="TODO", detailed=False, show_alerts=False):
+    def get_stop_schedule(cls, session, stop_id, date=None, route_id=None, agency="TODO", detailed=False, show_alerts=False, show_realtime=False):
         ''' factory returns full-on schedule DAO for this stop, on this date.  detailed flag gets all meta-data, whereas
             show_alerts reduces the queries down to just alerts for this stop (and routes hitting the stop).
+            show_realtime overlays the (gtfsrdb) predictions at this stop onto the schedule (see make_stop_time()).
         '''
         #import pdb; pdb.set_trace()
         ret_val = None
@@ -64,6 +66,11 @@ class StopScheduleDao(BaseDao):
             else:
                 stop_times = StopTime.get_departure_schedule(session, stop_id, date)
 
+        # step 3b: the realtime predictions for this stop (one query), keyed by trip, service date & stop_sequence
+        predictions = None
+        if show_realtime:
+            predictions = query.stop_predictions(session, stop_id, date)
+
         # step 4: loop through our queried stop times
         for i, st in enumerate(stop_times):
             if st.is_boarding_stop():
@@ -91,7 +98,7 @@ class StopScheduleDao(BaseDao):
 
                 # 4c: add new stoptime to headsign cache
                 if id in headsigns:
-                    time = cls.make_stop_time(st, id, now, i+1)
+                    time = cls.make_stop_time(st, id, now, i+1, predictions, date)
                     schedule.append(time)
                     headsigns[id].last_time = st.departure_time
                     headsigns[id].num_trips += 1
@@ -105,13 +112,27 @@ class StopScheduleDao(BaseDao):
     def get_stop_schedule_from_params(cls, session, params):
         ''' will make a stop schedule based on values set in ott.utils.parse.StopParamParser 
         '''
-        ret_val = cls.get_stop_schedule(session=session, stop_id=params.stop_id, date=params.date, route_id=params.route_id, agency=params.agency, detailed=params.detailed, show_alerts=params.alerts)
+        ret_val = cls.get_stop_schedule(session=session, stop_id=params.stop_id, date=params.date, route_id=params.route_id, agency=params.agency, detailed=params.detailed, show_alerts=params.alerts,
+                                        show_realtime=getattr(params, 'realtime', False))
         return ret_val
 
     @classmethod
-    def make_stop_time(cls, stoptime, headsign_id, now, order):
+    def make_stop_time(cls, stoptime, headsign_id, now, order, predictions=None, date=None):
         ''' {"t":'12:33am', "h":'headsign_id;, "n":[E|N|L ... where E=Earlier Today, N=Now/Next, L=Later]}
+
+            with predictions (see query.stop_predictions()), each time also gets "rt":true|false ... and a trip with a
+            prediction gets its predicted time in "t", with the scheduled time in "s" (and "x":true when it's canceled) ...
+            predictions are matched on the stop time's trip, service date (the schedule's date) and stop_sequence
         '''
         time = date_utils.military_to_english_time(stoptime.departure_time)
         ret_val = {"t":time, "h":headsign_id, "o":order}
+        if predictions is not None:
+            p = query.find_prediction(predictions, stoptime.trip_id, date, stoptime.stop_sequence)
+            ret_val["rt"] = p is not None
+            if p is not None:
+                ret_val["s"] = time
+                if p.schedule_relationship == 'CANCELED':
+                    ret_val["x"] = True
+                else:
+                    ret_val["t"] = date_utils.military_to_english_time(query.predicted_time(stoptime.departure_time, p))
         return ret_val
@@ -1,9 +1,11 @@
 import datetime
-import time
 from urllib2 import urlopen
+from sqlalchemy import MetaData, Table, Column, Integer, String
 import logging
 log = logging.getLogger(__file__)
 
+from . import bulk
+from . import decoder
 from . import model
 from .utils import get_translation
 from .utils import get_gtfs_db
@@ -35,9 +37,59 @@ def make_pretty_short_name(r):
     return ret_val
 
 
-def add_short_names(opts, alert_orm, route_ids=[]):
-    ''' add all the route_short_names (from gtfsdb) to the Alert record as a comman separated string
+# the static GTFS routes table (loaded by gtfsdb) ... just the columns the short names need, so gtfsdb needn't be installed
+ROUTES = Table('routes', MetaData(),
+    Column('route_id', String, primary_key=True),
+    Column('route_short_name', String),
+    Column('route_long_name', String),
+    Column('route_sort_order', Integer),
+)
+
+class RouteNames(object):
+    ''' route_id -> pretty short name map (see make_pretty_short_name()), for the alerts' route_short_names ... the
+        routes are read in one query (with the loader's own engine, so the static GTFS needs to be in the same
+        database & schema) per alerts feed, rather than one query per alert
+
+        refresh() once per alerts feed, and then short_names() for each alert doesn't touch the database
     '''
+    def __init__(self, engine):
+        self.engine = engine
+        self.names = None
+
+    def refresh(self):
+        ''' read the routes (one query), and rebuild the names ... so renamed routes are picked up on the next feed
+            @return: self
+        '''
+        try:
+            with self.engine.connect() as conn:
+                log.debug("query routes table")
+                names = {}
+                for r in conn.execute(ROUTES.select()):
+                    names[r.route_id] = (r.route_sort_order, make_pretty_short_name(r))
+            self.names = names
+        except Exception, e:
+            log.debug("no static routes to get the short names from: {0}".format(e))
+            self.names = None
+        return self
+
+    def short_names(self, route_ids):
+        ''' @return: the route_short_names of these routes (in route_sort_order) as a comma separated string ... or None,
+                     when there are no static routes
+        '''
+        ret_val = None
+        if self.names is not None:
+            short_names = []
+            for order, nm in sorted(self.names[i] for i in set(route_ids) if i in self.names):
+                if nm and nm not in short_names:
+                    short_names.append(nm)
+            ret_val = ', '.join([str(x) for x in short_names])
+        return ret_val
+
+
+def get_short_names(opts, route_ids=[]):
+    ''' @return: all the route_short_names (from gtfsdb) for these routes as a comma separated string
+    '''
+    ret_val = None
     gtfs_db = get_gtfs_db(opts.dsn, opts.schema)
     if gtfs_db:
         short_names = []
@@ -50,30 +102,55 @@ def add_short_names(opts, alert_orm, route_ids=[]):
                 nm = make_pretty_short_name(r)
                 if nm and nm not in short_names:
                     short_names.append(nm)
-            alert_orm.route_short_names = ', '.join([str(x) for x in short_names])
+            ret_val = ', '.join([str(x) for x in short_names])
         except Exception, e:
             pass
+    return ret_val
+
 
+def add_short_names(opts, alert_orm, route_ids=[], lookup=None):
+    ''' add all the route_short_names (from gtfsdb) to the Alert record as a comman separated string
+        @param lookup: (optional) callable that takes the route ids, and returns the short names (e.g., RouteNames.short_names)
+    '''
+    if lookup:
+        short_names = lookup(route_ids)
+    else:
+        short_names = get_short_names(opts, route_ids)
+    if short_names is not None:
+        alert_orm.route_short_names = short_names
 
-def make_alert(session, pb, opts):
+
+def make_alert(session, pb, opts, generation=None):
     ''' will make a gtfsrdb Alert and add it to the session
     '''
     fm = pb.FeedMessage()
     fm.ParseFromString(urlopen(opts.alerts).read())
+    add_alerts(session, fm, opts, generation)
+
+
+def add_alerts(session, fm, opts, generation=None, short_names=None):
+    ''' will make a gtfsrdb Alert for each entity in the (already parsed) feed, and add them to the session
+        @param short_names: (optional) callable that takes the route ids, and returns the short names ... default is to
+                            query gtfsdb for each alert
+    '''
     check_feed(fm)
 
     print 'Adding %s alerts' % len(fm.entity)
     for entity in fm.entity:
         alert = entity.alert
 
-        start = alert.active_period[0].start
-        end = alert.active_period[0].end
+        # alerts without an active period are active all the time
+        start = end = 0
+        if len(alert.active_period) > 0:
+            start = alert.active_period[0].start
+            end = alert.active_period[0].end
 
         alert_orm = model.Alert(
+            generation = generation,
             start = start,
             end = end,
-            cause = alert.DESCRIPTOR.enum_types_by_name['Cause'].values_by_number[alert.cause].name,
-            effect = alert.DESCRIPTOR.enum_types_by_name['Effect'].values_by_number[alert.effect].name,
+            cause = decoder.CAUSE[alert.cause],
+            effect = decoder.EFFECT[alert.effect],
             url = get_translation(alert.url, opts.lang),
             header_text = get_translation(alert.header_text, opts.lang),
             description_text = get_translation(alert.description_text, opts.lang)
@@ -82,6 +159,7 @@ def make_alert(session, pb, opts):
         session.add(alert_orm)
         for ie in alert.informed_entity:
             dbie = model.EntitySelector(
+                    generation = generation,
                     agency_id = ie.agency_id,
                     route_id = ie.route_id,
                     route_type = ie.route_type,
@@ -94,10 +172,28 @@ def make_alert(session, pb, opts):
             session.add(dbie)
             alert_orm.InformedEntities.append(dbie)
 
+        for p_start, p_end in decoder.active_periods(alert):
+            period = model.AlertPeriod(generation=generation, start=p_start, end=p_end)
+            session.add(period)
+            alert_orm.ActivePeriods.append(period)
+
         # FXP ADDED: 
         ids = []
         for ie in alert.informed_entity:
             ids.append(ie.route_id)
         alert_orm.route_ids = ', '.join([str(x) for x in ids])
-        add_short_names(opts, alert_orm, ids)
+        add_short_names(opts, alert_orm, ids, short_names)
+
+
+def load_alerts(session, fm, opts, generation=None, batches=None, short_names=None):
+    ''' bulk version of add_alerts() ... writes the Alert, EntitySelector and AlertPeriod rows via SQLAlchemy Core
+        @param batches: (optional) the feed, already run through decoder.decode()
+        @param short_names: (optional) see add_alerts()
+        @return: number of rows written
+    '''
+    check_feed(fm)
 
+    if short_names is None:
+        short_names = lambda route_ids: get_short_names(opts, route_ids)
+    print 'Adding %s alerts' % (len(batches.alerts) if batches else len(fm.entity))
+    return bulk.write_alerts(session, fm, opts.lang, short_names, generation, batches)
@@ -0,0 +1,170 @@
+''' bulk writers for the gtfsrdb loader
+
+    rather than building an ORM object per row and session.add()'ing each one, these routines turn a
+    decoded FeedMessage (via the column batches of decoder.py) into plain row dicts, and then insert
+    those rows via SQLAlchemy Core (multi-row INSERT ... VALUES where the dialect supports it,
+    otherwise a plain executemany).
+
+    NOTE: the inserts run on the session's connection, so they're part of the same transaction as
+          everything else the loader does in a cycle (e.g., the -o deletes) ... session.commit() still
+          publishes the whole cycle atomically
+'''
+import datetime
+import logging
+log = logging.getLogger(__file__)
+
+from sqlalchemy import func, select, text
+
+from . import model
+from . import decoder
+
+# SQLite (before 3.32) limits a statement to 999 bind parameters ... size the multi-row chunks to fit
+MAX_BIND_PARAMS = 999
+
+
+def reserve_oids(conn, table, count):
+    ''' hand out a block of count primary keys for table ... this lets us assign the child
+        foreign keys (e.g., stop_time_updates.trip_update_id) before anything gets inserted
+
+        PostgreSQL pulls the block from the SERIAL sequence (so it stays in sync with the ORM path),
+        everything else (e.g., SQLite) just counts up from max(oid) inside the current transaction
+    '''
+    ret_val = []
+    if count > 0:
+        if conn.dialect.name == 'postgresql':
+            # NOTE: the table's schema may come from the connection's schema_translate_map (see loader.py)
+            schema = conn.schema_for_object(table)
+            name = '{0}.{1}'.format(schema, table.name) if schema else table.name
+            seq = conn.execute(select([func.pg_get_serial_sequence(name, 'oid')])).scalar()
+            if seq:
+                rs = conn.execute(text("SELECT nextval(:seq) FROM generate_series(1, :num)"), seq=seq, num=count)
+                ret_val = sorted([r[0] for r in rs])
+        if len(ret_val) == 0:
+            start = conn.execute(select([func.coalesce(func.max(table.c.oid), 0)])).scalar()
+            ret_val = range(start + 1, start + count + 1)
+    return ret_val
+
+
+def insert_rows(conn, table, rows):
+    ''' insert a list of row dicts into table ... multi-row VALUES chunks when the dialect supports it
+        (SQLite 3.7.11+, PostgreSQL), and a straight executemany otherwise
+    '''
+    if rows:
+        if conn.dialect.supports_multivalues_insert:
+            chunk = max(1, MAX_BIND_PARAMS // len(rows[0]))
+            for i in range(0, len(rows), chunk):
+                conn.execute(table.insert().values(rows[i:i + chunk]))
+        else:
+            conn.execute(table.insert(), rows)
+    return len(rows)
+
+
+# number of entities written at a time, when a feed is streamed (see write_stream())
+STREAM_BATCH = 1000
+
+
+def feed_timestamp(batches):
+    ''' header timestamp as a (utc) datetime, which gets stamped on each trip_update & vehicle_position
+    '''
+    return datetime.datetime.utcfromtimestamp(batches.timestamp)
+
+
+def trip_update_rows(fm, generation=None, batches=None):
+    ''' @param batches: (optional) the feed, already run through decoder.decode()
+        @return: a list of trip_updates rows and a list of stop_time_updates rows ... where each
+                 stop time's 'trip_update_id' is (for now) the index of its parent in the trip list
+    '''
+    if batches is None:
+        batches = decoder.decode(fm)
+    trips = batches.trip_updates.rows(generation=generation, timestamp=feed_timestamp(batches))
+    stop_times = batches.stop_time_updates.rows(generation=generation)
+    return trips, stop_times
+
+
+def vehicle_position_rows(fm, generation=None, batches=None):
+    ''' @return: a list of vehicle_positions rows
+    '''
+    if batches is None:
+        batches = decoder.decode(fm)
+    return batches.vehicle_positions.rows(generation=generation, timestamp=feed_timestamp(batches))
+
+
+def alert_rows(fm, lang, short_names=None, generation=None, batches=None):
+    ''' @param short_names: optional callable that takes a list of route ids, and returns the alert's
+                            comma separated route_short_names string
+        @return: a list of alerts rows, a list of entity_selectors rows and a list of alert_periods rows ...
+                 where each selector's (and period's) 'alert_id' is (for now) the index of its parent in the alert list
+    '''
+    if batches is None:
+        batches = decoder.decode(fm, lang)
+    alerts = batches.alerts.rows(generation=generation, route_short_names=None)
+    if short_names:
+        for a, route_ids in zip(alerts, decoder.route_ids_by_alert(batches)):
+            a['route_short_names'] = short_names(route_ids)
+    selectors = batches.entity_selectors.rows(generation=generation)
+    periods = batches.alert_periods.rows(generation=generation)
+    return alerts, selectors, periods
+
+
+def link_children(conn, parent_table, parents, children, fk):
+    ''' reserve primary keys for the parent rows, then point each child's fk column at its parent's new oid
+    '''
+    oids = reserve_oids(conn, parent_table, len(parents))
+    for p, oid in zip(parents, oids):
+        p['oid'] = oid
+    for c in children:
+        c[fk] = oids[c[fk]]
+
+
+def write_trip_updates(session, fm, generation=None, batches=None):
+    ''' bulk insert the trip_updates & stop_time_updates for this feed
+        @return: number of rows written
+    '''
+    conn = session.connection()
+    trips, stop_times = trip_update_rows(fm, generation, batches)
+    link_children(conn, model.TripUpdate.__table__, trips, stop_times, 'trip_update_id')
+    ret_val  = insert_rows(conn, model.TripUpdate.__table__, trips)
+    ret_val += insert_rows(conn, model.StopTimeUpdate.__table__, stop_times)
+    return ret_val
+
+
+def write_vehicle_positions(session, fm, generation=None, batches=None):
+    ''' bulk insert the vehicle_positions for this feed
+        @return: number of rows written
+    '''
+    conn = session.connection()
+    return insert_rows(conn, model.VehiclePosition.__table__, vehicle_position_rows(fm, generation, batches))
+
+
+def write_alerts(session, fm, lang, short_names=None, generation=None, batches=None):
+    ''' bulk insert the alerts, entity_selectors & alert_periods for this feed
+        @return: number of rows written
+    '''
+    conn = session.connection()
+    alerts, selectors, periods = alert_rows(fm, lang, short_names, generation, batches)
+    link_children(conn, model.Alert.__table__, alerts, selectors + periods, 'alert_id')
+    ret_val  = insert_rows(conn, model.Alert.__table__, alerts)
+    ret_val += insert_rows(conn, model.EntitySelector.__table__, selectors)
+    ret_val += insert_rows(conn, model.AlertPeriod.__table__, periods)
+    return ret_val
+
+
+def write_stream(session, feed, fs, generation=None, lang=None, short_names=None, batch_size=STREAM_BATCH, delays=None):
+    ''' bulk insert a streamed feed (see stream.FeedStream), decoding and writing batch_size entities at a time
+        @param feed: 'trip_updates', 'alerts' or 'vehicle_positions'
+        @param delays: (optional) summary.DelaySummary that each batch of trip updates gets added to
+        @return: number of rows written
+    '''
+    ret_val = 0
+    timestamp = fs.read_header().timestamp
+    for entities in fs.batches(batch_size):
+        batches = decoder.decode_entities(entities, timestamp, lang)
+        if feed == 'trip_updates':
+            ret_val += write_trip_updates(session, None, generation, batches)
+            if delays is not None:
+                delays.add(batches)
+        elif feed == 'alerts':
+            ret_val += write_alerts(session, None, lang, short_names, generation, batches)
+        elif feed == 'vehicle_positions':
+            ret_val += write_vehicle_positions(session, None, generation, batches)
+    return ret_val
@@ -0,0 +1,237 @@
+''' columnar decoder for GTFS-realtime feeds
+
+    walks a gtfs_realtime_pb2.FeedMessage once, and turns it into column oriented batches (one list or
+    array per column) for trip updates, stop time updates, vehicle positions and alerts (and their entity
+    selectors) ... numeric columns are array.array's, strings are plain lists
+
+    the enum names (e.g., 'SCHEDULED', 'UNKNOWN_CAUSE') come from tables built once (at import) from the
+    protobuf descriptors, rather than looked up via DESCRIPTOR.enum_types_by_name for every row
+
+    child batches (stop time updates, entity selectors, alert periods) carry the index of their parent row in the parent
+    batch (e.g., stop_time_updates.trip_update_id), so the bulk writer can link them up once it has oids
+'''
+from array import array
+import logging
+log = logging.getLogger(__file__)
+
+from . import gtfs_realtime_pb2
+from .model import FOREVER
+from .utils import get_translation
+
+
+def enum_table(descriptor, enum_type):
+    ''' @return: {number: name} for one of the message's enums
+    '''
+    return dict((v.number, v.name) for v in descriptor.enum_types_by_name[enum_type].values)
+
+SCHEDULE_RELATIONSHIP = enum_table(gtfs_realtime_pb2.TripDescriptor.DESCRIPTOR, 'ScheduleRelationship')
+CAUSE = enum_table(gtfs_realtime_pb2.Alert.DESCRIPTOR, 'Cause')
+EFFECT = enum_table(gtfs_realtime_pb2.Alert.DESCRIPTOR, 'Effect')
+
+# (column name, array typecode) ... a typecode of None means a plain list
+TRIP_UPDATE_COLUMNS = (
+    ('trip_id', None), ('route_id', None), ('trip_start_time', None), ('trip_start_date', None),
+    ('schedule_relationship', None),
+    ('vehicle_id', None), ('vehicle_label', None), ('vehicle_license_plate', None),
+)
+STOP_TIME_UPDATE_COLUMNS = (
+    ('stop_sequence', 'l'), ('stop_id', None),
+    ('arrival_delay', 'l'), ('arrival_time', 'l'), ('arrival_uncertainty', 'l'),
+    ('departure_delay', 'l'), ('departure_time', 'l'), ('departure_uncertainty', 'l'),
+    ('schedule_relationship', None),
+    ('trip_update_id', 'l'),
+)
+# decoded, but not written to stop_time_updates ... 1 when the arrival has a delay (an on time arrival has a
+# delay of 0, while a missing one also reads as 0 ... see summary.py)
+STOP_TIME_UPDATE_FLAGS = (
+    ('arrival_has_delay', 'b'),
+)
+VEHICLE_POSITION_COLUMNS = (
+    ('trip_id', None), ('route_id', None), ('trip_start_time', None), ('trip_start_date', None),
+    ('vehicle_id', None), ('vehicle_label', None), ('vehicle_license_plate', None),
+    ('position_latitude', 'd'), ('position_longitude', 'd'), ('position_bearing', 'd'), ('position_speed', 'd'),
+)
+ALERT_COLUMNS = (
+    ('start', 'l'), ('end', 'l'), ('cause', None), ('effect', None),
+    ('url', None), ('header_text', None), ('description_text', None), ('route_ids', None),
+)
+ENTITY_SELECTOR_COLUMNS = (
+    ('agency_id', None), ('route_id', None), ('route_type', 'l'), ('stop_id', None),
+    ('trip_id', None), ('trip_route_id', None), ('trip_start_time', None), ('trip_start_date', None),
+    ('alert_id', 'l'),
+)
+ALERT_PERIOD_COLUMNS = (
+    ('start', 'l'), ('end', 'l'), ('alert_id', 'l'),
+)
+
+
+class Batch(object):
+    ''' one table's worth of rows, held as columns
+        @param flags: (optional) extra columns that are decoded, but aren't part of the rows
+    '''
+    def __init__(self, columns, flags=()):
+        self.names = [n for n, t in columns]
+        self.columns = dict((n, array(t) if t else []) for n, t in columns + flags)
+        self.entity_ids = []  # FeedEntity.id of each trip update / vehicle position row (not a column ... see diff.py)
+
+    def __len__(self):
+        return len(self.columns[self.names[0]])
+
+    def __getitem__(self, name):
+        return self.columns[name]
+
+    def rows(self, **constants):
+        ''' @param constants: extra values (e.g., generation) to set on every row
+            @return: the batch as a list of row dicts
+        '''
+        ret_val = []
+        for values in zip(*[self.columns[n] for n in self.names]):
+            row = dict(zip(self.names, values))
+            row.update(constants)
+            ret_val.append(row)
+        return ret_val
+
+
+class FeedBatches(object):
+    ''' the column batches for every type of entity in a feed
+    '''
+    def __init__(self, timestamp=0):
+        self.timestamp = timestamp
+        self.entities = 0
+        self.trip_updates = Batch(TRIP_UPDATE_COLUMNS)
+        self.stop_time_updates = Batch(STOP_TIME_UPDATE_COLUMNS, STOP_TIME_UPDATE_FLAGS)
+        self.vehicle_positions = Batch(VEHICLE_POSITION_COLUMNS)
+        self.alerts = Batch(ALERT_COLUMNS)
+        self.entity_selectors = Batch(ENTITY_SELECTOR_COLUMNS)
+        self.alert_periods = Batch(ALERT_PERIOD_COLUMNS)
+
+
+def decode(fm, lang=None):
+    ''' walk the feed's entities (once), appending each to the batch for its type
+        @param lang: language of the alert text to keep (see utils.get_translation)
+        @return: FeedBatches
+    '''
+    return decode_entities(fm.entity, fm.header.timestamp, lang)
+
+
+def decode_entities(entities, timestamp=0, lang=None):
+    ''' decode() for a list of FeedEntity's (e.g., one batch of a streamed feed ... see stream.py)
+        @param timestamp: the feed's header timestamp
+    '''
+    ret_val = FeedBatches(timestamp)
+    tu_cols = ret_val.trip_updates.columns
+    stu_cols = ret_val.stop_time_updates.columns
+    vp_cols = ret_val.vehicle_positions.columns
+    alert_cols = ret_val.alerts.columns
+    sel_cols = ret_val.entity_selectors.columns
+    period_cols = ret_val.alert_periods.columns
+
+    for entity in entities:
+        ret_val.entities += 1
+        if entity.HasField('trip_update'):
+            tu = entity.trip_update
+            trip = tu.trip
+            vehicle = tu.vehicle
+            sr = SCHEDULE_RELATIONSHIP[trip.schedule_relationship]
+            parent = len(tu_cols['trip_id'])
+            ret_val.trip_updates.entity_ids.append(entity.id)
+            tu_cols['trip_id'].append(trip.trip_id)
+            tu_cols['route_id'].append(trip.route_id)
+            tu_cols['trip_start_time'].append(trip.start_time)
+            tu_cols['trip_start_date'].append(trip.start_date)
+            tu_cols['schedule_relationship'].append(sr)
+            tu_cols['vehicle_id'].append(vehicle.id)
+            tu_cols['vehicle_label'].append(vehicle.label)
+            tu_cols['vehicle_license_plate'].append(vehicle.license_plate)
+
+            for stu in tu.stop_time_update:
+                arrival = stu.arrival
+                departure = stu.departure
+                stu_cols['stop_sequence'].append(stu.stop_sequence)
+                stu_cols['stop_id'].append(stu.stop_id)
+                stu_cols['arrival_delay'].append(arrival.delay)
+                stu_cols['arrival_has_delay'].append(arrival.HasField('delay'))
+                stu_cols['arrival_time'].append(arrival.time)
+                stu_cols['arrival_uncertainty'].append(arrival.uncertainty)
+                stu_cols['departure_delay'].append(departure.delay)
+                stu_cols['departure_time'].append(departure.time)
+                stu_cols['departure_uncertainty'].append(departure.uncertainty)
+                stu_cols['schedule_relationship'].append(sr)
+                stu_cols['trip_update_id'].append(parent)
+
+        if entity.HasField('vehicle'):
+            vp = entity.vehicle
+            trip = vp.trip
+            vehicle = vp.vehicle
+            position = vp.position
+            ret_val.vehicle_positions.entity_ids.append(entity.id)
+            vp_cols['trip_id'].append(trip.trip_id)
+            vp_cols['route_id'].append(trip.route_id)
+            vp_cols['trip_start_time'].append(trip.start_time)
+            vp_cols['trip_start_date'].append(trip.start_date)
+            vp_cols['vehicle_id'].append(vehicle.id)
+            vp_cols['vehicle_label'].append(vehicle.label)
+            vp_cols['vehicle_license_plate'].append(vehicle.license_plate)
+            vp_cols['position_latitude'].append(position.latitude)
+            vp_cols['position_longitude'].append(position.longitude)
+            vp_cols['position_bearing'].append(position.bearing)
+            vp_cols['position_speed'].append(position.speed)
+
+        if entity.HasField('alert'):
+            alert = entity.alert
+            parent = len(alert_cols['cause'])
+            route_ids = []
+            for ie in alert.informed_entity:
+                trip = ie.trip
+                route_ids.append(ie.route_id)
+                sel_cols['agency_id'].append(ie.agency_id)
+                sel_cols['route_id'].append(ie.route_id)
+                sel_cols['route_type'].append(ie.route_type)
+                sel_cols['stop_id'].append(ie.stop_id)
+                sel_cols['trip_id'].append(trip.trip_id)
+                sel_cols['trip_route_id'].append(trip.route_id)
+                sel_cols['trip_start_time'].append(trip.start_time)
+                sel_cols['trip_start_date'].append(trip.start_date)
+                sel_cols['alert_id'].append(parent)
+
+            # every active period gets an alert_periods row (alerts without one are active all the time) ...
+            # the alert itself keeps just the first one
+            start = end = 0
+            if len(alert.active_period) > 0:
+                start = alert.active_period[0].start
+                end = alert.active_period[0].end
+            for p_start, p_end in active_periods(alert):
+                period_cols['start'].append(p_start)
+                period_cols['end'].append(p_end)
+                period_cols['alert_id'].append(parent)
+            alert_cols['start'].append(start)
+            alert_cols['end'].append(end)
+            alert_cols['cause'].append(CAUSE[alert.cause])
+            alert_cols['effect'].append(EFFECT[alert.effect])
+            alert_cols['url'].append(get_translation(alert.url, lang))
+            alert_cols['header_text'].append(get_translation(alert.header_text, lang))
+            alert_cols['description_text'].append(get_translation(alert.description_text, lang))
+            alert_cols['route_ids'].append(', '.join([str(x) for x in route_ids]))
+
+    return ret_val
+
+
+def active_periods(alert):
+    ''' @return: list of (start, end) for each of the alert's active periods ... a missing start is 0, and a
+                 missing end is model.FOREVER (one (0, FOREVER) period when the alert doesn't have any)
+    '''
+    ret_val = []
+    for p in alert.active_period:
+        ret_val.append((p.start, p.end or FOREVER))
+    if not ret_val:
+        ret_val.append((0, FOREVER))
+    return ret_val
+
+
+def route_ids_by_alert(batches):
+    ''' @return: a list (one entry per alert) of each alert's informed route ids
+    '''
+    ret_val = [[] for i in range(len(batches.alerts))]
+    for parent, route_id in zip(batches.entity_selectors['alert_id'], batches.entity_selectors['route_id']):
+        ret_val[parent].append(route_id)
+    return ret_val
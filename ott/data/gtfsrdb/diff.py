@@ -0,0 +1,213 @@
+''' entity level, incremental writes of trip updates and vehicle positions (the loader's --diff mode)
+
+    rather than writing every entity of every feed again, each incoming entity is keyed (trip updates by
+    (trip_id, trip_start_date), vehicle positions by vehicle_id) and compared to the version of it we
+    last wrote ... and only the entities that were inserted, updated or deleted get written.  entities
+    without a key (e.g., vehicles with no vehicle.id), or with the same key as an earlier entity in the feed,
+    fall back to their FeedEntity.id.
+
+    the comparison is against a digest of each entity's row (plus, for trip updates, its stop time updates),
+    ignoring the oid, generation and the feed's header timestamp (which changes on every poll).  so the
+    timestamp column of an unchanged entity is the time it last changed.
+
+    the digests are held in memory (the keys and oids are seeded from the database when the loader starts,
+    so the first cycle rewrites every entity once).  changes only become the new baseline once the loader
+    commits them (see commit() / reset()).
+
+    in diff mode, rows stay in the feed's current generation (see generations.py) rather than getting a
+    new generation each cycle.
+'''
+import hashlib
+import logging
+log = logging.getLogger(__file__)
+
+from sqlalchemy import select, bindparam
+
+from . import bulk
+from . import decoder
+from . import model
+
+# columns that don't count as a change to an entity
+IGNORE = ('oid', 'generation', 'timestamp')
+
+# max number of ids in a single IN (...) list
+CHUNK = 500
+
+# seed() key of a row whose key another row already has ... never matched by write(), so the row gets deleted
+STALE = object()
+
+
+def row_digest(row, children=()):
+    ''' sha1 of the (significant) values of a row and its child rows
+    '''
+    def values(r, fk=None):
+        return [(k, r[k]) for k in sorted(r.keys()) if k not in IGNORE and k != fk]
+    s = repr(values(row))
+    for c in children:
+        s += repr(values(c, 'trip_update_id'))
+    return hashlib.sha1(s).hexdigest()
+
+
+def chunks(ids):
+    for i in range(0, len(ids), CHUNK):
+        yield ids[i:i + CHUNK]
+
+
+class EntityDiff(object):
+    ''' keeps the oid & digest of each entity (by key) we've written for a table, and writes only the changes
+
+        @param table: the parent table (e.g., trip_updates)
+        @param keys: the columns that identify an entity
+        @param child_table / fk: (optional) the child table (e.g., stop_time_updates) and its foreign key column
+    '''
+    def __init__(self, table, keys, child_table=None, fk=None):
+        self.table = table
+        self.keys = keys
+        self.child_table = child_table
+        self.fk = fk
+        self.state = None
+        self.pending = None
+
+    def seed(self, conn, generation):
+        ''' load the keys & oids of what's in the database ... with no digests, the first write updates everything
+
+            NOTE: the entity ids (see entity_key()) aren't in the database, so rows that were written under one
+                  share their (empty or duplicate) key ... all but one of them is seeded as STALE, and deleted
+                  by the next write
+        '''
+        cols = [self.table.c.oid] + [self.table.c[k] for k in self.keys]
+        rs = conn.execute(select(cols).where(self.table.c.generation == generation).order_by(self.table.c.oid))
+        self.state = {}
+        for r in rs:
+            key = tuple(r[1:])
+            if key in self.state:
+                key = (STALE, r[0])
+            self.state[key] = (r[0], None)
+
+    def commit(self):
+        ''' the loader committed our changes ... they're the new baseline
+        '''
+        if self.pending is not None:
+            self.state = self.pending
+            self.pending = None
+
+    def reset(self):
+        ''' the loader rolled back ... we no longer know what's in the database, so re-seed on the next write
+        '''
+        self.state = None
+        self.pending = None
+
+    def entity_key(self, row, entity_id, pending):
+        ''' @return: the row's key ... its keys columns, or (None, entity_id) when those are empty or
+                     already taken by an earlier entity in the feed.  None when neither is usable.
+        '''
+        key = tuple(row[k] for k in self.keys)
+        if any(key) and key not in pending:
+            return key
+        key = (None, entity_id)
+        if entity_id and key not in pending:
+            return key
+        return None
+
+    def write(self, conn, rows, children=[], generation=None, entity_ids=None):
+        ''' write the changes between the rows (and their children) and the last version of each entity
+            @param children: child rows, each with its fk column set to the index of its parent in rows
+            @param entity_ids: (optional) the FeedEntity.id of each row ... the fallback key (see entity_key())
+            @return: dict with the number of entities 'inserted', 'updated', 'deleted' and 'unchanged'
+        '''
+        if self.state is None:
+            self.seed(conn, generation)
+
+        # step 1: group the children by parent
+        kids = [[] for r in rows]
+        for c in children:
+            kids[c[self.fk]].append(c)
+
+        # step 2: compare each incoming entity to the last version we wrote
+        if entity_ids is None:
+            entity_ids = [None] * len(rows)
+        pending = {}
+        keys = {}
+        inserts = []
+        updates = []
+        unchanged = 0
+        dropped = 0
+        for i, row in enumerate(rows):
+            key = self.entity_key(row, entity_ids[i], pending)
+            if key is None:
+                dropped += 1
+                continue
+            keys[i] = key
+            digest = row_digest(row, kids[i])
+            old = self.state.get(key)
+            if old is None:
+                inserts.append(i)
+                pending[key] = [None, digest]
+            elif old[1] != digest:
+                row['oid'] = old[0]
+                updates.append(i)
+                pending[key] = [old[0], digest]
+            else:
+                unchanged += 1
+                pending[key] = list(old)
+        if dropped:
+            log.warn("{0} {1} entities with no key (or a duplicate one) and no entity id ... dropped".format(
+                dropped, self.table.name))
+        deletes = [oid for key, (oid, digest) in self.state.items() if key not in pending]
+
+        # step 3: deletes (and the children of updated entities, which just get re-inserted)
+        stale = deletes + [rows[i]['oid'] for i in updates]
+        if self.child_table is not None:
+            for ids in chunks(stale):
+                conn.execute(self.child_table.delete().where(self.child_table.c[self.fk].in_(ids)))
+        for ids in chunks(deletes):
+            conn.execute(self.table.delete().where(self.table.c.oid.in_(ids)))
+
+        # step 4: updates
+        if updates:
+            cols = [k for k in rows[updates[0]].keys() if k != 'oid']
+            stmt = self.table.update().where(self.table.c.oid == bindparam('_oid'))
+            stmt = stmt.values(dict((k, bindparam('_' + k)) for k in cols))
+            conn.execute(stmt, [dict(('_' + k, v) for k, v in rows[i].items()) for i in updates])
+
+        # step 5: inserts
+        oids = bulk.reserve_oids(conn, self.table, len(inserts))
+        for i, oid in zip(inserts, oids):
+            rows[i]['oid'] = oid
+            pending[keys[i]][0] = oid
+        bulk.insert_rows(conn, self.table, [rows[i] for i in inserts])
+
+        # step 6: children of the inserted & updated entities
+        if self.child_table is not None:
+            new_kids = []
+            for i in inserts + updates:
+                for c in kids[i]:
+                    c[self.fk] = rows[i]['oid']
+                    new_kids.append(c)
+            bulk.insert_rows(conn, self.child_table, new_kids)
+
+        self.pending = dict((k, tuple(v)) for k, v in pending.items())
+        return dict(inserted=len(inserts), updated=len(updates), deleted=len(deletes), unchanged=unchanged)
+
+
+class TripUpdateDiff(EntityDiff):
+    def __init__(self):
+        super(TripUpdateDiff, self).__init__(model.TripUpdate.__table__, ('trip_id', 'trip_start_date'),
+                                             model.StopTimeUpdate.__table__, 'trip_update_id')
+
+    def write_feed(self, session, fm, generation, batches=None):
+        if batches is None:
+            batches = decoder.decode(fm)
+        trips, stop_times = bulk.trip_update_rows(fm, generation, batches)
+        return self.write(session.connection(), trips, stop_times, generation, batches.trip_updates.entity_ids)
+
+
+class VehiclePositionDiff(EntityDiff):
+    def __init__(self):
+        super(VehiclePositionDiff, self).__init__(model.VehiclePosition.__table__, ('vehicle_id',))
+
+    def write_feed(self, session, fm, generation, batches=None):
+        if batches is None:
+            batches = decoder.decode(fm)
+        rows = bulk.vehicle_position_rows(fm, generation, batches)
+        return self.write(session.connection(), rows, [], generation, batches.vehicle_positions.entity_ids)
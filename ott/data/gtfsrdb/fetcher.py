@@ -0,0 +1,336 @@
+''' feed fetcher used by the loader for all three types of GTFS-realtime feed
+
+    - keeps its HTTP connection alive between fetches (one connection per feed)
+    - sends conditional requests (If-None-Match / If-Modified-Since) from the ETag and Last-Modified
+      values of the last load ... a 304 Not Modified comes back as a response with no raw bytes
+    - asks for (and decodes) gzip / deflate content
+    - open() hands back the feed as a stream (see stream.py) rather than reading it all into memory
+    - follows redirects (a permanent one re-points the fetcher for good), and goes through the proxy from the
+      http_proxy / https_proxy environment (see urllib.getproxies()), like urlopen does
+
+    non-http urls (e.g., file://) are just read via urlopen
+
+    FeedJob / run_jobs() fetch and decode several feeds at once, each on its own thread with its own timeout
+'''
+import time
+import zlib
+import socket
+import threading
+import base64
+import httplib
+import urllib
+import urlparse
+from urllib2 import urlopen
+import logging
+log = logging.getLogger(__file__)
+
+from . import stream
+
+# redirects followed per fetch, before giving up
+MAX_REDIRECTS = 5
+REDIRECTS = (301, 302, 303, 307, 308)
+PERMANENT_REDIRECTS = (301, 308)
+
+
+class FeedResponse(object):
+    ''' result of a fetch ... raw is None when the server said the feed hasn't changed (304)
+        NOTE: responses from FeedFetcher.open() have no raw bytes either ... the feed is read from stream
+    '''
+    def __init__(self, raw=None, etag=None, last_modified=None, status=200, stream=None):
+        self.raw = raw
+        self.etag = etag
+        self.last_modified = last_modified
+        self.status = status
+        self.stream = stream
+
+    @property
+    def not_modified(self):
+        return self.raw is None and self.stream is None
+
+
+class FeedFetcher(object):
+    ''' fetches a single feed url, keeping tabs on the requests made and bytes transferred
+    '''
+    def __init__(self, url, timeout=30):
+        self.timeout = timeout
+        self.conn = None
+        self.set_url(url)
+
+        # the url we were pointed at, while a temporary redirect has us somewhere else
+        self.origin = None
+
+        # counters
+        self.requests = 0
+        self.connections = 0
+        self.not_modified = 0
+        self.bytes_received = 0
+        self.bytes_decoded = 0
+
+    def set_url(self, url):
+        ''' point the fetcher at a url (and its proxy, if the environment has one for the url's scheme)
+        '''
+        self.url = url
+        parts = urlparse.urlsplit(url)
+        self.scheme = parts.scheme
+        self.host = parts.netloc
+        self.path = parts.path or '/'
+        if parts.query:
+            self.path = "{0}?{1}".format(self.path, parts.query)
+
+        self.proxy = None
+        self.proxy_headers = {}
+        proxy = urllib.getproxies().get(self.scheme)
+        if proxy and self.scheme in ('http', 'https') and not urllib.proxy_bypass(parts.hostname or self.host):
+            if '://' not in proxy:
+                proxy = 'http://' + proxy
+            p = urlparse.urlsplit(proxy)
+            self.proxy = p.hostname if p.port is None else "{0}:{1}".format(p.hostname, p.port)
+            if p.username:
+                auth = base64.b64encode("{0}:{1}".format(urllib.unquote(p.username), urllib.unquote(p.password or '')))
+                self.proxy_headers['Proxy-Authorization'] = 'Basic ' + auth
+
+    def fetch(self, etag=None, last_modified=None):
+        ''' fetch the feed ... pass in the ETag / Last-Modified of the data we already have (if any)
+            @return: FeedResponse
+        '''
+        if self.scheme not in ('http', 'https'):
+            raw = urlopen(self.url).read()
+            self.requests += 1
+            self.bytes_received += len(raw)
+            self.bytes_decoded += len(raw)
+            return FeedResponse(raw)
+
+        resp = self.request(self.headers(etag, last_modified))
+        body = resp.read()
+        self.bytes_received += len(body)
+
+        if resp.status == 304:
+            self.not_modified += 1
+            return FeedResponse(None, etag, last_modified, resp.status)
+        if resp.status != 200:
+            raise IOError("{0} returned HTTP status {1} {2}".format(self.url, resp.status, resp.reason))
+
+        raw = self.decode(body, resp.getheader('content-encoding'))
+        self.bytes_decoded += len(raw)
+        return FeedResponse(raw, resp.getheader('etag'), resp.getheader('last-modified'), resp.status)
+
+    def open(self, etag=None, last_modified=None):
+        ''' like fetch(), but rather than reading the whole feed into memory, the response's stream is a
+            (decoded) file-like object to read the feed from a bit at a time ... read it to the end before
+            the next fetch (or else the kept-alive connection gets dropped, and re-opened)
+            @return: FeedResponse
+        '''
+        def received(n):
+            self.bytes_received += n
+
+        def decoded(n):
+            self.bytes_decoded += n
+
+        if self.scheme not in ('http', 'https'):
+            f = stream.CountingReader(urlopen(self.url), received)
+            self.requests += 1
+            return FeedResponse(None, stream=stream.CountingReader(f, decoded))
+
+        resp = self.request(self.headers(etag, last_modified))
+        if resp.status == 304:
+            self.bytes_received += len(resp.read())
+            self.not_modified += 1
+            return FeedResponse(None, etag, last_modified, resp.status)
+        if resp.status != 200:
+            self.bytes_received += len(resp.read())
+            raise IOError("{0} returned HTTP status {1} {2}".format(self.url, resp.status, resp.reason))
+
+        f = stream.CountingReader(resp, received)
+        encoding = resp.getheader('content-encoding')
+        if encoding:
+            f = stream.InflateReader(f, encoding)
+        return FeedResponse(None, resp.getheader('etag'), resp.getheader('last-modified'), resp.status,
+                            stream.CountingReader(f, decoded))
+
+    def headers(self, etag=None, last_modified=None):
+        ret_val = {'Accept-Encoding': 'gzip, deflate'}
+        if etag:
+            ret_val['If-None-Match'] = etag
+        if last_modified:
+            ret_val['If-Modified-Since'] = last_modified
+        return ret_val
+
+    def request(self, headers):
+        ''' GET the feed, following any redirects ... a permanent redirect (301 / 308) re-points the fetcher at the
+            new url for good, while after a temporary one, the next request goes back to the url that redirected
+        '''
+        if self.origin:
+            self.close()
+            self.set_url(self.origin)
+            self.origin = None
+
+        start = self.url
+        origin = None
+        for redirect in range(MAX_REDIRECTS + 1):
+            resp = self.send(headers)
+            location = resp.getheader('location')
+            if resp.status not in REDIRECTS or not location:
+                break
+            if redirect == MAX_REDIRECTS:
+                self.origin = start
+                raise IOError("{0} redirected more than {1} times".format(start, MAX_REDIRECTS))
+
+            # the redirect is to somewhere else, so drop the kept-alive connection
+            self.bytes_received += len(resp.read())
+            self.close()
+            url = urlparse.urljoin(self.url, location)
+            if urlparse.urlsplit(url).scheme not in ('http', 'https'):
+                self.origin = start
+                raise IOError("{0} redirected to {1}".format(start, url))
+            log.info("{0} redirected ({1}) to {2}".format(self.url, resp.status, url))
+            if origin is None and resp.status not in PERMANENT_REDIRECTS:
+                origin = self.url
+            self.set_url(url)
+
+        self.origin = origin
+        return resp
+
+    def send(self, headers):
+        ''' GET the feed on our kept-alive connection ... if the server has dropped that connection
+            in the meantime, reconnect and try once more
+        '''
+        path = self.path
+        if self.proxy and self.scheme == 'http':
+            # plain http goes through the proxy with the full url ... https is tunneled (see connect())
+            path = urlparse.urlunsplit(urlparse.urlsplit(self.url)[:4] + ('',))
+            headers = dict(headers, **self.proxy_headers)
+        for attempt in (1, 2):
+            try:
+                conn = self.connect()
+                conn.request('GET', path, headers=headers)
+                self.requests += 1
+                return conn.getresponse()
+            except (httplib.HTTPException, socket.error), e:
+                self.close()
+                if attempt == 2:
+                    raise
+                log.debug("reconnecting to {0} after {1}".format(self.host, e))
+
+    def connect(self):
+        if self.conn is None:
+            host = self.proxy or self.host
+            if self.scheme == 'https':
+                self.conn = httplib.HTTPSConnection(host, timeout=self.timeout)
+                if self.proxy:
+                    self.conn.set_tunnel(self.host, headers=self.proxy_headers)
+            else:
+                self.conn = httplib.HTTPConnection(host, timeout=self.timeout)
+            self.connections += 1
+        return self.conn
+
+    def close(self):
+        if self.conn:
+            try:
+                self.conn.close()
+            except:
+                pass
+            self.conn = None
+
+    @classmethod
+    def decode(cls, body, encoding):
+        ''' undo any gzip / deflate content-encoding
+        '''
+        ret_val = body
+        if encoding:
+            encoding = encoding.lower().strip()
+            if encoding in ('gzip', 'x-gzip'):
+                ret_val = zlib.decompress(body, 16 + zlib.MAX_WBITS)
+            elif encoding == 'deflate':
+                # deflate should be zlib wrapped, but plenty of servers send raw deflate data
+                try:
+                    ret_val = zlib.decompress(body)
+                except zlib.error:
+                    ret_val = zlib.decompress(body, -zlib.MAX_WBITS)
+        return ret_val
+
+
+class FeedJob(object):
+    ''' fetch (and decode) one feed on its own thread
+
+        @param decode: callable that turns the raw feed bytes into a FeedMessage (None to just fetch them)
+        @param unchanged: optional callable that takes the raw bytes, and returns True if they're the same as
+                          the last load (in which case they aren't decoded ... see same_content)
+        @param timeout: seconds (from start) this job gets before we stop waiting on it
+        @param streaming: open() the feed rather than fetch() it ... decode is then handed the response's
+                          stream (and should read no more of it than it needs, e.g., just the header)
+    '''
+    def __init__(self, feed, fetcher, decode, etag=None, last_modified=None, unchanged=None, timeout=30,
+                 streaming=False):
+        self.feed = feed
+        self.fetcher = fetcher
+        self.decode = decode
+        self.etag = etag
+        self.last_modified = last_modified
+        self.unchanged = unchanged
+        self.timeout = timeout
+        self.streaming = streaming
+
+        self.resp = None
+        self.fm = None
+        self.batches = None  # column batches, when the feed gets decoded elsewhere (see pipeline.py)
+        self.same_content = False
+        self.error = None
+        self.thread = None
+        self.started = None
+
+        # seconds spent fetching, and decoding, the feed
+        self.fetch_time = 0
+        self.decode_time = 0
+
+    def start(self):
+        self.started = time.time()
+        self.thread = threading.Thread(target=self.run, name="fetch-{0}".format(self.feed))
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run(self):
+        clock = time.time
+        try:
+            if self.streaming:
+                self.resp = self.fetcher.open(self.etag, self.last_modified)
+                self.fetch_time = clock() - self.started
+                if self.resp.stream is not None:
+                    self.fm = self.decode(self.resp.stream)
+                    self.decode_time = clock() - self.started - self.fetch_time
+                return
+
+            self.resp = self.fetcher.fetch(self.etag, self.last_modified)
+            self.fetch_time = clock() - self.started
+            if self.resp.raw is not None:
+                if self.unchanged and self.unchanged(self.resp.raw):
+                    self.same_content = True
+                elif self.decode:
+                    self.fm = self.decode(self.resp.raw)
+                    self.decode_time = clock() - self.started - self.fetch_time
+        except Exception, e:
+            self.error = e
+
+    def wait(self):
+        ''' wait out whatever is left of this job's timeout
+            @return: True if the job finished (successfully or not) in time
+        '''
+        self.thread.join(max(0, self.started + self.timeout - time.time()))
+        if self.thread.is_alive():
+            self.error = IOError("timed out after {0} seconds fetching the {1} feed".format(self.timeout, self.feed))
+            return False
+        return True
+
+    @property
+    def running(self):
+        return self.thread is not None and self.thread.is_alive()
+
+
+def run_jobs(jobs):
+    ''' start all the jobs, and then wait for each of them (up to its own timeout) ... so one slow feed
+        can't hold the others past their own deadlines
+    '''
+    for j in jobs:
+        j.start()
+    for j in jobs:
+        j.wait()
+    return jobs
@@ -0,0 +1,62 @@
+''' feed fingerprints ... skip the parse and write stages of the loader when a feed hasn't changed
+
+    three checks, cheapest first:
+      1. the ETag / Last-Modified of the last load are sent with the next request (see fetcher.py),
+         so the server can answer 304 Not Modified without sending the feed at all
+      2. a sha1 of the raw feed bytes (same bytes means we don't even need to parse the feed)
+      3. the feed's header timestamp (catches feeds that get re-serialized, with the same data, for every request)
+
+    fingerprints live in the feed_fingerprints table, so they survive loader restarts, along with a count
+    of the cycles skipped for each feed
+'''
+import hashlib
+import datetime
+import logging
+log = logging.getLogger(__file__)
+
+from .model import FeedFingerprint
+
+
+def digest(raw):
+    return hashlib.sha1(raw).hexdigest()
+
+
+def lookup(session, feed):
+    ''' @return: the feed's FeedFingerprint (a new, blank one if this feed has never been loaded)
+    '''
+    ret_val = session.query(FeedFingerprint).get(feed)
+    if ret_val is None:
+        ret_val = FeedFingerprint(feed=feed, skipped=0)
+        session.add(ret_val)
+    return ret_val
+
+
+def same_content(fp, raw):
+    return fp.digest is not None and fp.digest == digest(raw)
+
+
+def same_header(fp, fm):
+    ''' NOTE: the header timestamp is optional in GTFS-rt ... a missing (0) timestamp never matches
+    '''
+    ts = fm.header.timestamp
+    return ts > 0 and fp.header_timestamp == ts
+
+
+def skip(fp):
+    ''' record a skipped cycle
+        @return: total number of cycles skipped for this feed
+    '''
+    fp.skipped = (fp.skipped or 0) + 1
+    return fp.skipped
+
+
+def update(fp, raw, fm=None, etag=None, last_modified=None, content_digest=None):
+    ''' remember what the feed looked like for this load
+        @param content_digest: sha1 of the raw bytes, when they were streamed rather than held (raw is None)
+    '''
+    fp.digest = content_digest or digest(raw)
+    if fm is not None:
+        fp.header_timestamp = fm.header.timestamp
+    fp.etag = etag
+    fp.last_modified = last_modified
+    fp.updated = datetime.datetime.now()
@@ -0,0 +1,77 @@
+''' generation based snapshots of the realtime tables
+
+    every load of a feed writes its rows under a brand new generation id, and then (in the same
+    transaction) flips that feed's row in the generations table to point at it.  readers filter on
+    the current generation, so they see either the old snapshot or the new one, never a mix ... and
+    old generations are garbage collected with one set-based DELETE per table, after a grace period.
+
+    generation ids are epoch seconds (bumped if need be so they always increase), which is what
+    lets the grace period be expressed in seconds.
+
+    NOTE: on PostgreSQL, the generation column is also a natural partition key ... we don't
+          (yet) manage partitions here, so old generations are always removed via DELETE
+'''
+import time
+import datetime
+import logging
+log = logging.getLogger(__file__)
+
+from sqlalchemy import func, or_, select
+
+from .model import Generation, FeedClasses
+
+
+def current(session, feed):
+    ''' @return: the feed's current generation id (or None when the feed has never been loaded)
+    '''
+    return session.query(Generation.current).filter(Generation.feed == feed).scalar()
+
+
+def next_generation(session, feed):
+    ''' @return: a new generation id for the feed (epoch seconds ... always greater than the current id)
+    '''
+    cur = current(session, feed) or 0
+    return max(int(time.time()), cur + 1)
+
+
+def flip(session, feed, generation):
+    ''' point the feed at a new generation ... readers see it once the session commits
+    '''
+    session.merge(Generation(feed=feed, current=generation, updated=datetime.datetime.now()))
+    session.flush()
+
+
+def is_current(cls, feed):
+    ''' @return: SQL clause that filters cls (e.g., EntitySelector) down to the feed's current generation
+        NOTE: if the feed has no generation pointer yet (e.g., a database loaded before generations existed),
+              then every row passes the filter
+    '''
+    cur = select([Generation.current]).where(Generation.feed == feed).as_scalar()
+    return or_(cls.generation == cur, cur == None)
+
+
+def collect(session, feed, grace=0):
+    ''' delete the feed's old generations that were superseded more than grace seconds ago
+
+        the newest generation at least grace seconds old became current before the cutoff, so every
+        generation prior to it has been out of service for the whole grace period (rows with no
+        generation at all pre-date generations, and go too)
+
+        @return: number of rows deleted
+    '''
+    ret_val = 0
+    cur = current(session, feed)
+    if cur is not None:
+        cutoff = cur
+        if grace > 0:
+            cutoff = min(cur, int(time.time()) - grace)
+        classes = FeedClasses[feed]
+        oldest = session.execute(select([func.max(classes[0].generation)]).where(classes[0].generation <= cutoff)).scalar()
+        for cls in classes:
+            t = cls.__table__
+            where = t.c.generation == None
+            if oldest is not None:
+                where = or_(t.c.generation < oldest, where)
+            ret_val += session.execute(t.delete().where(where)).rowcount
+        log.debug("deleted {0} {1} rows older than generation {2}".format(ret_val, feed, oldest))
+    return ret_val
@@ -29,219 +29,205 @@
   
 '''
 
+import ConfigParser
 from optparse import OptionParser
-import time
-import sys
-import datetime
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
-from urllib2 import urlopen
-from . import gtfs_realtime_pb2
-from . import alerts
-from . import model
-from utils import getTrans
-from .model import *
+from .loader import RealtimeLoader, MultiLoader
 
 
-p = OptionParser()
-p.add_option('-t', '--trip-updates', dest='tripUpdates', default=None, 
-             help='The trip updates URL', metavar='URL')
+def make_parser():
+    p = OptionParser()
+    p.add_option('-t', '--trip-updates', dest='tripUpdates', default=None, 
+                 help='The trip updates URL', metavar='URL')
 
-p.add_option('-a', '--alerts', default=None, dest='alerts', 
-             help='The alerts URL', metavar='URL')
+    p.add_option('-a', '--alerts', default=None, dest='alerts', 
+                 help='The alerts URL', metavar='URL')
 
-p.add_option('-p', '--vehicle-positions', dest='vehiclePositions', default=None, 
-             help='The vehicle positions URL', metavar='URL')
+    p.add_option('-p', '--vehicle-positions', dest='vehiclePositions', default=None, 
+                 help='The vehicle positions URL', metavar='URL')
 
-p.add_option('-d', '--database', default=None, dest='dsn',
-             help='Database connection string', metavar='DSN')
+    p.add_option('-d', '--database', default=None, dest='dsn',
+                 help='Database connection string', metavar='DSN')
 
-p.add_option('-o', '--discard-old', default=False, dest='deleteOld', 
-             action='store_true', 
-             help='Discard old updates, so the database is always current')
+    p.add_option('-o', '--discard-old', default=False, dest='deleteOld', 
+                 action='store_true', 
+                 help='Discard old updates, so the database is always current')
 
-p.add_option('-c', '--create-tables', default=False, dest='create',
-             action='store_true', help="Create tables if they aren't found")
+    p.add_option('-g', '--grace', default=120, type='int', metavar='SECS', dest='grace',
+                 help='With -o, keep superseded generations around this long for readers still using them (in seconds)')
 
-p.add_option('-w', '--wait', default=30, type='int', metavar='SECS',
-             dest='timeout', help='Time to wait between requests (in seconds)')
+    p.add_option('-c', '--create-tables', default=False, dest='create',
+                 action='store_true', help="Create tables if they aren't found")
 
-p.add_option('-v', '--verbose', default=False, dest='verbose', 
-             action='store_true', help='Print generated SQL')
+    p.add_option('-w', '--wait', default=30, type='int', metavar='SECS',
+                 dest='timeout', help='Time to wait between requests (in seconds)')
 
-p.add_option('-l', '--language', default='en', dest='lang', metavar='LANG',
-             help='When multiple translations are available, prefer this language')
+    p.add_option('--trip-updates-wait', default=None, type='int', metavar='SECS', dest='tripUpdatesWait',
+                 help='Polling interval for the trip updates feed (in seconds) ... defaults to --wait')
 
-p.add_option('-s', '--schema',   default=None, dest='schema', help='Database schema')
+    p.add_option('--alerts-wait', default=None, type='int', metavar='SECS', dest='alertsWait',
+                 help='Polling interval for the alerts feed (in seconds) ... defaults to --wait')
 
-p.add_option('-1', '--once',  default=False, dest='once', action='store_true', help='only run the loader one time')
+    p.add_option('--vehicle-positions-wait', default=None, type='int', metavar='SECS', dest='vehiclePositionsWait',
+                 help='Polling interval for the vehicle positions feed (in seconds) ... defaults to --wait')
 
-opts, args = p.parse_args()
+    p.add_option('--adaptive', default=False, dest='adaptive', action='store_true',
+                 help="Learn each feed's publish interval from its header timestamps, and time polls to land just after each publish")
 
+    p.add_option('--min-wait', default=5, type='int', metavar='SECS', dest='minWait',
+                 help='With --adaptive, the shortest time between polls of a feed (in seconds)')
 
-if opts.dsn == None:
-    print 'No database specified!'
-    exit(1)
+    p.add_option('--max-wait', default=300, type='int', metavar='SECS', dest='maxWait',
+                 help='With --adaptive, the longest time between polls of a feed (in seconds)')
 
-if opts.alerts == None and opts.tripUpdates == None and opts.vehiclePositions == None:
-    print 'No trip updates, alerts, or vehicle positions URLs were specified!'
-    exit(1)
+    p.add_option('--fetch-timeout', default=20, type='int', metavar='SECS', dest='fetch_timeout',
+                 help='How long each feed gets to be fetched and decoded, before it is skipped for the cycle (in seconds)')
 
-if opts.alerts == None:
-    print 'Warning: no alert URL specified, proceeding without alerts'
+    p.add_option('-v', '--verbose', default=False, dest='verbose', 
+                 action='store_true', help='Print generated SQL')
 
-if opts.tripUpdates == None:
-    print 'Warning: no trip update URL specified, proceeding without trip updates'
+    p.add_option('-l', '--language', default='en', dest='lang', metavar='LANG',
+                 help='When multiple translations are available, prefer this language')
 
-if opts.vehiclePositions == None:
-    print 'Warning: no vehicle positions URL specified, proceeding without vehicle positions'
+    p.add_option('-s', '--schema',   default=None, dest='schema', help='Database schema')
 
+    p.add_option('-1', '--once',  default=False, dest='once', action='store_true', help='only run the loader one time')
 
-# add DB schema definitions the table class meta data...
-if opts.schema:
-    model.add_schema(opts.schema)
+    p.add_option('--diff', default=False, dest='diff', action='store_true',
+                 help='Only write the trip updates and vehicle positions that were added, changed or removed since the last load')
 
+    p.add_option('--always-load', default=False, dest='always', action='store_true',
+                 help="Load every feed on every cycle, even when its fingerprint says it hasn't changed")
 
-# Connect to the database (and implicitly handle any non-default schema)
-engine = create_engine(opts.dsn, echo=opts.verbose)
+    p.add_option('--orm', default=False, dest='orm', action='store_true',
+                 help='Write rows one ORM object at a time (the old, slow path) rather than via bulk inserts')
+
+    p.add_option('--stream', default=False, dest='stream', action='store_true',
+                 help='Read each feed an entity at a time, and write it in batches, rather than holding the whole feed in memory')
+
+    p.add_option('--metrics-file', default=None, dest='metricsFile', metavar='FILE',
+                 help='After each cycle, write the loader metrics (Prometheus text format) to this file')
+
+    p.add_option('--metrics-json', default=None, dest='metricsJson', metavar='FILE',
+                 help='After each cycle, append a JSON summary of the cycle (one line per cycle) to this file')
+
+    p.add_option('--metrics-port', default=None, type='int', dest='metricsPort', metavar='PORT',
+                 help='Serve the loader metrics at http://<host>:PORT/metrics (and the last cycle at /metrics.json)')
+
+    p.add_option('--memory-every', default=0, type='int', dest='memoryEvery', metavar='NUM',
+                 help='Every NUM cycles, print the places memory has grown the most since the last report (uses tracemalloc, when available)')
+
+    p.add_option('--pipeline', default=False, dest='pipeline', action='store_true',
+                 help='Fetch, decode and write on separate threads (connected by bounded queues), so they all overlap')
+
+    p.add_option('--decode-processes', default=0, type='int', dest='decodeProcesses', metavar='NUM',
+                 help='With --pipeline, decode the feeds in a pool of NUM processes (default=0, decode on a thread)')
+
+    p.add_option('--queue-size', default=2, type='int', dest='queueSize', metavar='NUM',
+                 help='With --pipeline, how many feeds can wait between stages before the stage ahead blocks (default=2)')
+
+    p.add_option('--record', default=None, dest='record', metavar='DIR',
+                 help='Record the raw payload of every feed fetched into this archive directory (see replay.py)')
+
+    p.add_option('--replay', default=None, dest='replay', metavar='DIR',
+                 help='Replay the payloads recorded in this archive directory through the loader, then report the throughput')
+
+    p.add_option('--replay-speed', default=0, type='float', dest='replaySpeed', metavar='SPEED',
+                 help='With --replay, 1 replays at the speed the payloads were recorded, 2 twice as fast, etc. (default=0, as fast as possible)')
+
+    p.add_option('--config', default=None, dest='config', metavar='FILE',
+                 help='Load the feeds of each agency in this config file (see read_config()), all in this one process')
+    return p
+
+
+def read_config(p, path):
+    ''' read a multi-agency config file ... the [loader] section holds the settings shared by every agency, and
+        every other section is an agency (named for the section), with its own schema, feed urls, intervals, etc.:
+
+            [loader]
+            database = postgresql://localhost/rt
+            discard-old = true
+
+            [trimet]
+            schema = trimet
+            trip-updates = http://developer.trimet.org/ws/V1/TripUpdate/appID/...
+            trip-updates-wait = 15
+            alerts = http://developer.trimet.org/ws/V1/FeedSpecAlerts/appID/...
+            alerts-wait = 120
+
+        the keys are the long command line options (without the --)
+        @return: (shared settings, [(agency, settings), ...])
+    '''
+    cp = ConfigParser.RawConfigParser()
+    if not cp.read(path):
+        raise ValueError("Can't read the config file {0}!".format(path))
+
+    options = dict((o.get_opt_string()[2:], o) for o in p.option_list if o.dest and o.dest != 'config')
+
+    def section(name):
+        ret_val = {}
+        for key, value in cp.items(name):
+            o = options.get(key)
+            if o is None:
+                raise ValueError('Unknown setting {0} in the [{1}] section of {2}!'.format(key, name, path))
+            if o.action == 'store_true':
+                value = cp.getboolean(name, key)
+            elif o.type == 'int':
+                value = int(value)
+            elif o.type == 'float':
+                value = float(value)
+            ret_val[o.dest] = value
+        return ret_val
+
+    shared = section('loader') if cp.has_section('loader') else {}
+    agencies = [(name, section(name)) for name in cp.sections() if name != 'loader']
+    return shared, agencies
+
+
+def make_loader(p, opts):
+    ''' @return: a RealtimeLoader for the command line ... or with --config, a MultiLoader for the agencies in the
+                 config file (where the command line options that were given override its [loader] section)
+    '''
+    settings = dict(vars(opts))
+    path = settings.pop('config')
+    if path is None:
+        return RealtimeLoader(**settings)
+
+    defaults = vars(p.get_default_values())
+    shared, agencies = read_config(p, path)
+    defaults.pop('config')
+    defaults.update(shared)
+    defaults.update((k, v) for k, v in settings.items() if v != p.defaults[k])
+    return MultiLoader(agencies, **defaults)
 
-# sessionmaker returns a class
-session = sessionmaker(bind=engine)()
 
 def main():
-    # Check if it has the tables
-    # Base from model.py
-    for table in Base.metadata.tables.keys():
-        if not engine.has_table(table, opts.schema):
-            if opts.create:
-                print 'Creating table %s' % table
-                Base.metadata.tables[table].create(engine)
-            else:
-                print 'Missing table %s! Use -c to create it.' % table
-                exit(1)
+    p = make_parser()
+    opts, args = p.parse_args()
 
     try:
-        keep_running = True
-        while keep_running:
-            success = True
-            try:
-            #if True:
-                if opts.deleteOld:
-                    # Go through all of the tables that we create, clear them
-                    # Don't mess with other tables (i.e., tables from static GTFS)
-                    for theClass in AllClasses:
-                        for obj in session.query(theClass):
-                            session.delete(obj)
-
-                if opts.tripUpdates:
-                    fm = gtfs_realtime_pb2.FeedMessage()
-                    fm.ParseFromString(
-                        urlopen(opts.tripUpdates).read()
-                        )
-
-                    # Convert this a Python object, and save it to be placed into each
-                    # trip_update
-                    timestamp = datetime.datetime.utcfromtimestamp(fm.header.timestamp)
-
-                    # Check the feed version
-                    if fm.header.gtfs_realtime_version != u'1.0':
-                        print 'Warning: feed version has changed: found %s, expected 1.0' % fm.header.gtfs_realtime_version
-
-                    print 'Adding %s trip updates' % len(fm.entity)
-                    for entity in fm.entity:
-                        tu = entity.trip_update
-                        dbtu = TripUpdate(
-                            trip_id = tu.trip.trip_id,
-                            route_id = tu.trip.route_id,
-                            trip_start_time = tu.trip.start_time,
-                            trip_start_date = tu.trip.start_date,
-
-                            # get the schedule relationship
-                            # This is somewhat undocumented, but by referencing the
-                            # DESCRIPTOR.enum_types_by_name, you get a dict of enum types
-                            # as described at http://code.google.com/apis/protocolbuffers/docs/reference/python/google.protobuf.descriptor.EnumDescriptor-class.html
-                            schedule_relationship = tu.trip.DESCRIPTOR.enum_types_by_name['ScheduleRelationship'].values_by_number[tu.trip.schedule_relationship].name,
-
-                            vehicle_id = tu.vehicle.id,
-                            vehicle_label = tu.vehicle.label,
-                            vehicle_license_plate = tu.vehicle.license_plate,
-                            timestamp = timestamp)
-
-                        for stu in tu.stop_time_update:
-                            dbstu = StopTimeUpdate(
-                                stop_sequence = stu.stop_sequence,
-                                stop_id = stu.stop_id,
-                                arrival_delay = stu.arrival.delay,
-                                arrival_time = stu.arrival.time,
-                                arrival_uncertainty = stu.arrival.uncertainty,
-                                departure_delay = stu.departure.delay,
-                                departure_time = stu.departure.time,
-                                departure_uncertainty = stu.departure.uncertainty,
-                                schedule_relationship = tu.trip.DESCRIPTOR.enum_types_by_name['ScheduleRelationship'].values_by_number[tu.trip.schedule_relationship].name
-                            )
-                            session.add(dbstu)
-                            dbtu.StopTimeUpdates.append(dbstu)
-
-                        session.add(dbtu)
-
-                if opts.alerts:
-                    alerts.make_alert(session, gtfs_realtime_pb2, opts)
-
-                if opts.vehiclePositions:
-                    fm = gtfs_realtime_pb2.FeedMessage()
-                    fm.ParseFromString(
-                        urlopen(opts.vehiclePositions).read()
-                        )
-
-                    # Convert this a Python object, and save it to be placed into each
-                    # vehicle_position
-                    timestamp = datetime.datetime.utcfromtimestamp(fm.header.timestamp)
-
-                    # Check the feed version
-                    if fm.header.gtfs_realtime_version != u'1.0':
-                        print 'Warning: feed version has changed: found %s, expected 1.0' % fm.header.gtfs_realtime_version
-
-                    print 'Adding %s vehicle_positions' % len(fm.entity)
-                    for entity in fm.entity:
-                        vp = entity.vehicle
-                        dbvp = VehiclePosition(
-                            trip_id = vp.trip.trip_id,
-                            route_id = vp.trip.route_id,
-                            trip_start_time = vp.trip.start_time,
-                            trip_start_date = vp.trip.start_date,
-                            vehicle_id = vp.vehicle.id,
-                            vehicle_label = vp.vehicle.label,
-                            vehicle_license_plate = vp.vehicle.license_plate,
-                            position_latitude = vp.position.latitude,
-                            position_longitude = vp.position.longitude,
-                            position_bearing = vp.position.bearing,
-                            position_speed = vp.position.speed,
-                            timestamp = timestamp)
-
-                        session.add(dbvp)
-
-                # This does deletes and adds, since it's atomic it never leaves us
-                # without data
-                session.commit()
-            except:
-            #else:
-                print 'Exception occurred in iteration'
-                print sys.exc_info()
-                success = False
-
-            # put this outside the try...except so it won't be skipped when something 
-            # fails
-            # also, makes it easier to end the process with ctrl-c, b/c a 
-            # KeyboardInterrupt here will end the program (cleanly)
-            if opts.once and success:
-                print "Executed the load ONCE ... going to stop now..."
-                keep_running = False
-            else:
-                time.sleep(opts.timeout)
-    finally:
-        print "Closing session . . ."
-        session.close()
+        loader = make_loader(p, opts)
+    except ValueError, e:
+        print e
+        exit(1)
+
+    if opts.config:
+        for agency in loader.loaders:
+            print 'Loading the %s feeds of %s' % (', '.join(f for f, url in agency.feeds), agency.name)
+    else:
+        if opts.alerts == None:
+            print 'Warning: no alert URL specified, proceeding without alerts'
+
+        if opts.tripUpdates == None:
+            print 'Warning: no trip update URL specified, proceeding without trip updates'
+
+        if opts.vehiclePositions == None:
+            print 'Warning: no vehicle positions URL specified, proceeding without vehicle positions'
+
+    try:
+        loader.run()
+    except ValueError, e:
+        print e
+        exit(1)
 
 if __name__ == "__main__":
     main()
-
@@ -0,0 +1,1018 @@
+''' RealtimeLoader: the GTFS-realtime loader, as a class that can be embedded in another process
+
+    the loader takes its settings as keyword arguments (the same names as the load_rt options ... see
+    gtfsrdb.py and DEFAULTS below), and can be handed an engine (and so, its connection pool) that's
+    already set up, e.g. in a web app or a test:
+
+        loader = RealtimeLoader(engine, tripUpdates='http://...', vehiclePositions='http://...', deleteOld=True)
+        loader.setup()
+        loader.run_once()       # one cycle of every feed
+        loader.run_forever()    # poll the feeds on their schedule, until loader.stop() is called
+        loader.close()
+
+    nothing happens at import time ... the session, fetchers, metrics, etc. all belong to the loader
+'''
+import time
+import datetime
+import traceback
+import threading
+from Queue import Queue
+from contextlib import contextmanager
+from optparse import Values
+from sqlalchemy import create_engine, inspect
+from sqlalchemy.orm import sessionmaker
+import logging
+log = logging.getLogger(__file__)
+
+from . import gtfs_realtime_pb2
+from . import alerts
+from . import bulk
+from . import decoder
+from . import diff
+from . import fetcher
+from . import fingerprint
+from . import generations
+from . import memory
+from . import pipeline
+from . import query
+from . import replay
+from . import scheduler
+from . import stream
+from . import summary
+from .metrics import Metrics
+from . import model
+from .model import *
+
+# feed name, and the setting that holds its url & polling interval
+FEEDS = (
+    ('trip_updates', 'tripUpdates', 'tripUpdatesWait'),
+    ('alerts', 'alerts', 'alertsWait'),
+    ('vehicle_positions', 'vehiclePositions', 'vehiclePositionsWait'),
+)
+
+# the settings that belong to the whole process, rather than to one agency, when a MultiLoader runs many agencies
+SHARED = ('dsn', 'verbose', 'once', 'metricsFile', 'metricsJson', 'metricsPort', 'memoryEvery',
+          'pipeline', 'decodeProcesses', 'queueSize', 'replay', 'replaySpeed')
+
+# the loader's settings (named for the load_rt options ... see gtfsrdb.py for what each does)
+DEFAULTS = dict(
+    tripUpdates=None, alerts=None, vehiclePositions=None,
+    dsn=None, schema=None, create=False, verbose=False, lang='en',
+    deleteOld=False, grace=120,
+    timeout=30, tripUpdatesWait=None, alertsWait=None, vehiclePositionsWait=None,
+    adaptive=False, minWait=5, maxWait=300, fetch_timeout=20,
+    once=False, diff=False, always=False, orm=False, stream=False,
+    metricsFile=None, metricsJson=None, metricsPort=None, memoryEvery=0,
+    pipeline=False, decodeProcesses=0, queueSize=2,
+    record=None, replay=None, replaySpeed=0,
+)
+
+
+def parse_feed(raw):
+    ''' parse the raw bytes of a GTFS-realtime FeedMessage
+    '''
+    fm = gtfs_realtime_pb2.FeedMessage()
+    fm.ParseFromString(raw)
+
+    # Check the feed version
+    if fm.header.gtfs_realtime_version != u'1.0':
+        print 'Warning: feed version has changed: found %s, expected 1.0' % fm.header.gtfs_realtime_version
+
+    return fm
+
+
+def open_stream(f):
+    ''' start reading a GTFS-realtime FeedMessage off the wire ... just up to (and including) its header
+        @return: stream.FeedStream
+    '''
+    fs = stream.FeedStream(f)
+    version = fs.read_header().gtfs_realtime_version
+    if version != u'1.0':
+        print 'Warning: feed version has changed: found %s, expected 1.0' % version
+    return fs
+
+
+def add_trip_updates(session, fm, generation=None):
+    ''' ORM version of bulk.write_trip_updates() ... one TripUpdate / StopTimeUpdate object per row
+    '''
+    # Convert this a Python object, and save it to be placed into each
+    # trip_update
+    timestamp = datetime.datetime.utcfromtimestamp(fm.header.timestamp)
+
+    for entity in fm.entity:
+        tu = entity.trip_update
+        sr = decoder.SCHEDULE_RELATIONSHIP[tu.trip.schedule_relationship]
+        dbtu = TripUpdate(
+            generation = generation,
+            trip_id = tu.trip.trip_id,
+            route_id = tu.trip.route_id,
+            trip_start_time = tu.trip.start_time,
+            trip_start_date = tu.trip.start_date,
+
+            # get the schedule relationship name (from the table decoder.py builds from the protobuf descriptor)
+            schedule_relationship = sr,
+
+            vehicle_id = tu.vehicle.id,
+            vehicle_label = tu.vehicle.label,
+            vehicle_license_plate = tu.vehicle.license_plate,
+            timestamp = timestamp)
+
+        for stu in tu.stop_time_update:
+            dbstu = StopTimeUpdate(
+                generation = generation,
+                stop_sequence = stu.stop_sequence,
+                stop_id = stu.stop_id,
+                arrival_delay = stu.arrival.delay,
+                arrival_time = stu.arrival.time,
+                arrival_uncertainty = stu.arrival.uncertainty,
+                departure_delay = stu.departure.delay,
+                departure_time = stu.departure.time,
+                departure_uncertainty = stu.departure.uncertainty,
+                schedule_relationship = sr
+            )
+            session.add(dbstu)
+            dbtu.StopTimeUpdates.append(dbstu)
+
+        session.add(dbtu)
+
+
+def add_vehicle_positions(session, fm, generation=None):
+    ''' ORM version of bulk.write_vehicle_positions() ... one VehiclePosition object per row
+    '''
+    # Convert this a Python object, and save it to be placed into each
+    # vehicle_position
+    timestamp = datetime.datetime.utcfromtimestamp(fm.header.timestamp)
+
+    for entity in fm.entity:
+        vp = entity.vehicle
+        dbvp = VehiclePosition(
+            generation = generation,
+            trip_id = vp.trip.trip_id,
+            route_id = vp.trip.route_id,
+            trip_start_time = vp.trip.start_time,
+            trip_start_date = vp.trip.start_date,
+            vehicle_id = vp.vehicle.id,
+            vehicle_label = vp.vehicle.label,
+            vehicle_license_plate = vp.vehicle.license_plate,
+            position_latitude = vp.position.latitude,
+            position_longitude = vp.position.longitude,
+            position_bearing = vp.position.bearing,
+            position_speed = vp.position.speed,
+            timestamp = timestamp)
+
+        session.add(dbvp)
+
+
+def export_metrics(metrics, opts, watch=None):
+    ''' close out the cycle's metrics, and write them to the --metrics-file / --metrics-json files ... and with
+        --memory-every, print where memory has grown (see memory.py)
+    '''
+    metrics.end_cycle()
+    try:
+        if opts.metricsFile:
+            metrics.write(opts.metricsFile)
+        if opts.metricsJson:
+            metrics.append_json(opts.metricsJson)
+    except IOError, e:
+        print 'Error writing metrics: %s' % e
+    if watch:
+        report = watch.cycle()
+        if report:
+            print report
+
+
+def check_settings(opts):
+    ''' @raise ValueError: when the settings can't work together
+    '''
+    if opts.dsn is None:
+        raise ValueError('No database specified!')
+
+    if opts.alerts is None and opts.tripUpdates is None and opts.vehiclePositions is None and opts.replay is None:
+        raise ValueError('No trip updates, alerts, or vehicle positions URLs were specified!')
+
+    if opts.stream and (opts.diff or opts.orm):
+        raise ValueError('The --stream option can not be combined with --diff or --orm!')
+
+    if opts.pipeline and (opts.stream or opts.orm):
+        raise ValueError('The --pipeline option can not be combined with --stream or --orm!')
+
+    if opts.stream and opts.record:
+        raise ValueError('The --stream option can not be combined with --record!')
+
+
+class RealtimeLoader(object):
+    ''' loads GTFS-realtime feeds into the model.py tables
+
+        @param engine: (optional) SQLAlchemy engine to load into ... default is a new one, made from the dsn setting
+        @param name: (optional) name of the loader (e.g., the agency), when it shares its scheduler with others
+        @param sched: (optional) scheduler.Scheduler to poll the feeds on ... default is the loader's own
+        @param metrics: (optional) Metrics (or Metrics.scope()) to record into ... default is the loader's own
+        @param settings: see DEFAULTS (e.g., tripUpdates='http://...', deleteOld=True)
+        @raise ValueError: when the settings can't work together
+    '''
+    def __init__(self, engine=None, name=None, sched=None, metrics=None, **settings):
+        unknown = set(settings) - set(DEFAULTS)
+        if unknown:
+            raise ValueError('Unknown loader settings: {0}'.format(', '.join(sorted(unknown))))
+        opts = dict(DEFAULTS)
+        opts.update(settings)
+        if engine is not None and opts['dsn'] is None:
+            opts['dsn'] = str(engine.url)
+        self.opts = opts = Values(opts)
+        self.name = name
+        check_settings(opts)
+
+        # Connect to the database ... unless we've been handed an engine
+        self.own_engine = engine is None
+        if engine is None:
+            engine = create_engine(opts.dsn, echo=opts.verbose)
+
+        # a non-default schema is handled by the engine's schema translation (rather than model.add_schema()),
+        # so loaders writing to different schemas can share one engine (and its connection pool)
+        if opts.schema:
+            engine = engine.execution_options(schema_translate_map={None: opts.schema})
+        self.engine = engine
+
+        # each cycle gets a session of its own (see session_scope()), so the ORM objects a load adds don't pile up
+        self.Session = sessionmaker(bind=self.engine)
+
+        # one (kept-alive) fetcher per feed, and the last fetch job started for each feed
+        self.fetchers = {}
+        self.jobs_in_flight = {}
+
+        # timings & counters for each feed and phase of the load (see metrics.py)
+        self.metrics = metrics if metrics is not None else Metrics()
+
+        # the alerts' route short names come from the static GTFS routes ... read once per alerts feed, rather than
+        # once per alert (see refresh_route_names())
+        self.route_names = alerts.RouteNames(self.engine)
+
+        # with --memory-every, memory growth is reported every N cycles
+        self.memory = None
+        if opts.memoryEvery:
+            self.memory = memory.MemoryWatch(opts.memoryEvery)
+
+        # with --record, every payload fetched is archived
+        self.recorder = None
+        if opts.record:
+            self.recorder = replay.Recorder(opts.record)
+
+        # with --diff, trip updates and vehicle positions are written incrementally
+        self.differs = {}
+        if opts.diff:
+            self.differs['trip_updates'] = diff.TripUpdateDiff()
+            self.differs['vehicle_positions'] = diff.VehiclePositionDiff()
+
+        # each feed gets polled on its own (wall-clock anchored, or with --adaptive, learned) schedule ... and
+        # stop() cuts short the wait for the next poll
+        self.stopping = threading.Event()
+        self.sched = sched if sched is not None else scheduler.Scheduler(sleep=self.stopping.wait)
+        self.feeds = []
+        for feed, url, wait in FEEDS:
+            if getattr(opts, url):
+                self.feeds.append((feed, getattr(opts, url)))
+                self.sched.add(self.key(feed), getattr(opts, wait) or opts.timeout, self.make_cadence())
+
+    def key(self, feed):
+        ''' @return: the feed's name in the scheduler (and in messages) ... qualified by the loader's name, if it
+                     has one (e.g., 'trimet/trip_updates'), since a scheduler may be shared by several loaders
+        '''
+        if self.name:
+            return '{0}/{1}'.format(self.name, feed)
+        return feed
+
+    def setup(self):
+        ''' check the database has the tables (from model.py), and with the create setting, create the missing ones ...
+            and add the columns that tables from older versions of the loader don't have (e.g., generation)
+            @raise ValueError: when a table (or column) is missing
+        '''
+        created = False
+        for table in Base.metadata.tables.keys():
+            if not self.engine.has_table(table, self.opts.schema):
+                if self.opts.create:
+                    print 'Creating table %s' % table
+                    Base.metadata.tables[table].create(self.engine)
+                    created = True
+                else:
+                    raise ValueError('Missing table %s! Use -c to create it.' % table)
+            elif self.migrate_table(Base.metadata.tables[table]):
+                created = True
+        if created:
+            # readers in this process (see query.py) shouldn't wait out the ttl to see the new tables
+            query.capabilities.invalidate()
+
+    def migrate_table(self, table):
+        ''' with the create setting, ALTER the (existing) table to add the columns it's missing, and create the
+            indexes it's missing (e.g., ones added to the model on existing columns)
+            @return: True if columns or indexes were added
+            @raise ValueError: when a column is missing
+        '''
+        inspector = inspect(self.engine)
+        have = set(c['name'] for c in inspector.get_columns(table.name, self.opts.schema))
+        missing = [c for c in table.columns if c.name not in have]
+        if missing and not self.opts.create:
+            raise ValueError('Missing column %s.%s! Use -c to add it.' % (table.name, missing[0].name))
+
+        have = set(i['name'] for i in inspector.get_indexes(table.name, self.opts.schema))
+        indexes = [i for i in table.indexes if i.name not in have]
+        if indexes and not self.opts.create:
+            log.warn('Missing indexes on %s (%s) ... use -c to create them' % (table.name, ', '.join(i.name for i in indexes)))
+            indexes = []
+        if not missing and not indexes:
+            return False
+
+        prep = self.engine.dialect.identifier_preparer
+        name = prep.quote(table.name)
+        if self.opts.schema:
+            name = '%s.%s' % (prep.quote_schema(self.opts.schema), name)
+        for c in missing:
+            print 'Adding column %s.%s' % (table.name, c.name)
+            self.engine.execute('ALTER TABLE %s ADD COLUMN %s %s' % (name, prep.quote(c.name), c.type.compile(self.engine.dialect)))
+        for index in indexes:
+            print 'Creating index %s' % index.name
+            index.create(self.engine)
+        return True
+
+    def publish(self, session, feed, generation):
+        ''' flip the feed over to its newly written generation ... and with -o, garbage collect
+            the old generations (one set-based DELETE per table) once they're past the grace period
+        '''
+        generations.flip(session, feed, generation)
+        if self.opts.deleteOld:
+            generations.collect(session, feed, self.opts.grace)
+
+    def write_feed(self, session, feed, fm, generation, batches=None):
+        ''' write the feed's rows (bulk inserts, or one ORM object at a time with --orm)
+            @param batches: (optional) the feed's column batches, if it's already been run through decoder.decode()
+            @return: number of rows written (None with --orm)
+        '''
+        opts = self.opts
+        metrics = self.metrics
+        ret_val = None
+        if feed == 'trip_updates':
+            print 'Adding %s trip updates' % (len(batches.trip_updates) if batches else len(fm.entity))
+        elif feed == 'vehicle_positions':
+            print 'Adding %s vehicle_positions' % (len(batches.vehicle_positions) if batches else len(fm.entity))
+
+        if opts.orm:
+            with metrics.timer(feed, 'write'):
+                if feed == 'trip_updates':
+                    add_trip_updates(session, fm, generation)
+                elif feed == 'alerts':
+                    alerts.add_alerts(session, fm, opts, generation, self.route_names.short_names)
+                elif feed == 'vehicle_positions':
+                    add_vehicle_positions(session, fm, generation)
+            return ret_val
+
+        if batches is None:
+            with metrics.timer(feed, 'transform'):
+                batches = decoder.decode(fm, opts.lang)
+        with metrics.timer(feed, 'write'):
+            if feed == 'trip_updates':
+                ret_val = bulk.write_trip_updates(session, fm, generation, batches)
+            elif feed == 'alerts':
+                ret_val = alerts.load_alerts(session, fm, opts, generation, batches, self.route_names.short_names)
+            elif feed == 'vehicle_positions':
+                ret_val = bulk.write_vehicle_positions(session, fm, generation, batches)
+        return ret_val
+
+    def get_fetcher(self, feed, url):
+        if feed not in self.fetchers:
+            self.fetchers[feed] = fetcher.FeedFetcher(url, self.opts.fetch_timeout)
+        return self.fetchers[feed]
+
+    def make_job(self, feed, url, fp):
+        ''' set up the (threaded) fetch & decode of a feed ... the job is handed the validators and digest of
+            the last load, so it can make a conditional request, and skip decoding bytes we've already seen
+        '''
+        opts = self.opts
+        etag = last_modified = unchanged = None
+        if not opts.always:
+            etag = fp.etag
+            last_modified = fp.last_modified
+            digest = fp.digest
+            unchanged = lambda raw: digest is not None and fingerprint.digest(raw) == digest
+        f = self.get_fetcher(feed, url)
+        if opts.stream:
+            return fetcher.FeedJob(feed, f, open_stream, etag, last_modified, None, opts.fetch_timeout, True)
+        return fetcher.FeedJob(feed, f, parse_feed, etag, last_modified, unchanged, opts.fetch_timeout)
+
+    def store_feed(self, session, job, fp):
+        ''' unless its fingerprint shows the (fetched & decoded) feed hasn't changed since the last load,
+            write it out as the feed's new generation
+            @return: True if new data was written
+        '''
+        feed = job.feed
+        resp = job.resp
+
+        # step 1: conditional GET ... server says nothing has changed since the last load (304)
+        if resp.not_modified:
+            print 'Skipping unchanged %s feed (not modified, %s cycles skipped)' % (self.key(feed), fingerprint.skip(fp))
+            return False
+
+        if self.opts.stream:
+            return self.store_stream(session, job, fp)
+
+        # step 2: same bytes as last time ... the job didn't even bother parsing
+        if job.same_content:
+            print 'Skipping unchanged %s feed (same content, %s cycles skipped)' % (self.key(feed), fingerprint.skip(fp))
+            fingerprint.update(fp, resp.raw, None, resp.etag, resp.last_modified)
+            return False
+
+        # step 3: different bytes, but the same header timestamp ... don't bother writing
+        fm = job.fm
+        if not self.opts.always and fingerprint.same_header(fp, fm):
+            print 'Skipping unchanged %s feed (same timestamp, %s cycles skipped)' % (self.key(feed), fingerprint.skip(fp))
+            fingerprint.update(fp, resp.raw, fm, resp.etag, resp.last_modified)
+            return False
+
+        # step 4: new data ... either write just the changes into the current generation (--diff), or write a new generation
+        entities = job.batches.entities if job.batches else len(fm.entity)
+        batches = job.batches
+        if feed == 'trip_updates' and batches is None:
+            # the delay summaries are worked out from the batches (even with --orm)
+            with self.metrics.timer(feed, 'transform'):
+                batches = decoder.decode(fm, self.opts.lang)
+        if feed in self.differs:
+            gen = generations.current(session, feed) or generations.next_generation(session, feed)
+            with self.metrics.timer(feed, 'write'):
+                counts = self.differs[feed].write_feed(session, fm, gen, batches)
+            rows = counts['inserted'] + counts['updated']
+            print 'Diffed %s %s: %s inserted, %s updated, %s deleted, %s unchanged' % \
+                  (entities, feed, counts['inserted'], counts['updated'], counts['deleted'], counts['unchanged'])
+        else:
+            gen = generations.next_generation(session, feed)
+            rows = self.write_feed(session, feed, fm, gen, batches)
+        if feed == 'trip_updates':
+            with self.metrics.timer(feed, 'summarize'):
+                summary.DelaySummary().add(batches).write(session, gen, bulk.feed_timestamp(batches))
+        self.publish(session, feed, gen)
+        fingerprint.update(fp, resp.raw, fm, resp.etag, resp.last_modified)
+        self.record_load(feed, entities, rows, fm.header.timestamp)
+        return True
+
+    def record_load(self, feed, entities, rows, timestamp):
+        ''' metrics for a feed that was written ... rows is None when it's not known (--orm)
+        '''
+        metrics = self.metrics
+        metrics.set('gtfsrdb_entities', entities, feed=feed)
+        metrics.inc('gtfsrdb_entities_total', entities, feed=feed)
+        metrics.feed_stat(feed, 'entities', entities)
+        if rows is not None:
+            metrics.inc('gtfsrdb_rows_written_total', rows, feed=feed)
+            metrics.feed_stat(feed, 'rows', rows)
+        if timestamp:
+            lag = time.time() - timestamp
+            metrics.set('gtfsrdb_lag_seconds', lag, feed=feed)
+            metrics.feed_stat(feed, 'lag_seconds', round(lag, 3))
+
+    def store_stream(self, session, job, fp):
+        ''' store_feed() for --stream ... the job has only read up to the feed's header, so the rest of the feed
+            is written (as a new generation) a batch of entities at a time, as it's read
+
+            NOTE: the sha1 of the feed's bytes isn't known until it's been read (and written), so only the
+                  header timestamp can be used to skip an unchanged feed
+        '''
+        opts = self.opts
+        feed = job.feed
+        resp = job.resp
+        fs = job.fm
+
+        if not opts.always and fingerprint.same_header(fp, fs):
+            print 'Skipping unchanged %s feed (same timestamp, %s cycles skipped)' % (self.key(feed), fingerprint.skip(fp))
+            fs.drain()
+            fingerprint.update(fp, None, fs, resp.etag, resp.last_modified, resp.stream.hexdigest())
+            return False
+
+        gen = generations.next_generation(session, feed)
+        short_names = delays = None
+        if feed == 'alerts':
+            short_names = self.route_names.short_names
+        elif feed == 'trip_updates':
+            delays = summary.DelaySummary()
+        try:
+            with self.metrics.timer(feed, 'write'):
+                rows = bulk.write_stream(session, feed, fs, gen, opts.lang, short_names, delays=delays)
+        except:
+            # the rest of the feed is still sitting on the kept-alive connection ... so drop it
+            self.fetchers[feed].close()
+            raise
+        print 'Added %s %s (%s rows, streamed)' % (fs.entities, feed, rows)
+        if delays is not None:
+            with self.metrics.timer(feed, 'summarize'):
+                delays.write(session, gen, datetime.datetime.utcfromtimestamp(fs.header.timestamp))
+        self.publish(session, feed, gen)
+        fingerprint.update(fp, None, fs, resp.etag, resp.last_modified, resp.stream.hexdigest())
+        self.record_load(feed, fs.entities, rows, fs.header.timestamp)
+        return True
+
+    def load_feeds(self, session, feeds, sched=None):
+        ''' fetch & decode all the feeds at the same time (each on its own thread, with its own timeout), and then
+            write the ones that came back ... a feed that fails (or times out) is skipped for this cycle
+            @param feeds: list of (feed, url) pairs
+            @param sched: (optional) Scheduler that gets told what each fetch turned up (for adaptive polling)
+            @return: True if every feed was fetched
+        '''
+        ret_val = True
+
+        # step 1: start a job for each feed ... unless that feed's last job is somehow still running
+        jobs = []
+        for feed, url in feeds:
+            job = self.start_job(session, feed, url)
+            if job is None:
+                ret_val = False
+                continue
+            jobs.append(job)
+
+        # step 2: fetch & decode
+        fetcher.run_jobs([j for j, fp, b in jobs])
+
+        # step 3: write the results
+        for job, fp, bytes_before in jobs:
+            ret_val = self.handle_job(session, job, fp, sched) and ret_val
+
+            # NOTE: in --stream mode, most of the feed is received while it's being written
+            if not job.running:
+                self.record_bytes(job.feed, job.fetcher.bytes_received - bytes_before)
+        return ret_val
+
+    def start_job(self, session, feed, url):
+        ''' set up the fetch of a feed (see make_job()) ... unless that feed's last job is somehow still running
+            @return: (job, fingerprint, bytes received before the job), or None when the feed is skipped
+        '''
+        jobs_in_flight = self.jobs_in_flight
+        if feed in jobs_in_flight and jobs_in_flight[feed].running:
+            print 'Still waiting on the last fetch of the %s feed ... skipping it this cycle' % self.key(feed)
+            self.metrics.result(feed, 'failed')
+            return None
+        fp = fingerprint.lookup(session, feed)
+        jobs_in_flight[feed] = self.make_job(feed, url, fp)
+        return jobs_in_flight[feed], fp, jobs_in_flight[feed].fetcher.bytes_received
+
+    def handle_job(self, session, job, fp, sched=None):
+        ''' write out a (finished) fetch job ... or, if the fetch failed, report it
+            @return: False if the fetch failed
+        '''
+        metrics = self.metrics
+        if job.error:
+            print 'Error fetching the %s feed: %s' % (self.key(job.feed), job.error)
+            if self.opts.stream and not job.running:
+                self.fetchers[job.feed].close()
+            metrics.result(job.feed, 'failed')
+            return False
+
+        if self.recorder and job.resp.raw is not None:
+            self.recorder.record(job.feed, job.resp.raw, job.started)
+        metrics.phase(job.feed, 'fetch', job.fetch_time)
+        if job.fm is not None and job.batches is None:
+            metrics.phase(job.feed, 'parse', job.decode_time)
+        try:
+            new_data = self.store_feed(session, job, fp)
+        except:
+            metrics.result(job.feed, 'failed')
+            raise
+        metrics.result(job.feed, 'loaded' if new_data else 'skipped')
+        if sched:
+            sched.observe(self.key(job.feed), fp.header_timestamp, new_data)
+        return True
+
+    def refresh_route_names(self, feeds):
+        ''' with an alerts feed to load, read the static routes' short names (see alerts.RouteNames) ... this reads on a
+            connection of its own, so it's done before the load's transaction gets going
+        '''
+        if 'alerts' in feeds:
+            self.route_names.refresh()
+
+    def store_job(self, session, job, sched=None):
+        ''' write and commit a (finished) fetch job on its own ... if anything goes wrong, just this feed is rolled back
+            @return: True if the feed made it in
+        '''
+        try:
+            self.refresh_route_names([job.feed])
+            fp = fingerprint.lookup(session, job.feed)
+            ret_val = self.handle_job(session, job, fp, sched)
+            with self.metrics.timer('all', 'commit'):
+                session.commit()
+            for d in self.differs.values():
+                d.commit()
+        except:
+            print 'Exception occurred writing the %s feed' % self.key(job.feed)
+            traceback.print_exc()
+            session.rollback()
+            for d in self.differs.values():
+                d.reset()
+            ret_val = False
+        return ret_val
+
+    def record_bytes(self, feed, received):
+        self.metrics.inc('gtfsrdb_fetch_bytes_total', received, feed=feed)
+        self.metrics.feed_stat(feed, 'bytes', received)
+
+    def make_cadence(self):
+        ''' @return: a Cadence to learn a feed's publish interval (or None, when not --adaptive)
+        '''
+        ret_val = None
+        if self.opts.adaptive:
+            ret_val = scheduler.Cadence(self.opts.minWait, self.opts.maxWait)
+        return ret_val
+
+    def export_metrics(self):
+        export_metrics(self.metrics, self.opts, self.memory)
+
+    @contextmanager
+    def session_scope(self):
+        ''' a new session, that's closed when the block is done ... so its identity map (and everything a load added
+            to it) doesn't outlive the cycle
+        '''
+        session = self.Session()
+        try:
+            yield session
+        finally:
+            session.close()
+
+    def run_cycle(self, session, feeds, sched=None):
+        ''' one load cycle: fetch, write and commit the feeds (or, if anything goes wrong, roll it all back)
+            @return: True if every feed made it in
+        '''
+        self.metrics.start_cycle()
+        try:
+            self.refresh_route_names([f for f, url in feeds])
+            success = self.load_feeds(session, feeds, sched)
+
+            # This does the adds and the generation flips (and any deletes), since it's
+            # atomic it never leaves us without data
+            with self.metrics.timer('all', 'commit'):
+                session.commit()
+            for d in self.differs.values():
+                d.commit()
+        except:
+            print 'Exception occurred in iteration'
+            traceback.print_exc()
+            session.rollback()
+            for d in self.differs.values():
+                d.reset()
+            success = False
+        return success
+
+    def run_once(self):
+        ''' load every feed, once (one cycle)
+            @return: True if every feed made it in
+        '''
+        with self.session_scope() as session:
+            ret_val = self.run_cycle(session, self.feeds, self.sched)
+        self.sched.done([self.key(f) for f, url in self.feeds])
+        self.export_metrics()
+        return ret_val
+
+    def run_forever(self):
+        ''' poll each feed on its schedule, until stop() is called ... or with the once setting, until every
+            feed has made it in (every feed is loaded on each try)
+            @return: True if the last cycle loaded every feed it tried
+        '''
+        opts = self.opts
+        sched = self.sched
+        success = True
+        while not self.stopping.is_set():
+            due = sched.due()
+            if opts.once:
+                due = [self.key(f) for f, url in self.feeds]
+            with self.session_scope() as session:
+                success = self.run_cycle(session, [(f, url) for f, url in self.feeds if self.key(f) in due], sched)
+            sched.done(due)
+            self.export_metrics()
+            if opts.adaptive:
+                for f, (cadence, hit_rate) in sched.stats().items():
+                    if f in due and cadence:
+                        print '%s feed publishes every %ss (%.0f%% of fetches found new data)' % (f, cadence, hit_rate * 100)
+
+            # put this outside the try...except so it won't be skipped when something
+            # fails
+            # also, makes it easier to end the process with ctrl-c, b/c a
+            # KeyboardInterrupt here will end the program (cleanly)
+            if opts.once and success:
+                print "Executed the load ONCE ... going to stop now..."
+                break
+            sched.sleep()
+        return success
+
+    def stop(self):
+        ''' ask run_forever() (or the --pipeline fetcher) to finish up, from another thread
+        '''
+        self.stopping.set()
+
+    def run_pipeline(self):
+        ''' --pipeline: fetch, decode and write each feed on its own stage (see pipeline.py) ... the fetch stage
+            polls the feeds on their schedule, the decode stage parses them (on its thread, or in a process pool),
+            and the writer (this thread, since it owns the sessions) writes and commits each feed as it comes through
+
+            NOTE: the fetch stage doesn't touch the database, so it's handed each feed's validators & digest
+                  (from its fingerprint) by the writer
+            @return: True if every feed made it in
+        '''
+        opts = self.opts
+        metrics = self.metrics
+        sched = self.sched
+        feeds = self.feeds
+        jobs_in_flight = self.jobs_in_flight
+
+        validators = {}
+        with self.session_scope() as session:
+            for feed, url in feeds:
+                fp = fingerprint.lookup(session, feed)
+                validators[feed] = (fp.etag, fp.last_modified, fp.digest)
+            session.commit()
+
+        decode_q = Queue(max(opts.queueSize, 1))
+        write_q = Queue(max(opts.queueSize, 1))
+        pool = pipeline.DecodePool(opts.decodeProcesses, opts.lang)
+
+        def fetch():
+            while True:
+                due = sched.due()
+                if opts.once:
+                    due = [self.key(f) for f, url in feeds]
+                try:
+                    jobs = []
+                    for feed, url in feeds:
+                        if self.key(feed) not in due:
+                            continue
+                        if feed in jobs_in_flight and jobs_in_flight[feed].running:
+                            print 'Still waiting on the last fetch of the %s feed ... skipping it this cycle' % feed
+                            continue
+                        etag, last_modified, digest = validators[feed]
+                        unchanged = None
+                        if opts.always:
+                            etag = last_modified = None
+                        elif digest:
+                            unchanged = lambda raw, digest=digest: fingerprint.digest(raw) == digest
+                        f = self.get_fetcher(feed, url)
+                        jobs_in_flight[feed] = fetcher.FeedJob(feed, f, None, etag, last_modified, unchanged, opts.fetch_timeout)
+                        jobs.append((jobs_in_flight[feed], f.bytes_received))
+
+                    fetcher.run_jobs([j for j, b in jobs])
+
+                    # blocks when the decoder (and so the writer) has fallen behind
+                    for job, bytes_before in jobs:
+                        received = job.fetcher.bytes_received - bytes_before if not job.running else 0
+                        decode_q.put((job, received))
+                except Exception:
+                    traceback.print_exc()
+
+                if opts.once or self.stopping.is_set():
+                    decode_q.put(pipeline.STOP)
+                    break
+                sched.done(due)
+                sched.sleep()
+
+        def decode(item):
+            job, received = item
+            pending = None
+            if not job.error and job.resp.raw is not None and not job.same_content:
+                pending = pool.decode(job.resp.raw)
+            return job, received, pending
+
+        fetch_stage = threading.Thread(target=fetch, name='fetch')
+        fetch_stage.daemon = True
+        fetch_stage.start()
+        pipeline.Stage('decode', decode, decode_q, write_q).start()
+
+        ret_val = True
+        try:
+            while True:
+                item = pipeline.get(write_q)
+                if item is pipeline.STOP:
+                    break
+                job, received, pending = item
+
+                metrics.start_cycle()
+                if pending:
+                    try:
+                        header, job.batches, parse_secs, transform_secs = pending.get(opts.fetch_timeout)
+                        job.fm = pipeline.header_message(header)
+                        metrics.phase(job.feed, 'parse', parse_secs)
+                        metrics.phase(job.feed, 'transform', transform_secs)
+                    except Exception, e:
+                        job.error = e
+                with self.session_scope() as session:
+                    success = self.store_job(session, job, sched)
+                    fp = fingerprint.lookup(session, job.feed)
+                    validators[job.feed] = (fp.etag, fp.last_modified, fp.digest)
+                self.record_bytes(job.feed, received)
+                self.export_metrics()
+                ret_val = success and ret_val
+        finally:
+            pool.close()
+        return ret_val
+
+    def replay_archive(self):
+        ''' --replay: each payload in the archive gets its own load cycle (read from its file:// url)
+            @return: True if every payload was loaded
+        '''
+        archive = replay.Archive(self.opts.replay)
+        feeds = [f for f, url in self.feeds]
+        ret_val = True
+        start = time.time()
+        for payload in archive.play(self.opts.replaySpeed, feeds or None):
+            if self.stopping.is_set():
+                break
+            # a new fetcher for each payload, since each comes from its own file
+            f = self.fetchers.pop(payload.feed, None)
+            if f:
+                f.close()
+            with self.session_scope() as session:
+                ret_val = self.run_cycle(session, [(payload.feed, payload.url)]) and ret_val
+            self.export_metrics()
+        print replay.report(self.metrics, time.time() - start, self.opts.dsn)
+        return ret_val
+
+    def run(self):
+        ''' what load_rt does: check (or create) the tables, and then replay, run the pipeline, or poll the feeds,
+            depending on the settings ... and close everything down at the end
+            @return: True if the (last) load got every feed in
+        '''
+        try:
+            self.setup()
+            if self.opts.metricsPort:
+                self.metrics.serve(self.opts.metricsPort)
+            if self.opts.replay:
+                return self.replay_archive()
+            if self.opts.pipeline:
+                return self.run_pipeline()
+            return self.run_forever()
+        finally:
+            self.close()
+
+    def close(self):
+        ''' close the fetchers and metrics server ... and the engine, unless it was handed to us
+        '''
+        for f in self.fetchers.values():
+            f.close()
+        self.fetchers.clear()
+        self.metrics.close()
+        if self.memory:
+            self.memory.close()
+        if self.own_engine:
+            self.engine.dispose()
+
+
+class MultiLoader(object):
+    ''' loads many agencies' feeds in one process ... each agency gets a RealtimeLoader (writing to the agency's own
+        schema), and they all share one engine (so, one connection pool), one scheduler and one set of metrics
+        (labeled with the agency)
+
+        every cycle, all the feeds that are due (from every agency) are fetched at the same time, and then each one is
+        written and committed on its own ... so a feed that fails (to fetch, or to write) doesn't hold up the rest
+
+        @param agencies: list of (name, settings) ... settings are an agency's own (e.g., schema, tripUpdates, lang)
+        @param engine: (optional) SQLAlchemy engine ... default is a new one, made from the dsn setting
+        @param settings: the settings shared by every agency (see DEFAULTS) ... an agency's own settings override these
+        @raise ValueError: when the settings can't work together
+    '''
+    def __init__(self, agencies, engine=None, **settings):
+        unknown = set(settings) - set(DEFAULTS)
+        if unknown:
+            raise ValueError('Unknown loader settings: {0}'.format(', '.join(sorted(unknown))))
+        opts = dict(DEFAULTS)
+        opts.update(settings)
+        if engine is not None and opts['dsn'] is None:
+            opts['dsn'] = str(engine.url)
+        self.opts = opts = Values(opts)
+        if opts.dsn is None:
+            raise ValueError('No database specified!')
+        if opts.pipeline or opts.replay:
+            raise ValueError('The --pipeline and --replay options can not be combined with more than one agency!')
+        if not agencies:
+            raise ValueError('No agencies were specified!')
+
+        self.own_engine = engine is None
+        self.engine = engine if engine is not None else create_engine(opts.dsn, echo=opts.verbose)
+        self.metrics = Metrics()
+        self.memory = None
+        if opts.memoryEvery:
+            self.memory = memory.MemoryWatch(opts.memoryEvery)
+        self.stopping = threading.Event()
+        self.sched = scheduler.Scheduler(sleep=self.stopping.wait)
+
+        self.loaders = []
+        schemas = {}
+        for name, agency in agencies:
+            shared = set(agency) & set(SHARED)
+            if shared:
+                raise ValueError('The {0} settings are shared by every agency ... {1} can not set them'.format(', '.join(sorted(shared)), name))
+            agency_settings = dict((k, v) for k, v in settings.items() if k not in SHARED)
+            agency_settings.update(agency)
+
+            # each agency's generations & fingerprints are kept by feed name, so they need a schema to themselves
+            schema = agency_settings.get('schema')
+            if schema in schemas:
+                raise ValueError('The {0} and {1} agencies both load into the same schema ({2})!'.format(schemas[schema], name, schema))
+            schemas[schema] = name
+
+            try:
+                self.loaders.append(RealtimeLoader(self.engine, name, self.sched, self.metrics.scope(agency=name), **agency_settings))
+            except ValueError, e:
+                raise ValueError('{0}: {1}'.format(name, e))
+
+    def setup(self):
+        ''' check (and with the create setting, create) every agency's tables
+            @raise ValueError: when a table is missing
+        '''
+        for loader in self.loaders:
+            try:
+                loader.setup()
+            except ValueError, e:
+                raise ValueError('{0}: {1}'.format(loader.name, e))
+
+    def run_cycle(self, due=None):
+        ''' fetch every feed that's due (all of them, when due is None) at the same time, and then write & commit each
+            one on its own
+            @return: True if every feed made it in
+        '''
+        ret_val = True
+        self.metrics.start_cycle()
+
+        # step 1: start a job for each feed ... each agency's session is committed as soon as it's looked up the
+        #         fingerprints, so it's not holding a pooled connection while the feeds are fetched
+        jobs = []
+        sessions = {}
+        try:
+            for loader in self.loaders:
+                session = sessions[loader.name] = loader.Session()
+                try:
+                    for feed, url in loader.feeds:
+                        if due is None or loader.key(feed) in due:
+                            job = loader.start_job(session, feed, url)
+                            if job is None:
+                                ret_val = False
+                            else:
+                                jobs.append((loader, job))
+                    session.commit()
+                except:
+                    print 'Exception occurred starting the {0} feeds'.format(loader.name)
+                    traceback.print_exc()
+                    session.rollback()
+                    ret_val = False
+
+            # step 2: fetch & decode
+            fetcher.run_jobs([job for loader, (job, fp, b) in jobs])
+
+            # step 3: write & commit each feed
+            for loader, (job, fp, bytes_before) in jobs:
+                ret_val = loader.store_job(sessions[loader.name], job, self.sched) and ret_val
+                if not job.running:
+                    loader.record_bytes(job.feed, job.fetcher.bytes_received - bytes_before)
+        finally:
+            for session in sessions.values():
+                session.close()
+        export_metrics(self.metrics, self.opts, self.memory)
+        return ret_val
+
+    def run_once(self):
+        ''' load every agency's feeds, once (one cycle)
+            @return: True if every feed made it in
+        '''
+        ret_val = self.run_cycle()
+        self.sched.done([loader.key(f) for loader in self.loaders for f, url in loader.feeds])
+        return ret_val
+
+    def run_forever(self):
+        ''' poll each feed on its schedule, until stop() is called ... or with the once setting, until every feed
+            has made it in
+            @return: True if the last cycle loaded every feed it tried
+        '''
+        success = True
+        while not self.stopping.is_set():
+            if self.opts.once:
+                success = self.run_once()
+                if success:
+                    print "Executed the load ONCE ... going to stop now..."
+                    break
+            else:
+                due = self.sched.due()
+                success = self.run_cycle(due)
+                self.sched.done(due)
+            self.sched.sleep()
+        return success
+
+    def stop(self):
+        self.stopping.set()
+
+    def run(self):
+        ''' what load_rt does with a config file: check (or create) the tables, and then poll the feeds
+        '''
+        try:
+            self.setup()
+            if self.opts.metricsPort:
+                self.metrics.serve(self.opts.metricsPort)
+            return self.run_forever()
+        finally:
+            self.close()
+
+    def close(self):
+        for loader in self.loaders:
+            loader.close()
+        self.metrics.close()
+        if self.memory:
+            self.memory.close()
+        if self.own_engine:
+            self.engine.dispose()
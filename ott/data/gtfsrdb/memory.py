@@ -0,0 +1,105 @@
+''' memory watch for long running loaders (--memory-every N)
+
+    every N cycles, snapshot what's been allocated, and report the places that have grown the most since
+    the last snapshot ... so a week-long soak run can show memory staying flat (or, if it isn't, where
+    it's going).
+
+    uses tracemalloc when it's around (python 3.4+, or the pytracemalloc backport for python 2), which
+    reports growth by the line that allocated it ... otherwise, falls back to counting the live objects
+    of each type that the garbage collector knows about.
+'''
+import gc
+import resource
+import logging
+log = logging.getLogger(__file__)
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+# number of growth sites reported
+TOP = 10
+
+
+def max_rss():
+    ''' @return: peak resident set size of this process, in bytes (ru_maxrss is in KB on linux)
+    '''
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def type_counts():
+    ''' @return: {type name: number of live objects} for the objects the gc is tracking
+    '''
+    ret_val = {}
+    for o in gc.get_objects():
+        t = type(o)
+        name = '{0}.{1}'.format(t.__module__, t.__name__)
+        ret_val[name] = ret_val.get(name, 0) + 1
+    return ret_val
+
+
+class MemoryWatch(object):
+    ''' @param every: take a snapshot every this many cycles
+        @param top: number of growth sites to report
+    '''
+    def __init__(self, every, top=TOP):
+        self.every = max(every, 1)
+        self.top = top
+        self.cycles = 0
+        self.last = None
+        self.last_cycle = None
+        if tracemalloc and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    def snapshot(self):
+        if tracemalloc:
+            return tracemalloc.take_snapshot().filter_traces((
+                tracemalloc.Filter(False, tracemalloc.__file__),
+                tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+            ))
+        return type_counts()
+
+    def growth(self, old, new):
+        ''' @return: list of (growth, description) ... biggest first
+        '''
+        ret_val = []
+        if tracemalloc:
+            for s in new.compare_to(old, 'lineno')[:self.top]:
+                if s.size_diff > 0:
+                    ret_val.append((s.size_diff, str(s)))
+        else:
+            diffs = sorted(((n - old.get(t, 0), t) for t, n in new.items()), reverse=True)[:self.top]
+            for diff, t in diffs:
+                if diff > 0:
+                    ret_val.append((diff, '{0}: +{1} objects ({2} live)'.format(t, diff, new[t])))
+        return ret_val
+
+    def cycle(self):
+        ''' call after each load cycle ... every N cycles, takes a snapshot
+            @return: report (string) of the growth since the last snapshot, or None when there's nothing to report yet
+        '''
+        self.cycles += 1
+        if self.cycles % self.every != 0:
+            return None
+
+        gc.collect()
+        snap = self.snapshot()
+        ret_val = None
+        if self.last is not None:
+            lines = ['Memory after {0} cycles: peak RSS {1:.1f} MB ... top growth since cycle {2} ({3}):'.format(
+                     self.cycles, max_rss() / 1048576.0, self.last_cycle, 'tracemalloc' if tracemalloc else 'gc objects')]
+            growth = self.growth(self.last, snap)
+            for g, desc in growth:
+                lines.append('  ' + desc)
+            if not growth:
+                lines.append('  (nothing grew)')
+            ret_val = '\n'.join(lines)
+        self.last = snap
+        self.last_cycle = self.cycles
+        return ret_val
+
+    def close(self):
+        self.last = None
+        if tracemalloc and tracemalloc.is_tracing():
+            tracemalloc.stop()
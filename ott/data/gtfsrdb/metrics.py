@@ -0,0 +1,246 @@
+''' loader instrumentation ... timings & counters for each feed and each phase of a load cycle
+
+    phases (the 'phase' label of gtfsrdb_phase_seconds):
+      fetch     - the HTTP request(s), up to having the (decoded) bytes in hand
+      parse     - protobuf parse of the feed (in --stream mode, just the header)
+      transform - turning the FeedMessage into column batches (see decoder.py)
+      write     - building the rows and writing them (or, with --orm / --diff / --stream, the whole load)
+      commit    - session.commit() of the cycle (feed="all")
+
+    exported as:
+      - Prometheus text format, written to a file (e.g., for the node_exporter textfile collector) and/or
+        served at http://<host>:<port>/metrics
+      - a JSON summary of each cycle, appended (one line per cycle) to a file and/or served at /metrics.json
+'''
+import os
+import time
+import json
+import threading
+from contextlib import contextmanager
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+import logging
+log = logging.getLogger(__file__)
+
+COUNTER = 'counter'
+GAUGE = 'gauge'
+SUMMARY = 'summary'
+
+# name: (type, help)
+METRICS = {
+    'gtfsrdb_fetch_bytes_total': (COUNTER, 'Bytes received fetching the feed'),
+    'gtfsrdb_phase_seconds': (SUMMARY, 'Time spent in each phase of loading the feed'),
+    'gtfsrdb_rows_written_total': (COUNTER, 'Rows written to the database'),
+    'gtfsrdb_entities': (GAUGE, 'Number of entities in the last load of the feed'),
+    'gtfsrdb_entities_total': (COUNTER, 'Entities loaded'),
+    'gtfsrdb_lag_seconds': (GAUGE, 'How far behind the feed header timestamp the last load was written'),
+    'gtfsrdb_cycles_total': (COUNTER, 'Load cycles by result (loaded, skipped or failed)'),
+    'gtfsrdb_cycle_seconds': (SUMMARY, 'Time taken by each load cycle'),
+    'gtfsrdb_last_cycle_timestamp': (GAUGE, 'Unix time the last load cycle finished'),
+}
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join('{0}="{1}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"')) for k, v in labels) + '}'
+
+
+class Metrics(object):
+    ''' holds the loader's metrics (thread safe, since the fetch jobs run on their own threads)
+    '''
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.values = {}
+        self.cycle = None
+        self.last_cycle = None
+        self.server = None
+
+    def key(self, name, labels):
+        return name, tuple(sorted(labels.items()))
+
+    def inc(self, name, value=1, **labels):
+        with self.lock:
+            k = self.key(name, labels)
+            self.values[k] = self.values.get(k, 0) + value
+
+    def set(self, name, value, **labels):
+        with self.lock:
+            self.values[self.key(name, labels)] = value
+
+    def observe(self, name, value, **labels):
+        ''' add an observation (e.g., seconds) to a summary
+        '''
+        with self.lock:
+            k = self.key(name, labels)
+            s = self.values.setdefault(k, [0.0, 0])
+            s[0] += value
+            s[1] += 1
+
+    def get(self, name):
+        ''' @return: {labels: value} for each set of labels the metric has a value for ... where labels
+                     is a sorted tuple of (name, value) pairs
+        '''
+        with self.lock:
+            return dict((labels, v) for (n, labels), v in self.values.items() if n == name)
+
+    def phase(self, feed, phase, secs):
+        ''' record the time a phase took, both in the summary and in this cycle's JSON
+        '''
+        self.observe('gtfsrdb_phase_seconds', secs, feed=feed, phase=phase)
+        self.feed_stat(feed, phase + '_seconds', round(secs, 6), add=True)
+
+    @contextmanager
+    def timer(self, feed, phase):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.phase(feed, phase, time.time() - start)
+
+    def feed_stat(self, feed, stat, value, add=False):
+        ''' set (or add to) one of the feed's values in this cycle's JSON summary
+        '''
+        if self.cycle is not None:
+            with self.lock:
+                stats = self.cycle['feeds'].setdefault(feed, {})
+                if add and stat in stats:
+                    value += stats[stat]
+                stats[stat] = value
+
+    def result(self, feed, result):
+        ''' @param result: 'loaded', 'skipped' or 'failed'
+        '''
+        self.inc('gtfsrdb_cycles_total', feed=feed, result=result)
+        self.feed_stat(feed, 'result', result)
+
+    def scope(self, **labels):
+        ''' @return: a Scope that records into these metrics, with labels (e.g., agency='trimet') added
+        '''
+        return Scope(self, **labels)
+
+    def start_cycle(self):
+        self.cycle = dict(start=time.time(), feeds={})
+
+    def end_cycle(self):
+        ''' @return: this cycle's JSON summary
+        '''
+        now = time.time()
+        ret_val = self.cycle
+        if ret_val is not None:
+            ret_val['seconds'] = round(now - ret_val['start'], 6)
+            self.observe('gtfsrdb_cycle_seconds', now - ret_val['start'], feed='all')
+            self.last_cycle = ret_val
+            self.cycle = None
+        self.set('gtfsrdb_last_cycle_timestamp', now)
+        return ret_val
+
+    def prometheus(self):
+        ''' @return: the metrics in Prometheus text exposition format
+        '''
+        lines = []
+        with self.lock:
+            items = sorted(self.values.items())
+        names = sorted(set(name for (name, labels), v in items))
+        for name in names:
+            mtype, desc = METRICS.get(name, (GAUGE, ''))
+            lines.append('# HELP {0} {1}'.format(name, desc))
+            lines.append('# TYPE {0} {1}'.format(name, mtype))
+            for (n, labels), v in items:
+                if n != name:
+                    continue
+                if mtype == SUMMARY:
+                    lines.append('{0}_sum{1} {2}'.format(name, format_labels(labels), repr(float(v[0]))))
+                    lines.append('{0}_count{1} {2}'.format(name, format_labels(labels), v[1]))
+                else:
+                    lines.append('{0}{1} {2}'.format(name, format_labels(labels), v))
+        return '\n'.join(lines) + '\n'
+
+    def json(self):
+        return json.dumps(self.last_cycle, sort_keys=True)
+
+    def write(self, path):
+        ''' write the Prometheus text to path (via a temp file and rename, so scrapers never see half a file)
+        '''
+        tmp = path + '.tmp'
+        with open(tmp, 'w') as f:
+            f.write(self.prometheus())
+        os.rename(tmp, path)
+
+    def append_json(self, path):
+        with open(path, 'a') as f:
+            f.write(self.json() + '\n')
+
+    def serve(self, port, host=''):
+        ''' serve /metrics (Prometheus text) and /metrics.json (last cycle) from a background thread
+        '''
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.startswith('/metrics.json'):
+                    body, ctype = metrics.json(), 'application/json'
+                elif self.path.startswith('/metrics'):
+                    body, ctype = metrics.prometheus(), 'text/plain; version=0.0.4'
+                else:
+                    self.send_error(404)
+                    return
+                self.send_response(200)
+                self.send_header('Content-Type', ctype)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = HTTPServer((host, port), Handler)
+        t = threading.Thread(target=self.server.serve_forever, name='metrics')
+        t.daemon = True
+        t.start()
+        return self.server
+
+    def close(self):
+        if self.server:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+
+class Scope(object):
+    ''' records into a (shared) Metrics, adding its labels to everything ... e.g., each agency's loader records
+        with agency=<name>, and in the cycle's JSON summary, its feeds show up as <name>/<feed>
+
+        NOTE: the cycles belong to whoever owns the Metrics, so starting / ending one through a Scope does nothing
+    '''
+    def __init__(self, metrics, **labels):
+        self.metrics = metrics
+        self.labels = labels
+        self.prefix = ''.join('{0}/'.format(v) for k, v in sorted(labels.items()))
+
+    def __getattr__(self, name):
+        return getattr(self.metrics, name)
+
+    def inc(self, name, value=1, **labels):
+        labels.update(self.labels)
+        self.metrics.inc(name, value, **labels)
+
+    def set(self, name, value, **labels):
+        labels.update(self.labels)
+        self.metrics.set(name, value, **labels)
+
+    def observe(self, name, value, **labels):
+        labels.update(self.labels)
+        self.metrics.observe(name, value, **labels)
+
+    def feed_stat(self, feed, stat, value, add=False):
+        self.metrics.feed_stat(self.prefix + feed, stat, value, add)
+
+    phase = Metrics.phase.im_func
+    timer = Metrics.timer.im_func
+    result = Metrics.result.im_func
+
+    def start_cycle(self):
+        pass
+
+    def end_cycle(self):
+        pass
@@ -20,7 +20,7 @@
 # Matt Conway: main code
 
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy import Column, ForeignKey, Integer, String, DateTime, Boolean, Float
+from sqlalchemy import Column, ForeignKey, Integer, String, DateTime, Boolean, Float, Index
 from sqlalchemy.orm import relationship, backref
 
 Base = declarative_base()
@@ -57,9 +57,13 @@ def add_schema(schema, data_classes=None):
 # The oid is called oid because several of the GTFSr types have string ids
 # TODO: add sequences
 
+# Each load of a feed stamps its rows with a new generation id (see generations.py), and
+# the Generation table points at the one generation of each feed that readers should see.
+
 class TripUpdate(Base):
     __tablename__ = 'trip_updates'
     oid = Column(Integer, primary_key=True, index=True)
+    generation = Column(Integer, index=True)
 
     # This replaces the TripDescriptor message
     # TODO: figure out the relations
@@ -83,7 +87,12 @@ class TripUpdate(Base):
 
 class StopTimeUpdate(Base):
     __tablename__ = 'stop_time_updates'
+    __table_args__ = (
+        # a stop's predictions in the current generation, and the trip updates they join to
+        Index('ix_stop_time_updates_stop', 'stop_id', 'generation', 'trip_update_id'),
+    )
     oid = Column(Integer, primary_key=True, index=True)
+    generation = Column(Integer, index=True)
 
     # TODO: Fill one from the other
     stop_sequence = Column(Integer)
@@ -111,6 +120,7 @@ class Alert(Base):
     __tablename__ = 'alerts'
 
     oid = Column(Integer, primary_key=True, index=True)
+    generation = Column(Integer, index=True)
 
     # Collapsed TimeRange
     start = Column(Integer, index=True)
@@ -142,12 +152,13 @@ class Alert(Base):
 class EntitySelector(Base):
     __tablename__ = 'entity_selectors'
     oid = Column(Integer, primary_key=True, index=True)
+    generation = Column(Integer, index=True)
 
     agency_id = Column(String(15), index=True)
     route_id = Column(String(10), index=True)
 
     route_type = Column(Integer)
-    stop_id = Column(String(10))
+    stop_id = Column(String(10), index=True)
 
     # Collapsed TripDescriptor
     trip_id = Column(String(10))
@@ -163,10 +174,34 @@ class EntitySelector(Base):
     )
 
 
+# end of an active period that doesn't have one (i.e., the alert is active until further notice)
+FOREVER = 2**31 - 1
+
+class AlertPeriod(Base):
+    ''' one of an alert's active periods ... every period gets its own row (alerts.start / end only hold the
+        first one), and a period without a start or an end is stored as 0 or FOREVER, so an 'active at T' query
+        is a plain range lookup (start <= T and end >= T) on the (generation, start, end) index
+    '''
+    __tablename__ = 'alert_periods'
+    __table_args__ = (
+        Index('ix_alert_periods_active', 'generation', 'start', 'end'),
+    )
+    oid = Column(Integer, primary_key=True, index=True)
+    generation = Column(Integer, index=True)
+
+    start = Column(Integer)
+    end = Column(Integer)
+
+    alert_id = Column(Integer, ForeignKey('alerts.oid'), index=True)
+
+    Alert = relationship('Alert', backref='ActivePeriods')
+
+
 
 class VehiclePosition(Base):
     __tablename__ = 'vehicle_positions'
     oid = Column(Integer, primary_key=True, index=True)
+    generation = Column(Integer, index=True)
 
     # This replaces the TripDescriptor message
     # TODO: figure out the relations
@@ -190,5 +225,66 @@ class VehiclePosition(Base):
     timestamp = Column(DateTime)
    
 
+
+class RouteDelay(Base):
+    ''' arrival delay summary of each route in the current trip updates feed (see summary.py)
+    '''
+    __tablename__ = 'route_delays'
+    route_id = Column(String(10), primary_key=True)
+    generation = Column(Integer)
+
+    arrivals = Column(Integer)
+    avg_arrival_delay = Column(Float)
+    max_arrival_delay = Column(Integer)
+
+    # the trip updates feed's header timestamp
+    updated = Column(DateTime)
+
+
+class StopDelay(Base):
+    ''' arrival delay summary of each stop in the current trip updates feed (see summary.py)
+    '''
+    __tablename__ = 'stop_delays'
+    stop_id = Column(String(10), primary_key=True)
+    generation = Column(Integer)
+
+    arrivals = Column(Integer)
+    avg_arrival_delay = Column(Float)
+    max_arrival_delay = Column(Integer)
+
+    updated = Column(DateTime)
+
+
+class Generation(Base):
+    ''' the current generation of each feed ('trip_updates', 'alerts' or 'vehicle_positions') ...
+        the loader writes a new generation, and then flips this (small) pointer row to it
+    '''
+    __tablename__ = 'generations'
+    feed = Column(String(20), primary_key=True)
+    current = Column(Integer)
+    updated = Column(DateTime)
+
+
+class FeedFingerprint(Base):
+    ''' what each feed looked like the last time it was loaded (see fingerprint.py) ... lets the loader
+        skip parsing and writing feeds that haven't changed, across restarts
+    '''
+    __tablename__ = 'feed_fingerprints'
+    feed = Column(String(20), primary_key=True)
+    header_timestamp = Column(Integer)
+    digest = Column(String(40))
+    etag = Column(String(200))
+    last_modified = Column(String(40))
+    skipped = Column(Integer)
+    updated = Column(DateTime)
+
+
 # So one can loop over all classes to clear them for a new load (-o option)
-AllClasses = (TripUpdate, StopTimeUpdate, Alert, EntitySelector, VehiclePosition)
+AllClasses = (TripUpdate, StopTimeUpdate, Alert, EntitySelector, AlertPeriod, VehiclePosition)
+
+# The classes loaded from each type of feed (all stamped with that feed's generation)
+FeedClasses = {
+    'trip_updates'      : (TripUpdate, StopTimeUpdate),
+    'alerts'            : (Alert, EntitySelector, AlertPeriod),
+    'vehicle_positions' : (VehiclePosition,),
+}
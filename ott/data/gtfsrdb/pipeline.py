@@ -0,0 +1,116 @@
+''' staged pipeline for the loader (--pipeline): fetch -> decode -> write, connected by bounded queues
+
+    each stage runs on its own thread, so the network, the CPU and the database are all kept busy at the
+    same time ... the fetcher can be pulling down the next feed while the last one is being decoded, and
+    the one before that is being written & committed.
+
+    the queues are bounded, so when the database falls behind, the writer's queue fills up, then the
+    decoder's, and then the fetcher blocks (and its missed polling ticks get coalesced) ... memory
+    stays bounded at a few feeds, rather than growing without limit.
+
+    decoding (the protobuf parse, and turning the feed into column batches) can also run in a process
+    pool (see DecodePool), so it doesn't fight the writer for the GIL
+'''
+import time
+import Queue
+import threading
+import multiprocessing
+import logging
+log = logging.getLogger(__file__)
+
+from . import decoder
+from . import gtfs_realtime_pb2
+
+# put on a queue to tell the stages downstream to finish up
+STOP = 'STOP'
+
+
+def get(q, timeout=1.0):
+    ''' Queue.get() that (unlike a plain blocking get in python 2) can still be interrupted by ctrl-c
+    '''
+    while True:
+        try:
+            return q.get(True, timeout)
+        except Queue.Empty:
+            pass
+
+
+class Stage(threading.Thread):
+    ''' takes each item off its inbox, and puts work(item) on its outbox (unless work() returns None)
+        ... an exception in work() is logged, and the item dropped
+    '''
+    def __init__(self, name, work, inbox, outbox=None):
+        super(Stage, self).__init__(name=name)
+        self.daemon = True
+        self.work = work
+        self.inbox = inbox
+        self.outbox = outbox
+        self.processed = 0
+
+    def run(self):
+        while True:
+            item = get(self.inbox)
+            if item is STOP:
+                break
+            try:
+                out = self.work(item)
+                self.processed += 1
+            except Exception, e:
+                log.exception("{0} stage failed: {1}".format(self.name, e))
+                continue
+            if out is not None and self.outbox is not None:
+                self.outbox.put(out)
+        if self.outbox is not None:
+            self.outbox.put(STOP)
+
+
+def decode_payload(raw, lang=None):
+    ''' parse a feed, and turn it into column batches (see decoder.py) ... runs in the decode pool
+        @return: (serialized FeedHeader, FeedBatches, parse seconds, transform seconds)
+    '''
+    st = time.time()
+    fm = gtfs_realtime_pb2.FeedMessage.FromString(raw)
+    parsed = time.time()
+    batches = decoder.decode(fm, lang)
+    return fm.header.SerializeToString(), batches, parsed - st, time.time() - parsed
+
+
+class Decoded(object):
+    ''' result of a decode that has (already) been done
+    '''
+    def __init__(self, value):
+        self.value = value
+
+    def get(self, timeout=None):
+        return self.value
+
+
+class DecodePool(object):
+    ''' decodes feeds in a pool of processes (or, with processes=0, right away on the calling thread)
+        ... decode() returns something with a get(), so the decode stage can hand the writer a
+        feed that's still being decoded
+    '''
+    def __init__(self, processes=0, lang=None):
+        self.lang = lang
+        self.pool = None
+        if processes > 0:
+            self.pool = multiprocessing.Pool(processes)
+
+    def decode(self, raw):
+        if self.pool:
+            return self.pool.apply_async(decode_payload, (raw, self.lang))
+        return Decoded(decode_payload(raw, self.lang))
+
+    def close(self):
+        if self.pool:
+            self.pool.terminate()
+            self.pool = None
+
+
+def header_message(header):
+    ''' @return: a FeedMessage with just the (serialized) header ... all the writer needs of the feed,
+                 along with its batches
+    '''
+    ret_val = gtfs_realtime_pb2.FeedMessage()
+    ret_val.header.ParseFromString(header)
+    return ret_val
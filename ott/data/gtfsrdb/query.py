@@ -1,9 +1,17 @@
+import time
+import datetime
+import weakref
+import threading
+from collections import namedtuple
+from bisect import bisect_right
 import logging
 log = logging.getLogger(__file__)
 
-from sqlalchemy import and_
+from sqlalchemy import and_, or_, func, true
+from sqlalchemy.orm import sessionmaker, joinedload
 
-from .model import EntitySelector
+from .model import Base, Alert, EntitySelector, AlertPeriod, RouteDelay, StopDelay, TripUpdate, StopTimeUpdate
+from . import generations
 
 '''
   https://github.com/mattwigway/gtfsrdb
@@ -14,31 +22,93 @@ from .model import EntitySelector
 '''
 
 
-db_has_alerts_tables = None
+# the realtime tables a database may (or may not) have
+REALTIME_TABLES = ('alerts', 'entity_selectors', 'alert_periods', 'trip_updates', 'stop_time_updates',
+                   'vehicle_positions', 'route_delays', 'stop_delays', 'generations')
+
+# seconds a probe of the database's tables is trusted for
+CAPABILITY_TTL = 300
+
+
+class Capabilities(object):
+    ''' registry of which realtime tables each database (engine) has ... all of them are probed at once, on one pooled
+        connection, and the answer (yes or no) is cached for ttl seconds, so a database without the realtime tables costs
+        nothing per request.  invalidate() forces a new probe (e.g., once the loader has created the tables)
+    '''
+    def __init__(self, ttl=CAPABILITY_TTL):
+        self.ttl = ttl
+        self.probes = weakref.WeakKeyDictionary()
+        self.lock = threading.Lock()
+
+    def probe(self, engine):
+        ''' @return: frozenset of the REALTIME_TABLES that the database has
+        '''
+        ret_val = set()
+        schemas = dict((t.name, t.schema) for t in Base.metadata.tables.values())
+        with engine.connect() as conn:
+            for t in REALTIME_TABLES:
+                log.info("Checking to see if TABLE {0} EXISTS:".format(t))
+                if engine.dialect.has_table(conn, t, schema=schemas.get(t)):
+                    ret_val.add(t)
+        return frozenset(ret_val)
+
+    def tables(self, engine, now=None):
+        ''' @return: the (cached) set of realtime tables the engine's database has
+        '''
+        if now is None:
+            now = time.time()
+        with self.lock:
+            probed = self.probes.get(engine)
+            if probed is None or now - probed[0] > self.ttl:
+                try:
+                    probed = (now, self.probe(engine))
+                except Exception, e:
+                    log.warn("ERROR WHEN CHECKING GTFSRT TABLES EXIST: {0}".format(e))
+                    probed = (now, frozenset())
+                self.probes[engine] = probed
+        return probed[1]
+
+    def has(self, engine, tables, now=None):
+        ''' @return: True if the database has all of these tables
+        '''
+        return self.tables(engine, now).issuperset(tables)
+
+    def invalidate(self, engine=None):
+        ''' forget what's been probed (for just this engine, or every engine)
+        '''
+        with self.lock:
+            if engine is None:
+                self.probes.clear()
+            else:
+                self.probes.pop(engine, None)
+
+
+capabilities = Capabilities()
+
+
 def okay_to_query(session, tables=['alerts', 'entity_selectors']):
     ''' IMPORTANT: have to make sure the GTRTFS alerts stuff exists before we start querying for data...
                    If we don't want check, and query non-existant tables, then the DB sessions get very 
                    unstable for our normal GTFS data queries...
+                   (see Capabilities ... the tables are only checked every CAPABILITY_TTL seconds)
     '''
-    global db_has_alerts_tables
+    ret_val = False
+    try:
+        ret_val = capabilities.has(session.get_bind(), tables)
+    except Exception, e:
+        log.warn("ERROR WHEN CHECKING GTFSRT TABLE {0} EXISTS:".format(e))
+    return ret_val
 
-    if db_has_alerts_tables != True:
-        #import pdb; pdb.set_trace()
-        try:
-            engine = session.get_bind()
-            schema = EntitySelector.__table__.schema
-            db_has_alerts_tables = True
-            for t in tables:
-                log.info("Checking to see if TABLE {0} EXISTS:".format(t))
-                table_exists = engine.dialect.has_table(engine.connect(), t, schema=schema)
-                if not table_exists:
-                    db_has_alerts_tables = False
-                    break
-        except Exception, e:
-            log.warn("ERROR WHEN CHECKING GTFSRT TABLE {0} EXISTS:".format(e))
-            db_has_alerts_tables = False
 
-    return db_has_alerts_tables
+
+def current_rows(session, cls, feed):
+    ''' @return: SQL clause that filters cls down to the feed's current generation (see generations.is_current()) ...
+                 or, when the database doesn't have a generations table (it pre-dates generations, and hasn't been
+                 migrated by the loader yet), a clause that lets every row through
+    '''
+    if okay_to_query(session, ['generations']):
+        return generations.is_current(cls, feed)
+    return true()
 
 
 def via_route_id(session, route_id, agency_id='TODO: NotUsed', stop_id='TODO: NotUsed', def_val=[]):
@@ -46,10 +116,14 @@ def via_route_id(session, route_id, agency_id='TODO: NotUsed', stop_id='TODO: No
     '''
     ret_val = def_val
     try:
-        if okay_to_query(session):
+        index = index_for(session)
+        if index is not None:
+            ret_val = index.via_route_id(route_id, def_val)
+        elif okay_to_query(session):
             log.info("Alerts via route: {0}".format(route_id))
             log.info("QUERY EntitySelector table")
-            ret_val = session.query(EntitySelector).filter(EntitySelector.route_id == route_id).all()
+            q = session.query(EntitySelector).filter(EntitySelector.route_id == route_id)
+            ret_val = q.filter(current_rows(session, EntitySelector, 'alerts')).all()
     except Exception, e:
         log.warn(e)
     return ret_val
@@ -58,11 +132,425 @@ def via_route_id(session, route_id, agency_id='TODO: NotUsed', stop_id='TODO: No
 def via_stop_id(session, stop_id, agency_id='TODO: NotUsed', def_val=[]):
     ret_val = def_val
     try:
-        if okay_to_query(session):
+        index = index_for(session)
+        if index is not None:
+            ret_val = index.via_stop_id(stop_id, def_val)
+        elif okay_to_query(session):
             log.info("Alerts via stop: {0}".format(stop_id))
             log.info("QUERY EntitySelector table")
-            ret_val = session.query(EntitySelector).filter(EntitySelector.stop_id == stop_id).all()
+            q = session.query(EntitySelector).filter(EntitySelector.stop_id == stop_id)
+            ret_val = q.filter(current_rows(session, EntitySelector, 'alerts')).all()
+    except Exception, e:
+        log.warn(e)
+    return ret_val
+
+
+
+# just the columns that AlertsDao shows, from an alert's entity selector and the alert
+ALERT_ROW_COLUMNS = (
+    EntitySelector.alert_id, EntitySelector.route_id, EntitySelector.stop_id, EntitySelector.trip_id,
+    Alert.url, Alert.header_text, Alert.description_text, Alert.cause, Alert.effect, Alert.start, Alert.end,
+    Alert.route_short_names, Alert.route_ids,
+)
+AlertRow = namedtuple('AlertRow', [c.key for c in ALERT_ROW_COLUMNS])
+
+
+def alert_row(selector):
+    ''' @return: an EntitySelector (and its joined Alert) as an AlertRow ... the same columns that alert_rows() returns
+    '''
+    return AlertRow(*[getattr(selector if c.class_ is EntitySelector else selector.Alert, c.key) for c in ALERT_ROW_COLUMNS])
+
+
+def alert_rows(session, route_id=None, stop_id=None, def_val=[]):
+    ''' get the alerts for a route or stop as plain (named) tuples of ALERT_ROW_COLUMNS, rather than EntitySelector objects
+        with their joined Alert ... and just one row per alert (an alert with many selectors for the route / stop
+        comes back once)
+    '''
+    ret_val = def_val
+    try:
+        if okay_to_query(session):
+            log.info("Alert rows via route: {0} stop: {1}".format(route_id, stop_id))
+            q = session.query(*ALERT_ROW_COLUMNS).join(Alert, Alert.oid == EntitySelector.alert_id)
+            if route_id:
+                q = q.filter(EntitySelector.route_id == route_id)
+            if stop_id:
+                q = q.filter(EntitySelector.stop_id == stop_id)
+            q = q.filter(current_rows(session, EntitySelector, 'alerts')).order_by(EntitySelector.oid)
+            ret_val = []
+            seen = set()
+            for r in q:
+                if r.alert_id not in seen:
+                    seen.add(r.alert_id)
+                    ret_val.append(r)
+    except Exception, e:
+        log.warn(e)
+    return ret_val
+
+
+def group_by(selectors, attr, keys):
+    ''' @return: {key: [selectors]} with an entry (maybe empty) for every key
+    '''
+    ret_val = dict((k, []) for k in keys)
+    for s in selectors:
+        k = getattr(s, attr)
+        if k in ret_val:
+            ret_val[k].append(s)
+    return ret_val
+
+
+def via_route_ids(session, route_ids, def_val=None):
+    ''' get the alerts of many routes with one query (e.g., for a route list)
+        @return: {route_id: [alerts]} for each route
+    '''
+    ret_val = def_val if def_val is not None else {}
+    route_ids = list(set(route_ids))
+    try:
+        index = index_for(session)
+        if index is not None:
+            ret_val = dict((r, index.via_route_id(r)) for r in route_ids)
+        elif route_ids and okay_to_query(session):
+            log.info("Alerts via {0} routes".format(len(route_ids)))
+            log.info("QUERY EntitySelector table")
+            q = session.query(EntitySelector).filter(EntitySelector.route_id.in_(route_ids))
+            ret_val = group_by(q.filter(current_rows(session, EntitySelector, 'alerts')).all(), 'route_id', route_ids)
+    except Exception, e:
+        log.warn(e)
+    return ret_val
+
+
+def via_stop_ids(session, stop_ids, def_val=None):
+    ''' get the alerts of many stops with one query
+        @return: {stop_id: [alerts]} for each stop
+    '''
+    ret_val = def_val if def_val is not None else {}
+    stop_ids = list(set(stop_ids))
+    try:
+        index = index_for(session)
+        if index is not None:
+            ret_val = dict((s, index.via_stop_id(s)) for s in stop_ids)
+        elif stop_ids and okay_to_query(session):
+            log.info("Alerts via {0} stops".format(len(stop_ids)))
+            log.info("QUERY EntitySelector table")
+            q = session.query(EntitySelector).filter(EntitySelector.stop_id.in_(stop_ids))
+            ret_val = group_by(q.filter(current_rows(session, EntitySelector, 'alerts')).all(), 'stop_id', stop_ids)
     except Exception, e:
         log.warn(e)
     return ret_val
 
+
+def via_stop_and_route_ids(session, stop_id, route_ids):
+    ''' get the alerts for a stop, and for all the routes serving it, with one query (e.g., for a stop page)
+        @return: ([the stop's alerts], {route_id: [alerts]})
+    '''
+    stop_alerts = []
+    route_ids = list(set(route_ids))
+    route_alerts = dict((r, []) for r in route_ids)
+    try:
+        index = index_for(session)
+        if index is not None:
+            stop_alerts = index.via_stop_id(stop_id)
+            route_alerts = dict((r, index.via_route_id(r)) for r in route_ids)
+        elif okay_to_query(session):
+            log.info("Alerts via stop: {0} and {1} routes".format(stop_id, len(route_ids)))
+            log.info("QUERY EntitySelector table")
+            match = EntitySelector.stop_id == stop_id
+            if route_ids:
+                match = or_(match, EntitySelector.route_id.in_(route_ids))
+            selectors = session.query(EntitySelector).filter(match).filter(current_rows(session, EntitySelector, 'alerts')).all()
+            stop_alerts = [s for s in selectors if s.stop_id == stop_id]
+            route_alerts = group_by(selectors, 'route_id', route_ids)
+    except Exception, e:
+        log.warn(e)
+    return stop_alerts, route_alerts
+
+
+def active_at(session, when=None, route_id=None, stop_id=None, def_val=[]):
+    ''' get array of alerts (EntitySelectors) that are active at a time (epoch seconds ... default is now), optionally
+        just those for a route and/or stop ... a range lookup on the alert_periods index, rather than a filter in python
+        (or, with an AlertIndex, a bisect of its ActivePeriods)
+    '''
+    ret_val = def_val
+    try:
+        if when is None:
+            when = int(time.time())
+        index = index_for(session)
+        if index is not None and index.periods is not None:
+            ret_val = index.active_at(when, route_id, stop_id)
+        elif okay_to_query(session, ['alerts', 'entity_selectors', 'alert_periods']):
+            log.info("Alerts active at {0} via route: {1} stop: {2}".format(when, route_id, stop_id))
+            active = session.query(AlertPeriod.alert_id).filter(and_(
+                current_rows(session, AlertPeriod, 'alerts'), AlertPeriod.start <= when, AlertPeriod.end >= when))
+            q = session.query(EntitySelector).filter(EntitySelector.alert_id.in_(active.subquery()))
+            if route_id:
+                q = q.filter(EntitySelector.route_id == route_id)
+            if stop_id:
+                q = q.filter(EntitySelector.stop_id == stop_id)
+            ret_val = q.filter(current_rows(session, EntitySelector, 'alerts')).all()
+    except Exception, e:
+        log.warn(e)
+    return ret_val
+
+
+class ActivePeriods(object):
+    ''' in-memory interval index of alert active periods: the timeline is cut up at every period's start & end, and
+        each piece holds the (frozen) set of alert ids active during it ... so at(T) is a bisect, rather than a scan
+
+        @param periods: (alert_id, start, end) for each period ... ends are inclusive
+    '''
+    def __init__(self, periods=()):
+        events = {}
+        for alert_id, start, end in periods:
+            events.setdefault(start, []).append((alert_id, 1))
+            events.setdefault(end + 1, []).append((alert_id, -1))
+
+        self.bounds = sorted(events)
+        self.active = []
+        counts = {}
+        for b in self.bounds:
+            for alert_id, n in events[b]:
+                counts[alert_id] = counts.get(alert_id, 0) + n
+            self.active.append(frozenset(a for a, c in counts.items() if c > 0))
+
+    def at(self, when):
+        ''' @return: frozenset of the ids of the alerts active at this time (epoch seconds)
+        '''
+        i = bisect_right(self.bounds, when) - 1
+        if i < 0:
+            return frozenset()
+        return self.active[i]
+
+
+def route_delay(session, route_id, def_val=None):
+    ''' get the route's arrival delay summary (RouteDelay) ... a primary key lookup (see summary.py)
+    '''
+    ret_val = def_val
+    try:
+        if okay_to_query(session, ['route_delays']):
+            ret_val = session.query(RouteDelay).get(route_id) or def_val
+    except Exception, e:
+        log.warn(e)
+    return ret_val
+
+
+def stop_delay(session, stop_id, def_val=None):
+    ''' get the stop's arrival delay summary (StopDelay)
+    '''
+    ret_val = def_val
+    try:
+        if okay_to_query(session, ['stop_delays']):
+            ret_val = session.query(StopDelay).get(stop_id) or def_val
+    except Exception, e:
+        log.warn(e)
+    return ret_val
+
+
+def stop_predictions(session, stop_id, date=None, def_val={}):
+    ''' get the realtime predictions at a stop (from the current trip updates), for overlaying on its static schedule ...
+        one join of the stop's stop_time_updates (via their (stop_id, generation, trip_update_id) index) to their
+        trip_updates (by primary key)
+        @param date: (optional) service date ... trip updates for other dates are left out (ones without a date aren't)
+        @return: {(trip_id, trip_start_date, stop_sequence): row of (trip_id, trip_start_date, stop_sequence,
+                 schedule_relationship, arrival_time, arrival_delay, departure_time, departure_delay)} ... see find_prediction()
+    '''
+    ret_val = def_val
+    try:
+        if okay_to_query(session, ['trip_updates', 'stop_time_updates']):
+            log.info("Predictions via stop: {0}".format(stop_id))
+            q = session.query(TripUpdate.trip_id, TripUpdate.trip_start_date, StopTimeUpdate.stop_sequence,
+                              TripUpdate.schedule_relationship,
+                              StopTimeUpdate.arrival_time, StopTimeUpdate.arrival_delay,
+                              StopTimeUpdate.departure_time, StopTimeUpdate.departure_delay)
+            q = q.join(TripUpdate, TripUpdate.oid == StopTimeUpdate.trip_update_id)
+            q = q.filter(StopTimeUpdate.stop_id == stop_id).filter(current_rows(session, StopTimeUpdate, 'trip_updates'))
+            if date:
+                q = q.filter(TripUpdate.trip_start_date.in_([date.strftime('%Y%m%d'), '']))
+            ret_val = dict(((r.trip_id, r.trip_start_date, r.stop_sequence), r) for r in q)
+    except Exception, e:
+        log.warn(e)
+    return ret_val
+
+
+def find_prediction(predictions, trip_id, date=None, stop_sequence=None):
+    ''' find a scheduled stop time's prediction in stop_predictions() ... a trip that visits the stop more than once
+        (e.g., a loop) has a prediction per visit, and the same trip_id on another service date is another trip
+        @param date: service date of the schedule ... predictions without a date match any date
+        @param stop_sequence: the stop time's stop_sequence ... predictions without one (only a stop_id) match any visit
+        @return: the prediction row, or None
+    '''
+    dates = ['']
+    if date:
+        dates.insert(0, date.strftime('%Y%m%d'))
+    for d in dates:
+        for seq in (stop_sequence, 0):
+            ret_val = predictions.get((trip_id, d, seq))
+            if ret_val is not None:
+                return ret_val
+    return None
+
+
+def predicted_time(departure_time, prediction):
+    ''' @param departure_time: the scheduled departure, as a 'HH:MM:SS' string (which can be past 24:00:00)
+        @return: predicted departure as a 'HH:MM:SS' string (always 00:00:00 to 23:59:59) ... from the prediction's
+                 departure (or arrival) time, or else the scheduled departure plus the prediction's delay, rolled
+                 over into the day (so a delay that crosses midnight doesn't give 24:03:00, nor -00:02:00)
+        NOTE: the predicted (epoch) times are shown in the server's local time zone
+    '''
+    secs = prediction.departure_time or prediction.arrival_time
+    if secs:
+        return datetime.datetime.fromtimestamp(secs).strftime('%H:%M:%S')
+    delay = prediction.departure_delay or prediction.arrival_delay or 0
+    h, m, s = [int(x) for x in departure_time.split(':')]
+    secs = (h * 3600 + m * 60 + s + delay) % 86400
+    return '{0:02d}:{1:02d}:{2:02d}'.format(secs // 3600, secs % 3600 // 60, secs % 60)
+
+
+# seconds between the alert index's checks for a new alerts load
+ALERT_INDEX_INTERVAL = 30
+
+# the process' AlertIndex (see use_alert_index()) ... via_route_id() and via_stop_id() answer from it once it's loaded
+alert_index = None
+
+
+class AlertIndex(object):
+    ''' in-process index of the current alerts (their EntitySelectors, with the joined Alert), keyed by route_id and
+        by stop_id ... built from one query, so a lookup is a dict get, with no trip to the database
+
+        the alerts' active periods are indexed too (see ActivePeriods), so active_at() is a bisect and a dict get
+
+        a background thread checks every interval seconds whether the alerts have changed (the alerts feed's current
+        generation, and the max entity_selectors oid ... two cheap queries), and only then reloads the index
+
+        NOTE: the selectors are detached from the session that loaded them, and shared by every caller ... so treat
+              them as read-only.  their Alert, and its ActivePeriods and InformedEntities, are loaded up front (see
+              LOAD_OPTIONS) ... anything else lazy can't be loaded
+        NOTE: the index only answers for sessions bound to the engine it was built from (see serves())
+    '''
+    # eager loads of everything a caller (e.g., AlertsDao) reads from a detached selector ... by name, since the
+    # backrefs don't exist until the mappers are configured
+    LOAD_OPTIONS = (
+        joinedload(EntitySelector.Alert).subqueryload('ActivePeriods'),
+        joinedload(EntitySelector.Alert).subqueryload('InformedEntities'),
+    )
+
+    def __init__(self, engine, interval=ALERT_INDEX_INTERVAL):
+        self.engine = engine
+        self.Session = sessionmaker(bind=engine)
+        self.interval = interval
+        self.version = None
+        self.selectors = []
+        self.routes = {}
+        self.stops = {}
+        self.periods = None
+        self.ready = False
+        self.stopping = threading.Event()
+        self.thread = None
+
+    def current_version(self, session):
+        ''' @return: (current alerts generation, max entity_selectors oid)
+        '''
+        gen = None
+        if okay_to_query(session, ['generations']):
+            gen = generations.current(session, 'alerts')
+        return (gen, session.query(func.max(EntitySelector.oid)).scalar())
+
+    def refresh(self):
+        ''' reload the index, if the alerts have changed since it was last loaded
+            @return: True if the index was reloaded
+        '''
+        ret_val = False
+        session = self.Session()
+        try:
+            if not okay_to_query(session):
+                return ret_val
+            version = self.current_version(session)
+            if not self.ready or version != self.version:
+                log.info("QUERY EntitySelector table (alert index)")
+                has_periods = okay_to_query(session, ['alert_periods'])
+                options = self.LOAD_OPTIONS if has_periods else self.LOAD_OPTIONS[1:]
+                routes = {}
+                stops = {}
+                periods = {}
+                q = session.query(EntitySelector).options(*options)
+                selectors = q.filter(current_rows(session, EntitySelector, 'alerts')).all()
+                for s in selectors:
+                    if s.route_id:
+                        routes.setdefault(s.route_id, []).append(s)
+                    if s.stop_id:
+                        stops.setdefault(s.stop_id, []).append(s)
+                    if has_periods and s.Alert is not None and s.alert_id not in periods:
+                        periods[s.alert_id] = [(s.alert_id, p.start, p.end) for p in s.Alert.ActivePeriods]
+                self.selectors = selectors
+                self.routes = routes
+                self.stops = stops
+                self.periods = ActivePeriods(p for ps in periods.values() for p in ps) if has_periods else None
+                self.version = version
+                self.ready = True
+                ret_val = True
+        except Exception, e:
+            log.warn("alert index not refreshed: {0}".format(e))
+        finally:
+            session.close()
+        return ret_val
+
+    def serves(self, session):
+        ''' @return: True if the index is loaded, and from the database the session is bound to
+        '''
+        return self.ready and session.get_bind() is self.engine
+
+    def via_route_id(self, route_id, def_val=[]):
+        return self.routes.get(route_id, def_val)
+
+    def via_stop_id(self, stop_id, def_val=[]):
+        return self.stops.get(stop_id, def_val)
+
+    def active_at(self, when, route_id=None, stop_id=None):
+        ''' the selectors (optionally just those for a route and/or stop) of the alerts active at this time
+        '''
+        active = self.periods.at(when)
+        if route_id:
+            selectors = self.routes.get(route_id, [])
+        elif stop_id:
+            selectors = self.stops.get(stop_id, [])
+        else:
+            selectors = self.selectors
+        return [s for s in selectors if s.alert_id in active and (not stop_id or s.stop_id == stop_id)]
+
+    def run(self):
+        while not self.stopping.wait(self.interval):
+            self.refresh()
+
+    def start(self):
+        ''' load the index, and start checking for changes in the background
+            @return: self
+        '''
+        self.refresh()
+        self.thread = threading.Thread(target=self.run, name='alert-index')
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.stopping.set()
+        if self.thread:
+            self.thread.join()
+            self.thread = None
+
+
+def index_for(session):
+    ''' @return: the process' AlertIndex, when it can answer for this session (see AlertIndex.serves()) ... else None
+    '''
+    if alert_index is not None and alert_index.serves(session):
+        return alert_index
+    return None
+
+
+def use_alert_index(engine, interval=ALERT_INDEX_INTERVAL):
+    ''' have via_route_id() and via_stop_id() answer from an AlertIndex (that's kept up to date in the background),
+        rather than querying for every request ... call once, when the (web) app starts
+        @return: the AlertIndex
+    '''
+    global alert_index
+    if alert_index is not None:
+        alert_index.stop()
+    alert_index = AlertIndex(engine, interval).start()
+    return alert_index
@@ -0,0 +1,132 @@
+''' record & replay of raw feed payloads ... for profiling / benchmarking the loader offline
+
+    an archive is a directory with a sub-directory per feed, holding each payload as it was fetched
+    (after any gzip decoding), named for the time it was fetched (in epoch milliseconds):
+
+        archive/trip_updates/1400000000123.pb
+        archive/vehicle_positions/1400000001456.pb
+
+    the loader records into an archive with --record, and --replay feeds an archive back through the
+    whole pipeline (each payload is fetched from its file:// url, fingerprinted, decoded, written and
+    committed, just like a live cycle), either at (some multiple of) the speed it was recorded, or
+    as fast as possible ... and then prints a report (see report())
+'''
+import os
+import time
+import logging
+log = logging.getLogger(__file__)
+
+EXT = '.pb'
+
+
+class Recorder(object):
+    def __init__(self, path):
+        self.path = path
+
+    def record(self, feed, raw, when=None):
+        ''' write a payload into the archive
+            @return: path of the payload file
+        '''
+        if when is None:
+            when = time.time()
+        dir = os.path.join(self.path, feed)
+        if not os.path.isdir(dir):
+            os.makedirs(dir)
+        ret_val = os.path.join(dir, "{0}{1}".format(int(when * 1000), EXT))
+        tmp = ret_val + '.tmp'
+        with open(tmp, 'wb') as f:
+            f.write(raw)
+        os.rename(tmp, ret_val)
+        return ret_val
+
+
+class Payload(object):
+    def __init__(self, feed, when, path):
+        self.feed = feed
+        self.when = when
+        self.path = path
+
+    @property
+    def url(self):
+        return 'file://' + os.path.abspath(self.path)
+
+
+class Archive(object):
+    ''' the recorded payloads in a directory
+    '''
+    def __init__(self, path):
+        self.path = path
+
+    def feeds(self):
+        return sorted([f for f in os.listdir(self.path) if os.path.isdir(os.path.join(self.path, f))])
+
+    def payloads(self, feeds=None):
+        ''' @param feeds: optional list of the feeds to replay (default is all of them)
+            @return: every payload in the archive, in the order they were recorded
+        '''
+        ret_val = []
+        for feed in feeds or self.feeds():
+            dir = os.path.join(self.path, feed)
+            for name in os.listdir(dir):
+                if name.endswith(EXT):
+                    try:
+                        when = int(name[:-len(EXT)]) / 1000.0
+                    except ValueError:
+                        log.info("skipping {0} ... not named for its time".format(name))
+                        continue
+                    ret_val.append(Payload(feed, when, os.path.join(dir, name)))
+        ret_val.sort(key=lambda p: (p.when, p.feed))
+        return ret_val
+
+    def play(self, speed=0, feeds=None, clock=time.time, sleep=time.sleep):
+        ''' yield the payloads, each at its (recorded) time
+            @param speed: 1 is the speed they were recorded at, 2 twice as fast, etc. ... and 0 is as fast as possible
+        '''
+        start = clock()
+        first = None
+        for p in self.payloads(feeds):
+            if first is None:
+                first = p.when
+            if speed > 0:
+                wait = start + (p.when - first) / float(speed) - clock()
+                if wait > 0:
+                    sleep(wait)
+            yield p
+
+
+def labels(**kw):
+    return tuple(sorted(kw.items()))
+
+
+def report(m, seconds, dsn=None):
+    ''' @param m: the loader's Metrics
+        @param seconds: wall clock time the replay took
+        @return: report (string) of the replay's throughput, and where the time went
+    '''
+    entities = m.get('gtfsrdb_entities_total')
+    rows = m.get('gtfsrdb_rows_written_total')
+    cycles = m.get('gtfsrdb_cycles_total')
+    phases = m.get('gtfsrdb_phase_seconds')
+    total = sum(entities.values())
+
+    lines = []
+    if dsn:
+        lines.append("database: {0}".format(dsn.split(':')[0]))
+    lines.append("replayed {0} entities in {1:.2f}s ... {2:.1f} entities/sec".format(
+                 total, seconds, total / seconds if seconds > 0 else 0))
+
+    feeds = set(dict(l)['feed'] for l in phases.keys() + cycles.keys())
+    feeds.discard('all')
+    for feed in sorted(feeds):
+        lines.append("  {0}: {1} entities, {2} rows, {3} loaded, {4} skipped, {5} failed".format(
+            feed, entities.get(labels(feed=feed), 0), rows.get(labels(feed=feed), 0),
+            cycles.get(labels(feed=feed, result='loaded'), 0), cycles.get(labels(feed=feed, result='skipped'), 0),
+            cycles.get(labels(feed=feed, result='failed'), 0)))
+        for phase in ('fetch', 'parse', 'transform', 'write'):
+            s = phases.get(labels(feed=feed, phase=phase))
+            if s:
+                lines.append("    {0:<10} {1:9.3f}s total {2:9.2f}ms avg".format(phase, s[0], 1000.0 * s[0] / s[1]))
+    s = phases.get(labels(feed='all', phase='commit'))
+    if s:
+        lines.append("    {0:<10} {1:9.3f}s total {2:9.2f}ms avg".format('commit', s[0], 1000.0 * s[0] / s[1]))
+    return '\n'.join(lines)
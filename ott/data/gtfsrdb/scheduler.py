@@ -0,0 +1,161 @@
+''' polling schedule for the loader ... each feed gets its own interval (e.g., vehicle positions every 10s,
+    alerts every 5 min)
+
+    ticks are anchored to the wall clock (multiples of the interval since the epoch, so a 30s feed polls at
+    :00 and :30), rather than sleeping a fixed time after each cycle, so the period doesn't drift by however
+    long the cycle took.  when a cycle overruns one or more ticks, those ticks are coalesced into the next
+    one, rather than queued up and run back to back.
+
+    a feed can also be polled adaptively (see Cadence), where its next poll is timed to land just after the
+    feed is next expected to publish.
+
+    NOTE: the Scheduler is thread safe, since with --pipeline it's shared by the fetch and write stages
+'''
+import math
+import time
+import threading
+from collections import deque
+import logging
+log = logging.getLogger(__file__)
+
+
+class Cadence(object):
+    ''' learns a feed's publish interval from the header timestamps of successive fetches
+
+        the cadence is the median gap between the last few distinct header timestamps.  the smallest
+        lag seen between a header timestamp and our (local) first sight of it soaks up both clock skew
+        and publishing latency, so the next poll is aimed at:
+            last timestamp + cadence + lag + margin (bounded by min_wait and max_wait from now)
+
+        also keeps the hit rate ... the fraction of fetches that came back with new data
+    '''
+    def __init__(self, min_wait=5, max_wait=120, margin=1, history=8):
+        self.min_wait = min_wait
+        self.max_wait = max_wait
+        self.margin = margin
+        self.timestamps = deque(maxlen=history)
+        self.lags = deque(maxlen=history)
+        self.fetches = 0
+        self.hits = 0
+
+    def observe(self, header_timestamp, new_data, now=None):
+        ''' record a fetch, along with the feed's header timestamp (as of this fetch)
+        '''
+        if now is None:
+            now = time.time()
+        self.fetches += 1
+        if new_data:
+            self.hits += 1
+        if header_timestamp and (len(self.timestamps) == 0 or header_timestamp > self.timestamps[-1]):
+            self.timestamps.append(header_timestamp)
+            self.lags.append(now - header_timestamp)
+
+    @property
+    def cadence(self):
+        ''' @return: learned publish interval in seconds (None until we've seen the feed publish twice)
+        '''
+        ret_val = None
+        if len(self.timestamps) > 1:
+            ts = list(self.timestamps)
+            gaps = sorted([b - a for a, b in zip(ts, ts[1:])])
+            ret_val = gaps[len(gaps) // 2]
+        return ret_val
+
+    @property
+    def hit_rate(self):
+        ret_val = None
+        if self.fetches > 0:
+            ret_val = float(self.hits) / self.fetches
+        return ret_val
+
+    def next_poll(self, now):
+        ''' @return: when to poll next (None if we haven't learned the cadence yet)
+        '''
+        ret_val = None
+        cadence = self.cadence
+        if cadence:
+            lag = min(self.lags)
+            expected = self.timestamps[-1] + cadence + lag + self.margin
+
+            # we've already missed the expected publish, so aim for the one after
+            if expected <= now:
+                expected += math.ceil(float(now - expected) / cadence) * cadence
+            ret_val = min(max(expected, now + self.min_wait), now + self.max_wait)
+        return ret_val
+
+
+class Scheduler(object):
+    def __init__(self, clock=time.time, sleep=time.sleep):
+        self.clock = clock
+        self._sleep = sleep
+        self.lock = threading.RLock()
+        self.intervals = {}
+        self.next_tick = {}
+        self.coalesced = {}
+        self.cadences = {}
+
+    def add(self, feed, interval, cadence=None):
+        ''' schedule a feed ... its first poll is due right away
+            @param cadence: optional Cadence ... once it has learned the feed's publish interval, it times the
+                            feed's polls, and interval is just the fallback
+        '''
+        with self.lock:
+            self.intervals[feed] = max(interval, 1)
+            self.next_tick[feed] = self.clock()
+            self.coalesced[feed] = 0
+            if cadence:
+                self.cadences[feed] = cadence
+
+    def observe(self, feed, header_timestamp, new_data):
+        ''' tell an adaptive feed's Cadence about a fetch
+        '''
+        with self.lock:
+            if feed in self.cadences:
+                self.cadences[feed].observe(header_timestamp, new_data, self.clock())
+
+    def stats(self):
+        ''' @return: {feed: (learned cadence, hit rate)} for the adaptive feeds
+        '''
+        with self.lock:
+            return dict((f, (c.cadence, c.hit_rate)) for f, c in self.cadences.items())
+
+    def due(self, now=None):
+        ''' @return: list of the feeds whose tick has come
+        '''
+        if now is None:
+            now = self.clock()
+        with self.lock:
+            return [f for f in self.intervals if self.next_tick[f] <= now]
+
+    def done(self, feeds, now=None):
+        ''' the cycle for these feeds is finished ... schedule each for its next tick after now,
+            coalescing any ticks the cycle overran
+        '''
+        if now is None:
+            now = self.clock()
+        with self.lock:
+            for f in feeds:
+                if f in self.cadences:
+                    tick = self.cadences[f].next_poll(now)
+                    if tick is not None:
+                        self.next_tick[f] = tick
+                        continue
+
+                interval = self.intervals[f]
+                tick = (math.floor(now / interval) + 1) * interval
+                missed = int(round((tick - self.next_tick[f]) / interval)) - 1
+                if missed > 0:
+                    self.coalesced[f] += missed
+                    log.info("{0} cycle overran {1} tick(s) ... coalesced".format(f, missed))
+                self.next_tick[f] = tick
+
+    def next_due(self):
+        with self.lock:
+            return min(self.next_tick.values()) if self.next_tick else None
+
+    def sleep(self):
+        ''' sleep until the next feed is due
+        '''
+        secs = self.next_due() - self.clock()
+        if secs > 0:
+            self._sleep(secs)
@@ -0,0 +1,218 @@
+''' streaming (wire level) reader for large GTFS-realtime feeds
+
+    fm.ParseFromString(raw) needs the whole raw payload, and then the whole parsed message tree, in memory
+    at once.  a FeedMessage is just a header (field 1) followed by its entities (field 2, repeated), each of
+    which is a length delimited record on the wire ... so FeedStream reads those records one at a time off
+    a file-like object, and parses each FeedEntity on its own.  the writer (see bulk.write_stream()) takes
+    the entities a batch at a time, so peak memory is one batch of entities (plus its rows), not the feed.
+
+    the readers here sit between the fetcher and the FeedStream:
+      - CountingReader counts (and sha1's) the bytes that pass through it
+      - InflateReader undoes a gzip / deflate content-encoding a chunk at a time
+'''
+import zlib
+import hashlib
+import logging
+log = logging.getLogger(__file__)
+
+from . import gtfs_realtime_pb2
+
+# size of each read from the underlying file
+CHUNK = 64 * 1024
+
+# protobuf wire types
+VARINT = 0
+FIXED64 = 1
+LENGTH_DELIMITED = 2
+FIXED32 = 5
+
+# FeedMessage field numbers
+HEADER = 1
+ENTITY = 2
+
+
+class CountingReader(object):
+    ''' passes reads through to f, keeping a count and a sha1 of the bytes read
+        @param count: optional callable that's handed the size of each read (e.g., to update a counter)
+    '''
+    def __init__(self, f, count=None):
+        self.f = f
+        self.count = count
+        self.bytes = 0
+        self.sha1 = hashlib.sha1()
+
+    def read(self, size=-1):
+        data = self.f.read(size) if size >= 0 else self.f.read()
+        self.bytes += len(data)
+        self.sha1.update(data)
+        if self.count:
+            self.count(len(data))
+        return data
+
+    def hexdigest(self):
+        return self.sha1.hexdigest()
+
+
+class InflateReader(object):
+    ''' decodes a gzip or deflate stream as it's read
+    '''
+    def __init__(self, f, encoding):
+        self.f = f
+        self.encoding = encoding.lower().strip()
+        self.inflater = None
+        self.buf = ''
+        self.eof = False
+
+    def make_inflater(self, first):
+        if self.encoding in ('gzip', 'x-gzip'):
+            return zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+        # deflate should be zlib wrapped, but plenty of servers send raw deflate data
+        if len(first) >= 2 and ord(first[0]) & 0x0f == 8 and (ord(first[0]) * 256 + ord(first[1])) % 31 == 0:
+            return zlib.decompressobj()
+        return zlib.decompressobj(-zlib.MAX_WBITS)
+
+    def read(self, size=-1):
+        while not self.eof and (size < 0 or len(self.buf) < size):
+            data = self.f.read(CHUNK)
+            if not data:
+                self.eof = True
+                if self.inflater:
+                    self.buf += self.inflater.flush()
+                break
+            if self.inflater is None:
+                self.inflater = self.make_inflater(data)
+            self.buf += self.inflater.decompress(data)
+
+        if size < 0:
+            size = len(self.buf)
+        ret_val = self.buf[:size]
+        self.buf = self.buf[size:]
+        return ret_val
+
+
+class FeedStream(object):
+    ''' reads a FeedMessage's header and entities, one record at a time, from a file-like object
+
+        NOTE: the header is (in every feed we know of) written first ... read_header() reads up to it,
+              holding on to any entities that (in theory) come before it
+    '''
+    def __init__(self, f):
+        self.f = f
+        self.buf = ''
+        self.pos = 0
+        self.header = None
+        self.entities = 0
+        self.early = []
+
+    def fill(self, size):
+        ''' make sure there are at least size unread bytes in the buffer
+            @return: False if the stream ends first
+        '''
+        while len(self.buf) - self.pos < size:
+            data = self.f.read(max(CHUNK, size))
+            if not data:
+                return False
+            self.buf = self.buf[self.pos:] + data
+            self.pos = 0
+        return True
+
+    def read_varint(self):
+        ''' @return: the next varint (None at the end of the stream)
+        '''
+        ret_val = 0
+        shift = 0
+        while True:
+            if not self.fill(1):
+                if shift > 0:
+                    raise IOError("feed ends in the middle of a varint")
+                return None
+            b = ord(self.buf[self.pos])
+            self.pos += 1
+            ret_val |= (b & 0x7f) << shift
+            if b < 0x80:
+                return ret_val
+            shift += 7
+
+    def read_bytes(self, size):
+        if not self.fill(size):
+            raise IOError("feed ends in the middle of a record ({0} bytes short)".format(size - (len(self.buf) - self.pos)))
+        ret_val = self.buf[self.pos:self.pos + size]
+        self.pos += size
+        return ret_val
+
+    def skip_field(self, wire_type):
+        if wire_type == VARINT:
+            self.read_varint()
+        elif wire_type == FIXED64:
+            self.read_bytes(8)
+        elif wire_type == LENGTH_DELIMITED:
+            self.read_bytes(self.read_varint())
+        elif wire_type == FIXED32:
+            self.read_bytes(4)
+        else:
+            raise IOError("unsupported wire type {0} in feed".format(wire_type))
+
+    def next_record(self):
+        ''' @return: the next (field number, parsed message) ... header or entity ... or None at the end
+        '''
+        while True:
+            tag = self.read_varint()
+            if tag is None:
+                return None
+            field, wire_type = tag >> 3, tag & 0x07
+            if wire_type == LENGTH_DELIMITED and field == HEADER:
+                return field, gtfs_realtime_pb2.FeedHeader.FromString(self.read_bytes(self.read_varint()))
+            if wire_type == LENGTH_DELIMITED and field == ENTITY:
+                return field, gtfs_realtime_pb2.FeedEntity.FromString(self.read_bytes(self.read_varint()))
+            self.skip_field(wire_type)
+
+    def read_header(self):
+        ''' @return: the feed's FeedHeader (an empty one if the feed doesn't have a header)
+        '''
+        while self.header is None:
+            rec = self.next_record()
+            if rec is None:
+                self.header = gtfs_realtime_pb2.FeedHeader()
+            elif rec[0] == HEADER:
+                self.header = rec[1]
+            else:
+                self.early.append(rec[1])
+        return self.header
+
+    def __iter__(self):
+        ''' yield each of the feed's entities, as it's read
+        '''
+        while self.early:
+            self.entities += 1
+            yield self.early.pop(0)
+        while True:
+            rec = self.next_record()
+            if rec is None:
+                break
+            if rec[0] == HEADER:
+                self.header = rec[1]
+            else:
+                self.entities += 1
+                yield rec[1]
+
+    def batches(self, size):
+        ''' yield the feed's entities in lists of (up to) size entities
+        '''
+        batch = []
+        for e in self:
+            batch.append(e)
+            if len(batch) >= size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    def drain(self):
+        ''' read (and throw away) the rest of the stream
+        '''
+        self.buf = ''
+        self.pos = 0
+        self.early = []
+        while self.f.read(CHUNK):
+            pass
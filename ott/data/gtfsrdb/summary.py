@@ -0,0 +1,79 @@
+''' per-route and per-stop arrival delay summaries, computed while the trip updates feed is loaded
+
+    asking the stop_time_updates table for the average & max delay of a route (or a stop) is a GROUP BY over
+    the whole feed ... so instead, the loader works the summaries out from the feed's decoded column batches
+    (see decoder.py) in one pass, and writes them to the (small) route_delays and stop_delays tables, which
+    readers can hit with a primary key lookup.
+
+    the summaries are rewritten (delete & insert) in the same transaction that flips the trip updates feed to
+    its new generation, so they always agree with the current stop_time_updates.
+
+    only stop time updates with an arrival delay are counted (on time arrivals have a delay of 0) ... ones with
+    just an arrival time, or just a departure, aren't.
+'''
+import logging
+log = logging.getLogger(__file__)
+
+from . import bulk
+from . import model
+
+
+def accumulate(sums, key, delay):
+    ''' add a delay to key's [count, total, max]
+    '''
+    s = sums.get(key)
+    if s is None:
+        sums[key] = [1, delay, delay]
+    else:
+        s[0] += 1
+        s[1] += delay
+        if delay > s[2]:
+            s[2] = delay
+
+
+class DelaySummary(object):
+    ''' running count, total and max arrival delay of each route and stop ... add() each batch of a feed
+        (more than one when the feed is streamed), then write()
+    '''
+    def __init__(self):
+        self.routes = {}
+        self.stops = {}
+
+    def add(self, batches):
+        ''' fold a feed's decoder.FeedBatches into the summaries
+        '''
+        routes = self.routes
+        stops = self.stops
+        trip_routes = batches.trip_updates['route_id']
+        stu = batches.stop_time_updates
+        for parent, stop_id, delay, has_delay in zip(stu['trip_update_id'], stu['stop_id'], stu['arrival_delay'], stu['arrival_has_delay']):
+            if not has_delay:
+                continue
+            route_id = trip_routes[parent]
+            if route_id:
+                accumulate(routes, route_id, delay)
+            if stop_id:
+                accumulate(stops, stop_id, delay)
+        return self
+
+    def rows(self, sums, key, generation=None, updated=None):
+        ''' @return: a list of summary rows (dicts) ... keyed on key (e.g., 'route_id')
+        '''
+        ret_val = []
+        for k, (count, total, max_delay) in sums.items():
+            ret_val.append({key: k, 'arrivals': count, 'avg_arrival_delay': float(total) / count,
+                            'max_arrival_delay': max_delay, 'generation': generation, 'updated': updated})
+        return ret_val
+
+    def write(self, session, generation=None, updated=None):
+        ''' replace the route_delays & stop_delays rows with this summary
+            @return: number of rows written
+        '''
+        conn = session.connection()
+        ret_val = 0
+        for table, sums, key in ((model.RouteDelay.__table__, self.routes, 'route_id'),
+                                 (model.StopDelay.__table__, self.stops, 'stop_id')):
+            conn.execute(table.delete())
+            ret_val += bulk.insert_rows(conn, table, self.rows(sums, key, generation, updated))
+        log.debug("wrote delay summaries for {0} routes and {1} stops".format(len(self.routes), len(self.stops)))
+        return ret_val
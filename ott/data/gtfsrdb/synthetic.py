@@ -0,0 +1,268 @@
+''' synthetic GTFS-realtime feeds, for scale testing the loader (and the model.py tables)
+
+    SyntheticFeeds keeps a fleet of vehicles, each running a trip, and builds the trip updates,
+    vehicle positions and alerts FeedMessages for it.  every step() moves the clock forward one
+    polling interval, and churns some fraction of the fleet (delays drift, vehicles move, and every
+    so often a vehicle finishes its trip and starts a new one) ... the rest of the fleet is left
+    exactly as it was, so the feeds look like real ones to the fingerprints and to --diff.
+
+    the trip, route and stop ids are made up, unless the feeds are derived from a gtfsdb database
+    (see from_gtfsdb()), in which case they're real (and join to the static tables).
+
+    the bench_rt command (see main()) writes a few cycles of the feeds into a replay archive (see
+    replay.py), and then replays it through the loader, to report throughput and memory:
+
+        bin/bench_rt -d postgresql://localhost/rt --vehicles 10000 --stops 50 --cycles 5
+'''
+import os
+import sys
+import time
+import random
+import shutil
+import tempfile
+import resource
+import subprocess
+from optparse import OptionParser
+import logging
+log = logging.getLogger(__file__)
+
+from . import gtfs_realtime_pb2
+from .replay import Recorder
+
+# made up fleet is spread out around this point (Portland, OR)
+CENTER_LAT = 45.52
+CENTER_LON = -122.68
+
+
+class Vehicle(object):
+    def __init__(self, vehicle_id, trip_id, route_id, stop_ids, start):
+        self.vehicle_id = vehicle_id
+        self.trip_id = trip_id
+        self.route_id = route_id
+        self.stop_ids = stop_ids
+        self.start = start
+        self.next_stop = 0
+        self.delay = 0
+        self.lat = CENTER_LAT
+        self.lon = CENTER_LON
+        self.bearing = 0.0
+        self.speed = 0.0
+
+
+class SyntheticFeeds(object):
+    ''' @param vehicles: size of the fleet (one trip update & vehicle position per vehicle)
+        @param stops: stops per trip (a stop time update for each stop the vehicle has yet to reach)
+        @param alerts: number of alerts
+        @param churn: fraction of the fleet that changes each step
+        @param interval: seconds between steps
+        @param trips: optional list of (trip_id, route_id, [stop_id, ...]) to run ... default is made up trips
+    '''
+    def __init__(self, vehicles=1000, stops=50, alerts=20, churn=0.2, interval=30, trips=None, seed=None, timestamp=None):
+        self.rand = random.Random(seed)
+        self.stops = stops
+        self.num_alerts = alerts
+        self.churn = churn
+        self.interval = interval
+        self.timestamp = int(timestamp or time.time())
+        self.trips = trips or self.make_trips(max(vehicles * 2, 1), stops)
+        self.next_trip = 0
+        self.vehicles = [self.assign(Vehicle('bus{0}'.format(i), None, None, None, None)) for i in range(vehicles)]
+
+    def make_trips(self, num, stops):
+        ret_val = []
+        for t in range(num):
+            route_id = str(t % 200 + 1)
+            first = self.rand.randint(1, 10000)
+            ret_val.append(('trip{0}'.format(t), route_id, [str(first + s) for s in range(stops)]))
+        return ret_val
+
+    def assign(self, v):
+        ''' put the vehicle on the next trip ... trips are handed out round robin
+        '''
+        trip_id, route_id, stop_ids = self.trips[self.next_trip % len(self.trips)]
+        self.next_trip += 1
+        v.trip_id = trip_id
+        v.route_id = route_id
+        v.stop_ids = stop_ids
+        v.start = self.timestamp
+        v.next_stop = 0
+        v.delay = self.rand.randint(-60, 300)
+        v.lat = CENTER_LAT + self.rand.uniform(-0.2, 0.2)
+        v.lon = CENTER_LON + self.rand.uniform(-0.3, 0.3)
+        v.bearing = float(self.rand.randint(0, 359))
+        v.speed = self.rand.uniform(0, 20)
+        return v
+
+    def step(self):
+        ''' move the clock on one interval, and churn the fleet
+        '''
+        self.timestamp += self.interval
+        for v in self.vehicles:
+            if self.rand.random() >= self.churn:
+                continue
+            v.next_stop += self.rand.randint(0, 2)
+            if v.next_stop >= len(v.stop_ids):
+                self.assign(v)
+                continue
+            v.delay += self.rand.randint(-30, 60)
+            v.lat += self.rand.uniform(-0.002, 0.002)
+            v.lon += self.rand.uniform(-0.002, 0.002)
+            v.bearing = float(self.rand.randint(0, 359))
+            v.speed = self.rand.uniform(0, 20)
+
+    def message(self):
+        fm = gtfs_realtime_pb2.FeedMessage()
+        fm.header.gtfs_realtime_version = '1.0'
+        fm.header.incrementality = gtfs_realtime_pb2.FeedHeader.FULL_DATASET
+        fm.header.timestamp = self.timestamp
+        return fm
+
+    def trip_updates(self):
+        fm = self.message()
+        for v in self.vehicles:
+            e = fm.entity.add()
+            e.id = v.vehicle_id
+            tu = e.trip_update
+            tu.trip.trip_id = v.trip_id
+            tu.trip.route_id = v.route_id
+            tu.trip.start_date = time.strftime('%Y%m%d', time.localtime(v.start))
+            tu.vehicle.id = v.vehicle_id
+            tu.vehicle.label = v.route_id
+            for s in range(v.next_stop, len(v.stop_ids)):
+                stu = tu.stop_time_update.add()
+                stu.stop_sequence = s + 1
+                stu.stop_id = v.stop_ids[s]
+                stu.arrival.delay = v.delay
+                stu.arrival.time = v.start + 120 * s + v.delay
+                stu.departure.delay = v.delay
+                stu.departure.time = v.start + 120 * s + v.delay + 20
+        return fm
+
+    def vehicle_positions(self):
+        fm = self.message()
+        for v in self.vehicles:
+            e = fm.entity.add()
+            e.id = v.vehicle_id
+            vp = e.vehicle
+            vp.trip.trip_id = v.trip_id
+            vp.trip.route_id = v.route_id
+            vp.vehicle.id = v.vehicle_id
+            vp.vehicle.label = v.route_id
+            vp.position.latitude = v.lat
+            vp.position.longitude = v.lon
+            vp.position.bearing = v.bearing
+            vp.position.speed = v.speed
+            vp.timestamp = self.timestamp
+        return fm
+
+    def alerts(self):
+        ''' alerts on some of the fleet's routes (and the stops of their trips) ... the same from step to step
+        '''
+        fm = self.message()
+        rand = random.Random(self.num_alerts)
+        causes = gtfs_realtime_pb2.Alert.DESCRIPTOR.enum_types_by_name['Cause'].values
+        effects = gtfs_realtime_pb2.Alert.DESCRIPTOR.enum_types_by_name['Effect'].values
+        for a in range(self.num_alerts):
+            trip_id, route_id, stop_ids = self.trips[rand.randint(0, len(self.trips) - 1)]
+            e = fm.entity.add()
+            e.id = 'alert{0}'.format(a)
+            alert = e.alert
+            p = alert.active_period.add()
+            p.start = self.timestamp - 3600
+            p.end = self.timestamp + 3600 * 24
+            alert.cause = rand.choice(causes).number
+            alert.effect = rand.choice(effects).number
+            alert.header_text.translation.add().text = 'Route {0} detour'.format(route_id)
+            alert.description_text.translation.add().text = 'Stops {0} closed'.format(', '.join(stop_ids[:3]))
+            alert.url.translation.add().text = 'http://example.com/alerts/{0}'.format(a)
+            alert.informed_entity.add().route_id = route_id
+            for stop_id in stop_ids[:rand.randint(0, 3)]:
+                alert.informed_entity.add().stop_id = stop_id
+        return fm
+
+    def feeds(self):
+        ''' @return: the FeedMessage for each type of feed, keyed like the loader's feeds
+        '''
+        return dict(trip_updates=self.trip_updates(), vehicle_positions=self.vehicle_positions(), alerts=self.alerts())
+
+
+def from_gtfsdb(url, schema=None, limit=None):
+    ''' @return: (trip_id, route_id, [stop_id, ...]) of the trips in a gtfsdb database, for SyntheticFeeds(trips=...)
+    '''
+    from .utils import get_gtfs_db
+    db = get_gtfs_db(url, schema)
+    if db is None:
+        raise ImportError("gtfsdb is needed to derive the feeds from a gtfs database")
+    from gtfsdb import Trip, StopTime
+
+    trips = db.session.query(Trip.trip_id, Trip.route_id)
+    if limit:
+        trips = trips.limit(limit)
+    trips = dict(trips.all())
+
+    stops = {}
+    q = db.session.query(StopTime.trip_id, StopTime.stop_id).order_by(StopTime.trip_id, StopTime.stop_sequence)
+    for trip_id, stop_id in q:
+        if trip_id in trips:
+            stops.setdefault(trip_id, []).append(stop_id)
+    return [(t, trips[t], stops[t]) for t in sorted(stops)]
+
+
+def main():
+    ''' bench_rt: replay synthetic feeds through the loader, and report its throughput and memory
+    '''
+    p = OptionParser(usage='usage: %prog [options] [-- loader options]')
+    p.add_option('-d', '--database', default=None, dest='dsn',
+                 help='Database connection string (default is a throw-away SQLite database)')
+    p.add_option('--vehicles', default=1000, type='int', help='Vehicles in the fleet (default=1000)')
+    p.add_option('--stops', default=50, type='int', help='Stops per trip (default=50)')
+    p.add_option('--alerts', default=20, type='int', help='Number of alerts (default=20)')
+    p.add_option('--churn', default=0.2, type='float', help='Fraction of the fleet that changes each cycle (default=0.2)')
+    p.add_option('--cycles', default=5, type='int', help='Number of cycles of the feeds to load (default=5)')
+    p.add_option('--interval', default=30, type='int', help='Seconds between cycles (default=30)')
+    p.add_option('--seed', default=None, type='int', help='Random seed (for repeatable feeds)')
+    p.add_option('--gtfsdb', default=None, dest='gtfsdb', metavar='URL',
+                 help='Derive the trips, routes and stops from this gtfsdb database')
+    p.add_option('-s', '--schema', default=None, dest='schema', help='gtfsdb database schema')
+    p.add_option('--archive', default=None, dest='archive', metavar='DIR',
+                 help='Keep the generated feeds in this (replay) archive directory')
+    opts, args = p.parse_args()
+
+    tmp = tempfile.mkdtemp(prefix='bench_rt')
+    try:
+        trips = None
+        if opts.gtfsdb:
+            trips = from_gtfsdb(opts.gtfsdb, opts.schema, opts.vehicles * 2)
+
+        # step 1: generate the feeds (one cycle's worth per replay payload)
+        st = time.time()
+        archive = opts.archive or os.path.join(tmp, 'archive')
+        recorder = Recorder(archive)
+        sf = SyntheticFeeds(opts.vehicles, opts.stops, opts.alerts, opts.churn, opts.interval, trips, opts.seed)
+        size = 0
+        for c in range(opts.cycles):
+            if c > 0:
+                sf.step()
+            for feed, fm in sorted(sf.feeds().items()):
+                raw = fm.SerializeToString()
+                size += len(raw)
+                recorder.record(feed, raw, sf.timestamp)
+        stus = sum(len(e.trip_update.stop_time_update) for e in sf.trip_updates().entity)
+        print "Generated {0} cycles of {1} vehicles ({2} stop time updates per cycle), {3:.1f} MB in {4:.2f}s".format(
+              opts.cycles, opts.vehicles, stus, size / 1048576.0, time.time() - st)
+
+        # step 2: replay them through the loader (in its own process, so its memory can be measured)
+        dsn = opts.dsn or 'sqlite:///' + os.path.join(tmp, 'bench.db')
+        cmd = [sys.executable, '-m', 'ott.data.gtfsrdb.gtfsrdb', '-d', dsn, '-c', '-o', '--replay', archive] + args
+        st = time.time()
+        ret_val = subprocess.call(cmd)
+        secs = time.time() - st
+        maxrss = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+        print "Loader took {0:.2f}s (including startup), peak RSS {1:.1f} MB".format(secs, maxrss / 1024.0)
+        return ret_val
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,91 @@
+''' local http server for the fetcher & loader tests ... serves a feed with an ETag and Last-Modified, gzips it
+    when asked, answers conditional requests with a 304, and sends the redirects in REDIRECTS
+'''
+import gzip
+import hashlib
+import unittest
+import threading
+from StringIO import StringIO
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+
+FEED = 'feed bytes ' * 1000
+LAST_MODIFIED = 'Tue, 13 May 2014 22:13:20 GMT'
+
+# path -> (status, location) of the redirects the server sends
+REDIRECTS = {
+    '/moved': (302, '/feed.pb?key=value'),
+    '/gone': (301, '/moved'),
+}
+
+
+def etag(body):
+    ''' @return: the ETag the server sends with this body (so a new body gets a new ETag)
+    '''
+    return '"{0}"'.format(hashlib.sha1(body).hexdigest())
+
+
+def gzipped(data):
+    buf = StringIO()
+    f = gzip.GzipFile(fileobj=buf, mode='wb')
+    f.write(data)
+    f.close()
+    return buf.getvalue()
+
+
+class FeedHandler(BaseHTTPRequestHandler):
+    ''' serves server.body
+    '''
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        self.server.requests.append(dict(self.headers))
+        self.server.paths.append(self.path)
+        self.server.clients.add(self.client_address)
+        if self.path in REDIRECTS:
+            status, location = REDIRECTS[self.path]
+            self.send_response(status)
+            self.send_header('Location', location)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        if self.headers.get('If-None-Match') == etag(self.server.body):
+            self.send_response(304)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+
+        body = self.server.body
+        self.send_response(200)
+        if 'gzip' in self.headers.get('Accept-Encoding', ''):
+            body = gzipped(body)
+            self.send_header('Content-Encoding', 'gzip')
+        self.send_header('ETag', etag(self.server.body))
+        self.send_header('Last-Modified', LAST_MODIFIED)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.server.bytes_sent += len(body)
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FeedServerTestCase(unittest.TestCase):
+    ''' starts a FeedHandler server (serving FEED) for each test ... self.root is its http://host:port
+
+        NOTE: the server is single threaded, and waits on a client's keep-alive connection ... so close the fetchers
+              (or loaders) before it shuts down, e.g., via addCleanup(), which runs them before the server's
+    '''
+    def setUp(self):
+        self.server = HTTPServer(('127.0.0.1', 0), FeedHandler)
+        self.server.body = FEED
+        self.server.requests = []
+        self.server.paths = []
+        self.server.clients = set()
+        self.server.bytes_sent = 0
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        self.root = 'http://127.0.0.1:{0}'.format(self.server.server_address[1])
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
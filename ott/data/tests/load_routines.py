@@ -33,3 +33,30 @@ def stops(num, session):
     end = time.time()
     out = "Total time {:.3f} seconds (for {} stops)\n\n{}".format(end-st, num, out) 
     return out
+
+
+def alerts(num, session):
+    ''' measure the per-alert cost of the two alert read paths, for the alerts of N routes: AlertsDao.get_route_alerts()
+        (EntitySelector objects with their joined Alert, copied reflectively) vs. AlertsDao.get_route_alerts_via_columns()
+        (just the needed columns, as plain tuples)
+    '''
+    from ott.data.gtfsrdb.model import EntitySelector
+    from ott.data.dao.alerts_dao import AlertsDao
+    from datetime import datetime
+    import time
+
+    out = "Starting alerts benchmark @ {}\n\n".format(datetime.now())
+
+    q = session.query(EntitySelector.route_id).filter(EntitySelector.route_id != '').distinct().limit(num)
+    route_ids = [r[0] for r in q]
+    for name, get_alerts in (('orm', AlertsDao.get_route_alerts), ('columns', AlertsDao.get_route_alerts_via_columns)):
+        count = 0
+        session.expunge_all()
+        st = time.time()
+        for route_id in route_ids:
+            count += len(get_alerts(session, route_id))
+        secs = time.time() - st
+        out += "{}: {:.3f} seconds for {} alerts on {} routes ({:.3f} ms per alert)\n".format(
+               name, secs, count, len(route_ids), secs * 1000.0 / max(count, 1))
+    return out
+
@@ -0,0 +1,133 @@
+import time
+import unittest
+
+from ott.data.gtfsrdb.fetcher import FeedFetcher, FeedResponse, FeedJob, run_jobs
+from ott.data.tests.feed_server import FeedServerTestCase, FEED, LAST_MODIFIED, etag
+
+ETAG = etag(FEED)
+
+
+class TestFetcher(FeedServerTestCase):
+    def setUp(self):
+        super(TestFetcher, self).setUp()
+        self.url = self.root + '/feed.pb?key=value'
+
+    def test_gzip(self):
+        f = FeedFetcher(self.url)
+        resp = f.fetch()
+        f.close()
+        self.assertEqual(resp.raw, FEED)
+        self.assertEqual(resp.etag, ETAG)
+        self.assertEqual(resp.last_modified, LAST_MODIFIED)
+        self.assertEqual(f.bytes_received, self.server.bytes_sent)
+        self.assertLess(f.bytes_received, len(FEED))
+        self.assertEqual(f.bytes_decoded, len(FEED))
+
+    def test_conditional(self):
+        f = FeedFetcher(self.url)
+        first = f.fetch()
+        second = f.fetch(first.etag, first.last_modified)
+        f.close()
+        self.assertFalse(first.not_modified)
+        self.assertTrue(second.not_modified)
+        self.assertEqual(f.not_modified, 1)
+        self.assertEqual(self.server.requests[1]['if-none-match'], ETAG)
+        self.assertEqual(self.server.requests[1]['if-modified-since'], LAST_MODIFIED)
+        self.assertEqual(f.bytes_received, self.server.bytes_sent)
+
+    def test_open(self):
+        f = FeedFetcher(self.url)
+        resp = f.open()
+        self.assertFalse(resp.not_modified)
+        self.assertIsNone(resp.raw)
+        self.assertEqual(resp.etag, ETAG)
+        self.assertEqual(resp.stream.read(100), FEED[:100])
+        self.assertEqual(resp.stream.read(), FEED[100:])
+        self.assertEqual(f.bytes_received, self.server.bytes_sent)
+        self.assertEqual(f.bytes_decoded, len(FEED))
+
+        # the connection is still good for the next (conditional) request
+        self.assertTrue(f.open(resp.etag).not_modified)
+        self.assertEqual(f.connections, 1)
+        f.close()
+
+    def test_keep_alive(self):
+        f = FeedFetcher(self.url)
+        for i in range(5):
+            f.fetch()
+        self.assertEqual(f.requests, 5)
+        self.assertEqual(f.connections, 1)
+        self.assertEqual(len(self.server.clients), 1)
+
+        # server drops the connection ... fetcher reconnects
+        f.conn.sock.close()
+        self.assertEqual(f.fetch().raw, FEED)
+        self.assertEqual(f.connections, 2)
+        f.close()
+
+    def test_redirect(self):
+        ''' a temporary redirect is followed each time, a permanent one re-points the fetcher
+        '''
+        f = FeedFetcher(self.root + '/moved')
+        self.assertEqual(f.fetch().raw, FEED)
+        self.assertEqual(f.open().stream.read(), FEED)
+        self.assertEqual(self.server.paths, ['/moved', '/feed.pb?key=value'] * 2)
+        self.assertEqual(f.url, self.url)
+        f.close()
+
+        del self.server.paths[:]
+        f = FeedFetcher(self.root + '/gone')
+        self.assertEqual(f.fetch().raw, FEED)
+        self.assertEqual(f.fetch().raw, FEED)
+        self.assertEqual(self.server.paths, ['/gone', '/moved', '/feed.pb?key=value', '/moved', '/feed.pb?key=value'])
+        f.close()
+
+    def test_proxy(self):
+        ''' http_proxy from the environment ... the test server plays the proxy
+        '''
+        import os
+        saved = dict(os.environ)
+        os.environ['http_proxy'] = self.root
+        os.environ.pop('no_proxy', None)
+        os.environ.pop('NO_PROXY', None)
+        try:
+            f = FeedFetcher('http://feeds.example.com/feed.pb')
+            self.assertEqual(f.fetch().raw, FEED)
+            f.close()
+        finally:
+            os.environ.clear()
+            os.environ.update(saved)
+        self.assertEqual(self.server.paths, ['http://feeds.example.com/feed.pb'])
+        self.assertEqual(self.server.requests[0]['host'], 'feeds.example.com')
+
+    def test_deflate(self):
+        import zlib
+        self.assertEqual(FeedFetcher.decode(zlib.compress(FEED), 'deflate'), FEED)
+        raw = zlib.compressobj(9, zlib.DEFLATED, -zlib.MAX_WBITS)
+        self.assertEqual(FeedFetcher.decode(raw.compress(FEED) + raw.flush(), 'deflate'), FEED)
+
+
+class TestFeedJobs(unittest.TestCase):
+    def test_timeouts(self):
+        ''' a slow feed times out on its own, without holding up the fast one
+        '''
+        class Fetcher(object):
+            def fetch(self, etag=None, last_modified=None):
+                return FeedResponse(FEED)
+
+        def slow(raw):
+            time.sleep(2)
+            return 'slow'
+
+        start = time.time()
+        jobs = run_jobs([FeedJob('alerts', Fetcher(), slow, timeout=0.2),
+                         FeedJob('vehicle_positions', Fetcher(), lambda raw: 'fast', timeout=0.5)])
+        self.assertLess(time.time() - start, 1.0)
+        self.assertTrue(isinstance(jobs[0].error, IOError))
+        self.assertIsNone(jobs[1].error)
+        self.assertEqual(jobs[1].fm, 'fast')
+
+        # a job that recognizes its bytes from the last load doesn't decode them
+        job = run_jobs([FeedJob('alerts', Fetcher(), slow, unchanged=lambda raw: True)])[0]
+        self.assertTrue(job.same_content)
+        self.assertIsNone(job.fm)
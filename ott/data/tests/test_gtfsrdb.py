@@ -0,0 +1,1064 @@
+import zlib
+import datetime
+import hashlib
+import unittest
+from StringIO import StringIO
+
+from sqlalchemy import create_engine, event, inspect
+from sqlalchemy.orm import sessionmaker
+
+from ott.data.gtfsrdb import bulk
+from ott.data.gtfsrdb import decoder
+from ott.data.gtfsrdb import diff
+from ott.data.gtfsrdb import generations
+from ott.data.gtfsrdb import loader
+from ott.data.gtfsrdb import memory
+from ott.data.gtfsrdb import metrics
+from ott.data.gtfsrdb import pipeline
+from ott.data.gtfsrdb import query
+from ott.data.gtfsrdb import replay
+from ott.data.gtfsrdb import scheduler
+from ott.data.gtfsrdb import synthetic
+from ott.data.gtfsrdb import stream
+from ott.data.gtfsrdb import summary
+from ott.data.gtfsrdb import model
+from ott.data.gtfsrdb import gtfs_realtime_pb2
+from ott.data.tests.feed_server import FeedServerTestCase, LAST_MODIFIED, etag
+
+
+def make_trip_updates(num_trips=3, num_stops=4, timestamp=1400000000):
+    ''' small TripUpdates FeedMessage for testing the loader
+    '''
+    fm = gtfs_realtime_pb2.FeedMessage()
+    fm.header.gtfs_realtime_version = '1.0'
+    fm.header.timestamp = timestamp
+    for t in range(num_trips):
+        e = fm.entity.add()
+        e.id = str(t)
+        tu = e.trip_update
+        tu.trip.trip_id = 'trip{0}'.format(t)
+        tu.trip.route_id = str(t % 2)
+        tu.trip.start_date = '20140513'
+        tu.vehicle.id = 'bus{0}'.format(t)
+        for s in range(num_stops):
+            stu = tu.stop_time_update.add()
+            stu.stop_sequence = s + 1
+            stu.stop_id = str(100 + s)
+            stu.arrival.delay = 60 * t
+            stu.departure.time = timestamp + 120 * s
+    return fm
+
+
+def make_vehicle_positions(num_vehicles=3, timestamp=1400000000):
+    fm = gtfs_realtime_pb2.FeedMessage()
+    fm.header.gtfs_realtime_version = '1.0'
+    fm.header.timestamp = timestamp
+    for v in range(num_vehicles):
+        e = fm.entity.add()
+        e.id = str(v)
+        vp = e.vehicle
+        vp.trip.trip_id = 'trip{0}'.format(v)
+        vp.vehicle.id = 'bus{0}'.format(v)
+        vp.position.latitude = 45.5
+        vp.position.longitude = -122.6 + v
+    return fm
+
+
+def make_alerts(num_alerts=2, timestamp=1400000000):
+    fm = gtfs_realtime_pb2.FeedMessage()
+    fm.header.gtfs_realtime_version = '1.0'
+    fm.header.timestamp = timestamp
+    for a in range(num_alerts):
+        e = fm.entity.add()
+        e.id = str(a)
+        alert = e.alert
+        p = alert.active_period.add()
+        p.start = timestamp - 3600
+        p.end = timestamp + 3600
+        alert.header_text.translation.add().text = 'alert {0}'.format(a)
+        alert.description_text.translation.add().text = 'description {0}'.format(a)
+        alert.url.translation.add().text = 'http://example.com'
+        for r in range(a + 1):
+            ie = alert.informed_entity.add()
+            ie.route_id = str(r)
+            ie.stop_id = str(100 + r)
+    return fm
+
+
+class TestDecoder(unittest.TestCase):
+    def test_columns(self):
+        fm = make_trip_updates(3, 4)
+        fm.entity[1].trip_update.trip.schedule_relationship = gtfs_realtime_pb2.TripDescriptor.ADDED
+        b = decoder.decode(fm)
+        self.assertEqual(len(b.trip_updates), 3)
+        self.assertEqual(len(b.stop_time_updates), 12)
+        self.assertEqual(len(b.vehicle_positions), 0)
+        self.assertEqual(len(b.alerts), 0)
+        self.assertEqual(b.trip_updates['trip_id'], ['trip0', 'trip1', 'trip2'])
+        self.assertEqual(b.trip_updates['schedule_relationship'], ['SCHEDULED', 'ADDED', 'SCHEDULED'])
+        self.assertEqual(list(b.stop_time_updates['trip_update_id']), [0] * 4 + [1] * 4 + [2] * 4)
+        self.assertEqual(list(b.stop_time_updates['arrival_delay'][::4]), [0, 60, 120])
+        self.assertEqual(b.stop_time_updates['schedule_relationship'][4], 'ADDED')
+
+    def test_mixed_feed(self):
+        fm = make_alerts(2)
+        fm.MergeFrom(make_vehicle_positions(3))
+        b = decoder.decode(fm, 'en')
+        self.assertEqual(len(b.alerts), 2)
+        self.assertEqual(len(b.entity_selectors), 3)
+        self.assertEqual(len(b.vehicle_positions), 3)
+        self.assertEqual(b.alerts['cause'], ['UNKNOWN_CAUSE'] * 2)
+        self.assertEqual(b.alerts['route_ids'], ['0', '0, 1'])
+        self.assertEqual(decoder.route_ids_by_alert(b), [['0'], ['0', '1']])
+        self.assertAlmostEqual(b.vehicle_positions['position_longitude'][2], -120.6, places=4)
+
+        rows = b.vehicle_positions.rows(generation=7)
+        self.assertEqual(rows[1]['vehicle_id'], 'bus1')
+        self.assertEqual(rows[1]['generation'], 7)
+
+
+class TestStream(unittest.TestCase):
+    def test_entities(self):
+        raw = make_trip_updates(50, 3).SerializeToString()
+        fs = stream.FeedStream(StringIO(raw))
+        self.assertEqual(fs.read_header().timestamp, 1400000000)
+        ids = [e.id for e in fs]
+        self.assertEqual(ids, [str(i) for i in range(50)])
+        self.assertEqual(fs.entities, 50)
+
+        # batches ... and unknown fields get skipped
+        raw = '\x48\x96\x01' + raw + '\x55\x01\x02\x03\x04'
+        sizes = [len(b) for b in stream.FeedStream(StringIO(raw)).batches(20)]
+        self.assertEqual(sizes, [20, 20, 10])
+
+        # truncated feed
+        fs = stream.FeedStream(StringIO(raw[:-100]))
+        self.assertRaises(IOError, list, fs)
+
+    def test_inflate(self):
+        raw = make_vehicle_positions(200).SerializeToString()
+        z = zlib.compressobj(9, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        gz = z.compress(raw) + z.flush()
+        received = stream.CountingReader(StringIO(gz))
+        decoded = stream.CountingReader(stream.InflateReader(received, 'gzip'))
+        fs = stream.FeedStream(decoded)
+        self.assertEqual(len(list(fs)), 200)
+        self.assertEqual(received.bytes, len(gz))
+        self.assertEqual(decoded.bytes, len(raw))
+        self.assertEqual(decoded.hexdigest(), hashlib.sha1(raw).hexdigest())
+
+        decoded = stream.InflateReader(StringIO(zlib.compress(raw)), 'deflate')
+        self.assertEqual(decoded.read(), raw)
+
+
+class DatabaseTestCase(unittest.TestCase):
+    ''' each test gets its own (in-memory) database with the realtime tables, and a session on it
+    '''
+    def setUp(self):
+        self.engine = create_engine('sqlite://')
+        model.Base.metadata.create_all(self.engine)
+        self.session = sessionmaker(bind=self.engine)()
+
+    def tearDown(self):
+        self.session.close()
+
+
+class TestBulkWriter(DatabaseTestCase):
+    def test_trip_updates(self):
+        n = bulk.write_trip_updates(self.session, make_trip_updates(3, 4))
+        self.session.commit()
+        self.assertEqual(n, 3 + 3*4)
+        for tu in self.session.query(model.TripUpdate):
+            self.assertEqual(len(tu.StopTimeUpdates), 4)
+            self.assertEqual(tu.schedule_relationship, 'SCHEDULED')
+
+        # second load keeps the foreign keys pointed at the right (new) parents
+        bulk.write_trip_updates(self.session, make_trip_updates(2, 1))
+        self.session.commit()
+        self.assertEqual(self.session.query(model.TripUpdate).count(), 5)
+        self.assertEqual(self.session.query(model.StopTimeUpdate).count(), 14)
+        counts = sorted([len(tu.StopTimeUpdates) for tu in self.session.query(model.TripUpdate)])
+        self.assertEqual(counts, [1, 1, 4, 4, 4])
+
+    def test_stream(self):
+        fs = stream.FeedStream(StringIO(make_trip_updates(25, 4).SerializeToString()))
+        n = bulk.write_stream(self.session, 'trip_updates', fs, 1, batch_size=10)
+        self.session.commit()
+        self.assertEqual(n, 25 + 25*4)
+        for tu in self.session.query(model.TripUpdate):
+            self.assertEqual(len(tu.StopTimeUpdates), 4)
+            self.assertEqual(tu.StopTimeUpdates[0].trip_update_id, tu.oid)
+
+    def test_vehicle_positions(self):
+        n = bulk.write_vehicle_positions(self.session, make_vehicle_positions(5))
+        self.session.commit()
+        self.assertEqual(n, 5)
+        self.assertEqual(self.session.query(model.VehiclePosition).count(), 5)
+
+    def test_alerts(self):
+        bulk.write_alerts(self.session, make_alerts(2), 'en', lambda ids: 'short')
+        self.session.commit()
+        alerts = self.session.query(model.Alert).order_by(model.Alert.oid).all()
+        self.assertEqual([len(a.InformedEntities) for a in alerts], [1, 2])
+        self.assertEqual(alerts[1].route_ids, '0, 1')
+        self.assertEqual(alerts[1].route_short_names, 'short')
+        self.assertEqual(alerts[0].header_text, 'alert 0')
+        self.assertEqual([len(a.ActivePeriods) for a in alerts], [1, 1])
+
+    def test_active_periods(self):
+        ''' every active period gets a row, and an alert without any is active all the time
+        '''
+        fm = make_alerts(3)
+        p = fm.entity[0].alert.active_period.add()
+        p.start = 1400000000 + 7200
+        p.end = 0
+        del fm.entity[2].alert.active_period[:]
+        bulk.write_alerts(self.session, fm, 'en')
+        self.session.commit()
+        self.assertEqual(self.session.query(model.AlertPeriod).count(), 4)
+
+        def active(when, **kw):
+            return sorted(set(s.Alert.header_text for s in query.active_at(self.session, when, **kw)))
+        self.assertEqual(active(1400000000), ['alert 0', 'alert 1', 'alert 2'])
+        self.assertEqual(active(1400000000 + 5000), ['alert 2'])
+        self.assertEqual(active(2000000000), ['alert 0', 'alert 2'])
+        self.assertEqual(active(2000000000, stop_id='101'), ['alert 2'])
+        self.assertEqual(active(1400000000, route_id='1'), ['alert 1', 'alert 2'])
+
+        # the AlertIndex gives the same answers, from its in-memory ActivePeriods
+        index = query.AlertIndex(self.engine)
+        self.assertTrue(index.refresh())
+        oids = dict((a.header_text, a.oid) for a in self.session.query(model.Alert))
+        self.assertEqual(index.periods.at(1400000000 + 5000), frozenset([oids['alert 2']]))
+        self.assertEqual(index.periods.at(2000000000), frozenset([oids['alert 0'], oids['alert 2']]))
+        query.alert_index = index
+        try:
+            self.assertEqual(active(1400000000), ['alert 0', 'alert 1', 'alert 2'])
+            self.assertEqual(active(1400000000 + 5000), ['alert 2'])
+            self.assertEqual(active(2000000000, stop_id='101'), ['alert 2'])
+            self.assertEqual(active(1400000000, route_id='1'), ['alert 1', 'alert 2'])
+            self.assertEqual(active(1400000000, route_id='1', stop_id='100'), [])
+        finally:
+            query.alert_index = None
+        self.assertEqual(query.ActivePeriods([(1, 10, 20)]).at(9), frozenset())
+        self.assertEqual(query.ActivePeriods([(1, 10, 20)]).at(20), frozenset([1]))
+        self.assertEqual(query.ActivePeriods([(1, 10, 20)]).at(21), frozenset())
+
+    def test_many_rows(self):
+        ''' more rows than fit in a single multi-row insert
+        '''
+        bulk.write_trip_updates(self.session, make_trip_updates(300, 10))
+        self.session.commit()
+        self.assertEqual(self.session.query(model.StopTimeUpdate).count(), 3000)
+
+
+class TestGenerations(DatabaseTestCase):
+    def load(self, num_trips):
+        gen = generations.next_generation(self.session, 'trip_updates')
+        bulk.write_trip_updates(self.session, make_trip_updates(num_trips, 2), gen)
+        generations.flip(self.session, 'trip_updates', gen)
+        self.session.commit()
+        return gen
+
+    def current_trips(self):
+        return self.session.query(model.TripUpdate).filter(generations.is_current(model.TripUpdate, 'trip_updates')).count()
+
+    def test_flip(self):
+        g1 = self.load(3)
+        self.assertEqual(self.current_trips(), 3)
+        g2 = self.load(5)
+        self.assertGreater(g2, g1)
+        self.assertEqual(generations.current(self.session, 'trip_updates'), g2)
+        self.assertEqual(self.current_trips(), 5)
+        self.assertEqual(self.session.query(model.TripUpdate).count(), 8)
+
+    def test_collect(self):
+        self.load(3)
+        self.load(4)
+        self.load(5)
+
+        # everything has been superseded for less than the grace period, so nothing goes
+        self.assertEqual(generations.collect(self.session, 'trip_updates', grace=3600), 0)
+
+        # no grace period ... only the current generation is left
+        n = generations.collect(self.session, 'trip_updates', grace=0)
+        self.session.commit()
+        self.assertEqual(n, (3 + 4) * 3)
+        self.assertEqual(self.session.query(model.TripUpdate).count(), 5)
+        self.assertEqual(self.session.query(model.StopTimeUpdate).count(), 10)
+        self.assertEqual(self.current_trips(), 5)
+
+
+class TestDiff(DatabaseTestCase):
+    def test_trip_updates(self):
+        d = diff.TripUpdateDiff()
+        counts = d.write_feed(self.session, make_trip_updates(3, 4), 1)
+        self.session.commit()
+        d.commit()
+        self.assertEqual(counts['inserted'], 3)
+
+        # same data, newer timestamp ... nothing to write
+        fm = make_trip_updates(3, 4)
+        fm.header.timestamp = 1400000030
+        counts = d.write_feed(self.session, fm, 1)
+        self.assertEqual(counts, dict(inserted=0, updated=0, deleted=0, unchanged=3))
+        d.commit()
+
+        # one trip changes, one goes away and a new one shows up
+        fm = make_trip_updates(4, 4)
+        fm.header.timestamp = 1400000060
+        del fm.entity[0]
+        fm.entity[0].trip_update.stop_time_update[0].arrival.delay = 300
+        counts = d.write_feed(self.session, fm, 1)
+        self.session.commit()
+        d.commit()
+        self.assertEqual(counts, dict(inserted=1, updated=1, deleted=1, unchanged=1))
+
+        trips = self.session.query(model.TripUpdate).order_by(model.TripUpdate.trip_id).all()
+        self.assertEqual([t.trip_id for t in trips], ['trip1', 'trip2', 'trip3'])
+        self.assertEqual([len(t.StopTimeUpdates) for t in trips], [4, 4, 4])
+        self.assertEqual(self.session.query(model.StopTimeUpdate).count(), 12)
+        self.assertIn(300, [s.arrival_delay for s in trips[0].StopTimeUpdates])
+
+    def test_reseed(self):
+        ''' a new (or reset) differ picks up the oids of what's already in the database
+        '''
+        diff.VehiclePositionDiff().write_feed(self.session, make_vehicle_positions(3), 1)
+        self.session.commit()
+        counts = diff.VehiclePositionDiff().write_feed(self.session, make_vehicle_positions(4), 1)
+        self.session.commit()
+        self.assertEqual(counts['inserted'], 1)
+        self.assertEqual(counts['updated'], 3)
+        self.assertEqual(self.session.query(model.VehiclePosition).count(), 4)
+
+    def test_no_vehicle_ids(self):
+        ''' vehicles without a vehicle.id are keyed by their entity id, rather than dropped as duplicates
+        '''
+        fm = make_vehicle_positions(3)
+        fm.entity[0].vehicle.vehicle.id = ''
+        fm.entity[1].vehicle.vehicle.id = ''
+        d = diff.VehiclePositionDiff()
+        counts = d.write_feed(self.session, fm, 1)
+        self.session.commit()
+        d.commit()
+        self.assertEqual(counts['inserted'], 3)
+        self.assertEqual(self.session.query(model.VehiclePosition).count(), 3)
+
+        fm.entity[1].vehicle.position.latitude = 45.6
+        counts = d.write_feed(self.session, fm, 1)
+        self.session.commit()
+        self.assertEqual(counts, dict(inserted=0, updated=1, deleted=0, unchanged=2))
+        self.assertEqual(self.session.query(model.VehiclePosition).count(), 3)
+
+        # a new differ (e.g., after a restart or a rollback) can't tell the id-less rows apart ... but doesn't leave any behind
+        counts = diff.VehiclePositionDiff().write_feed(self.session, fm, 1)
+        self.session.commit()
+        self.assertEqual(counts, dict(inserted=2, updated=1, deleted=2, unchanged=0))
+        self.assertEqual(self.session.query(model.VehiclePosition).count(), 3)
+
+
+class TestAlertQueries(DatabaseTestCase):
+    def setUp(self):
+        super(TestAlertQueries, self).setUp()
+        fm = make_alerts(3)
+        fm.entity[2].alert.informed_entity.add().route_id = '0'
+        bulk.write_alerts(self.session, fm, 'en')
+        self.session.commit()
+
+    def test_batches(self):
+        ''' one query for many routes / stops
+        '''
+        statements = []
+        def count(conn, cursor, statement, parameters, context, executemany):
+            statements.append(statement)
+        query.okay_to_query(self.session)
+        event.listen(self.engine, 'before_cursor_execute', count)
+
+        routes = query.via_route_ids(self.session, ['0', '2', '9'])
+        self.assertEqual(dict((k, len(v)) for k, v in routes.items()), {'0': 4, '2': 1, '9': 0})
+        stops = query.via_stop_ids(self.session, ['101', '102'])
+        self.assertEqual(dict((k, len(v)) for k, v in stops.items()), {'101': 2, '102': 1})
+        stop, routes = query.via_stop_and_route_ids(self.session, '102', ['1'])
+        self.assertEqual([s.Alert.header_text for s in stop], ['alert 2'])
+        self.assertEqual(sorted(s.Alert.header_text for s in routes['1']), ['alert 1', 'alert 2'])
+        self.assertEqual(len(statements), 3)
+
+    def test_no_generations(self):
+        ''' a database that pre-dates generations (no generations table) still has its alerts read
+        '''
+        self.engine.execute('DROP TABLE generations')
+        query.capabilities.invalidate()
+        try:
+            self.assertEqual(len(query.via_route_id(self.session, '0')), 4)
+            self.assertEqual(len(query.alert_rows(self.session, route_id='0')), 3)
+        finally:
+            query.capabilities.invalidate()
+
+    def test_rows(self):
+        ''' just the columns, and one row per alert
+        '''
+        rows = query.alert_rows(self.session, route_id='0')
+        self.assertEqual([r.header_text for r in rows], ['alert 0', 'alert 1', 'alert 2'])
+        self.assertEqual(len(rows[0]), len(query.ALERT_ROW_COLUMNS))
+        self.assertEqual((rows[1].route_id, rows[1].stop_id, rows[1].route_ids), ('0', '100', '0, 1'))
+        self.assertEqual(len(query.alert_rows(self.session, stop_id='102')), 1)
+
+
+class TestCapabilities(unittest.TestCase):
+    def test_cache(self):
+        ''' missing tables are cached too, until the ttl runs out, or the cache is invalidated
+        '''
+        engine = create_engine('sqlite://')
+        caps = query.Capabilities(ttl=60)
+        self.assertEqual(caps.tables(engine, 1000), frozenset())
+        model.Base.metadata.create_all(engine)
+        self.assertFalse(caps.has(engine, ['alerts'], 1001))
+        self.assertEqual(caps.tables(engine, 1059), frozenset())
+        self.assertEqual(caps.tables(engine, 1061), frozenset(query.REALTIME_TABLES))
+
+        engine.execute('DROP TABLE vehicle_positions')
+        self.assertTrue(caps.has(engine, ['vehicle_positions'], 1062))
+        caps.invalidate(engine)
+        self.assertFalse(caps.has(engine, ['vehicle_positions'], 1063))
+        self.assertTrue(caps.has(engine, ['alerts', 'entity_selectors', 'generations'], 1063))
+
+
+class TestAlertIndex(DatabaseTestCase):
+    def load(self, num_alerts):
+        gen = generations.next_generation(self.session, 'alerts')
+        bulk.write_alerts(self.session, make_alerts(num_alerts), 'en', generation=gen)
+        generations.flip(self.session, 'alerts', gen)
+        self.session.commit()
+
+    def test_refresh(self):
+        self.load(2)
+        index = query.AlertIndex(self.engine)
+        self.assertTrue(index.refresh())
+        self.assertEqual([s.Alert.header_text for s in index.via_route_id('1')], ['alert 1'])
+        self.assertEqual(len(index.via_stop_id('100')), 2)
+        self.assertEqual(index.via_route_id('9'), [])
+
+        # nothing changed, so no reload
+        self.assertFalse(index.refresh())
+
+        # a new load (of a new generation) is picked up
+        self.load(3)
+        self.assertTrue(index.refresh())
+        self.assertEqual(len(index.via_stop_id('100')), 3)
+        self.assertEqual([s.Alert.header_text for s in index.via_route_id('2')], ['alert 2'])
+
+        # and answers via_route_id()
+        query.alert_index = index
+        try:
+            self.assertEqual(len(query.via_route_id(self.session, '0')), 3)
+        finally:
+            query.alert_index = None
+
+    def test_other_engine(self):
+        ''' sessions on another database get that database's alerts, not the index's
+        '''
+        self.load(2)
+        other = create_engine('sqlite://')
+        model.Base.metadata.create_all(other)
+        session = sessionmaker(bind=other)()
+        query.alert_index = query.AlertIndex(self.engine)
+        try:
+            self.assertTrue(query.alert_index.refresh())
+            self.assertEqual(len(query.via_stop_id(self.session, '100')), 2)
+            self.assertEqual(query.via_stop_id(session, '100'), [])
+            self.assertEqual(query.via_route_ids(session, ['0']), {'0': []})
+        finally:
+            query.alert_index = None
+            session.close()
+
+    def test_detached(self):
+        ''' everything AlertsDao.init_via_alert() reads is loaded with the (detached) selectors
+        '''
+        self.load(2)
+        index = query.AlertIndex(self.engine)
+        index.refresh()
+        s = index.via_route_id('1')[0]
+        r = query.alert_row(s)
+        self.assertEqual((r.alert_id, r.route_id, r.stop_id, r.header_text), (s.alert_id, '1', '101', 'alert 1'))
+        self.assertEqual(r._fields, tuple(c.key for c in query.ALERT_ROW_COLUMNS))
+        self.assertEqual(len(s.Alert.ActivePeriods), 1)
+        self.assertEqual(len(s.Alert.InformedEntities), 2)
+
+
+class TestPredictions(DatabaseTestCase):
+    def load(self, fm):
+        gen = generations.next_generation(self.session, 'trip_updates')
+        bulk.write_trip_updates(self.session, fm, gen)
+        generations.flip(self.session, 'trip_updates', gen)
+        self.session.commit()
+
+    def test_stop(self):
+        self.load(make_trip_updates(3, 4))
+        date = datetime.date(2014, 5, 13)
+        p = query.stop_predictions(self.session, '102', date)
+        self.assertEqual(sorted(p), [('trip0', '20140513', 3), ('trip1', '20140513', 3), ('trip2', '20140513', 3)])
+        r = query.find_prediction(p, 'trip1', date, 3)
+        self.assertEqual((r.arrival_delay, r.departure_time), (60, 1400000000 + 240))
+        self.assertEqual(query.find_prediction(p, 'trip1', date, 4), None)
+        self.assertEqual(query.find_prediction(p, 'trip1', datetime.date(2014, 5, 14), 3), None)
+        self.assertEqual(query.stop_predictions(self.session, '102', datetime.date(2014, 5, 14)), {})
+
+        # just the current generation's predictions
+        self.load(make_trip_updates(1, 4))
+        self.assertEqual([k[0] for k in query.stop_predictions(self.session, '102')], ['trip0'])
+
+    def test_loop(self):
+        ''' a trip that visits the stop twice has a prediction for each visit ... and a prediction without a date
+            or stop_sequence matches any
+        '''
+        fm = make_trip_updates(2, 2)
+        fm.entity[0].trip_update.stop_time_update[1].stop_id = '100'
+        fm.entity[1].trip_update.trip.start_date = ''
+        fm.entity[1].trip_update.stop_time_update[0].ClearField('stop_sequence')
+        self.load(fm)
+        date = datetime.date(2014, 5, 13)
+        p = query.stop_predictions(self.session, '100', date)
+        self.assertEqual(query.find_prediction(p, 'trip0', date, 1).departure_time, 1400000000)
+        self.assertEqual(query.find_prediction(p, 'trip0', date, 2).departure_time, 1400000000 + 120)
+        self.assertEqual(query.find_prediction(p, 'trip1', date, 7).arrival_delay, 60)
+
+    def test_predicted_time(self):
+        ''' delays that cross midnight roll over into the day
+        '''
+        fm = make_trip_updates(2, 1)
+        for e, delay in zip(fm.entity, (300, -300)):
+            stu = e.trip_update.stop_time_update[0]
+            stu.ClearField('departure')
+            stu.arrival.delay = delay
+        self.load(fm)
+        date = datetime.date(2014, 5, 13)
+        p = query.stop_predictions(self.session, '100', date)
+        late = query.find_prediction(p, 'trip0', date, 1)
+        early = query.find_prediction(p, 'trip1', date, 1)
+        self.assertEqual(query.predicted_time('23:58:00', late), '00:03:00')
+        self.assertEqual(query.predicted_time('24:10:00', late), '00:15:00')
+        self.assertEqual(query.predicted_time('00:02:00', early), '23:57:00')
+        self.assertEqual(query.predicted_time('12:00:30', late), '12:05:30')
+
+
+class TestSummary(DatabaseTestCase):
+    def test_delays(self):
+        ''' trip0 (route 0) is on time ... a delay of 0 still counts as an arrival
+        '''
+        batches = decoder.decode(make_trip_updates(4, 3))
+        n = summary.DelaySummary().add(batches).write(self.session, 1)
+        self.session.commit()
+        self.assertEqual(n, 5)
+        r = query.route_delay(self.session, '1')
+        self.assertEqual((r.arrivals, r.avg_arrival_delay, r.max_arrival_delay), (6, 120.0, 180))
+        r = query.route_delay(self.session, '0')
+        self.assertEqual((r.arrivals, r.avg_arrival_delay, r.max_arrival_delay), (6, 60.0, 120))
+        s = query.stop_delay(self.session, '101')
+        self.assertEqual((s.arrivals, s.avg_arrival_delay, s.max_arrival_delay), (4, 90.0, 180))
+        self.assertEqual(query.route_delay(self.session, '9'), None)
+
+        # the next feed replaces the summaries
+        summary.DelaySummary().add(decoder.decode(make_trip_updates(2, 1))).write(self.session, 2)
+        self.session.commit()
+        self.assertEqual(self.session.query(model.RouteDelay).count(), 2)
+        self.assertEqual(query.stop_delay(self.session, '100').max_arrival_delay, 60)
+
+    def test_time_only(self):
+        ''' arrivals with just a predicted time (no delay) aren't counted ... and the flag isn't written
+        '''
+        fm = make_trip_updates(2, 2)
+        for stu in fm.entity[1].trip_update.stop_time_update:
+            stu.arrival.ClearField('delay')
+            stu.arrival.time = 1400000300
+        batches = decoder.decode(fm)
+        summary.DelaySummary().add(batches).write(self.session, 1)
+        self.session.commit()
+        self.assertEqual(query.route_delay(self.session, '1'), None)
+        self.assertEqual(query.route_delay(self.session, '0').arrivals, 2)
+        self.assertNotIn('arrival_has_delay', batches.stop_time_updates.rows()[0])
+
+
+class TestScheduler(unittest.TestCase):
+    def test_ticks(self):
+        now = [1000.5]
+        s = scheduler.Scheduler(clock=lambda: now[0])
+        s.add('vehicle_positions', 10)
+        s.add('alerts', 300)
+        self.assertEqual(sorted(s.due()), ['alerts', 'vehicle_positions'])
+
+        # ticks land on the clock, no matter how long the cycle took
+        now[0] = 1003.0
+        s.done(['alerts', 'vehicle_positions'])
+        self.assertEqual(s.next_tick['vehicle_positions'], 1010)
+        self.assertEqual(s.next_tick['alerts'], 1200)
+        self.assertEqual(s.due(), [])
+        self.assertEqual(s.due(1010), ['vehicle_positions'])
+
+        # a cycle that overruns two ticks gets them coalesced into the next one
+        now[0] = 1034.0
+        s.done(['vehicle_positions'])
+        self.assertEqual(s.next_tick['vehicle_positions'], 1040)
+        self.assertEqual(s.coalesced['vehicle_positions'], 2)
+        self.assertEqual(s.next_due(), 1040)
+
+    def test_cadence(self):
+        c = scheduler.Cadence(min_wait=5, max_wait=120)
+        self.assertIsNone(c.next_poll(1000))
+
+        # feed publishes every 30s, and we see each publish 2s later
+        for ts in (1000, 1030, 1060):
+            c.observe(ts, True, now=ts + 2)
+            c.observe(ts, False, now=ts + 12)
+        self.assertEqual(c.cadence, 30)
+        self.assertEqual(c.hit_rate, 0.5)
+
+        # next publish at 1090, plus 2s lag and 1s margin
+        self.assertEqual(c.next_poll(1072), 1093)
+
+        # missed that one ... aim for the following publish
+        self.assertEqual(c.next_poll(1095), 1123)
+
+        # bounds
+        self.assertEqual(c.next_poll(1090.5), 1095.5)
+        c.max_wait = 10
+        self.assertEqual(c.next_poll(1062), 1072)
+
+
+class TestMetrics(unittest.TestCase):
+    def test_export(self):
+        m = metrics.Metrics()
+        m.start_cycle()
+        with m.timer('trip_updates', 'write'):
+            pass
+        m.phase('trip_updates', 'fetch', 0.25)
+        m.phase('trip_updates', 'fetch', 0.5)
+        m.inc('gtfsrdb_rows_written_total', 15, feed='trip_updates')
+        m.result('trip_updates', 'loaded')
+        m.result('alerts', 'skipped')
+        cycle = m.end_cycle()
+
+        self.assertEqual(cycle['feeds']['trip_updates']['fetch_seconds'], 0.75)
+        self.assertEqual(cycle['feeds']['trip_updates']['result'], 'loaded')
+        self.assertEqual(cycle['feeds']['alerts']['result'], 'skipped')
+        self.assertTrue('write_seconds' in cycle['feeds']['trip_updates'])
+
+        text = m.prometheus()
+        self.assertTrue('# TYPE gtfsrdb_phase_seconds summary' in text)
+        self.assertTrue('gtfsrdb_phase_seconds_sum{feed="trip_updates",phase="fetch"} 0.75' in text)
+        self.assertTrue('gtfsrdb_phase_seconds_count{feed="trip_updates",phase="fetch"} 2' in text)
+        self.assertTrue('gtfsrdb_rows_written_total{feed="trip_updates"} 15' in text)
+        self.assertTrue('gtfsrdb_cycles_total{feed="alerts",result="skipped"} 1' in text)
+
+    def test_serve(self):
+        import json
+        from urllib2 import urlopen
+        m = metrics.Metrics()
+        m.start_cycle()
+        m.result('alerts', 'failed')
+        m.end_cycle()
+        server = m.serve(0, '127.0.0.1')
+        try:
+            url = 'http://127.0.0.1:{0}'.format(server.server_address[1])
+            self.assertTrue('gtfsrdb_cycles_total' in urlopen(url + '/metrics').read())
+            self.assertEqual(json.loads(urlopen(url + '/metrics.json').read())['feeds']['alerts']['result'], 'failed')
+        finally:
+            m.close()
+
+
+class Leak(object):
+    pass
+
+
+class TestMemory(unittest.TestCase):
+    def test_growth(self):
+        watch = memory.MemoryWatch(2, top=50)
+        try:
+            self.assertEqual([watch.cycle(), watch.cycle(), watch.cycle()], [None, None, None])
+            leaked = [Leak() for i in range(5000)]
+            report = watch.cycle()
+            self.assertTrue(report.startswith('Memory after 4 cycles'), report)
+            if memory.tracemalloc:
+                self.assertTrue('test_gtfsrdb.py' in report, report)
+            else:
+                self.assertTrue('Leak: +5000 objects' in report, report)
+        finally:
+            watch.close()
+
+
+class TestReplay(unittest.TestCase):
+    def setUp(self):
+        import tempfile
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.path)
+
+    def test_play(self):
+        r = replay.Recorder(self.path)
+        r.record('vehicle_positions', 'vp1', 1000.0)
+        r.record('trip_updates', 'tu1', 1000.5)
+        r.record('vehicle_positions', 'vp2', 1010.0)
+        r.record('trip_updates', 'tu2', 1030.0)
+
+        archive = replay.Archive(self.path)
+        self.assertEqual(archive.feeds(), ['trip_updates', 'vehicle_positions'])
+        payloads = archive.payloads()
+        self.assertEqual([open(p.path).read() for p in payloads], ['vp1', 'tu1', 'vp2', 'tu2'])
+        self.assertTrue(payloads[0].url.startswith('file:///'))
+        self.assertEqual([p.when for p in archive.payloads(['trip_updates'])], [1000.5, 1030.0])
+
+        # as fast as possible, and twice as fast as it was recorded
+        now = [0]
+        def sleep(secs):
+            now[0] += secs
+        list(archive.play(0, clock=lambda: now[0], sleep=sleep))
+        self.assertEqual(now[0], 0)
+        list(archive.play(2, clock=lambda: now[0], sleep=sleep))
+        self.assertEqual(now[0], 15)
+
+    def test_report(self):
+        m = metrics.Metrics()
+        m.inc('gtfsrdb_entities_total', 300, feed='trip_updates')
+        m.result('trip_updates', 'loaded')
+        m.phase('trip_updates', 'write', 1.5)
+        text = replay.report(m, 2.0, 'postgresql://localhost/db')
+        self.assertTrue('database: postgresql' in text)
+        self.assertTrue('150.0 entities/sec' in text)
+        self.assertTrue('1 loaded, 0 skipped' in text)
+
+
+class TestSynthetic(unittest.TestCase):
+    def test_feeds(self):
+        sf = synthetic.SyntheticFeeds(vehicles=100, stops=20, alerts=5, churn=0.25, seed=1, timestamp=1400000000)
+        feeds = sf.feeds()
+        self.assertEqual(len(feeds['trip_updates'].entity), 100)
+        self.assertEqual(len(feeds['vehicle_positions'].entity), 100)
+        self.assertEqual(len(feeds['alerts'].entity), 5)
+        self.assertEqual(sum(len(e.trip_update.stop_time_update) for e in feeds['trip_updates'].entity), 2000)
+
+        # about a quarter of the fleet changes each step ... the rest stays exactly the same
+        sf.step()
+        after = sf.vehicle_positions()
+        self.assertEqual(after.header.timestamp, 1400000030)
+        changed = len([1 for b, a in zip(feeds['vehicle_positions'].entity, after.entity) if b.vehicle.position != a.vehicle.position])
+        self.assertTrue(10 < changed < 40, changed)
+
+        # same seed, same feeds
+        again = synthetic.SyntheticFeeds(vehicles=100, stops=20, alerts=5, churn=0.25, seed=1, timestamp=1400000000)
+        self.assertEqual(again.trip_updates().SerializeToString(), feeds['trip_updates'].SerializeToString())
+
+
+class TestPipeline(unittest.TestCase):
+    def test_backpressure(self):
+        ''' a slow last stage fills the (bounded) queues, and then blocks the first stage
+        '''
+        import time
+        import Queue
+        import threading
+        q1 = Queue.Queue(2)
+        q2 = Queue.Queue(2)
+        done = Queue.Queue()
+        gate = threading.Event()
+
+        def slow(item):
+            gate.wait()
+            return item
+        pipeline.Stage('double', lambda i: i * 2, q1, q2).start()
+        pipeline.Stage('slow', slow, q2, done).start()
+
+        fed = []
+        def feed():
+            for i in range(10):
+                q1.put(i)
+                fed.append(i)
+            q1.put(pipeline.STOP)
+        t = threading.Thread(target=feed)
+        t.daemon = True
+        t.start()
+
+        time.sleep(0.2)
+        self.assertTrue(len(fed) < 10)
+
+        gate.set()
+        out = []
+        while True:
+            item = pipeline.get(done)
+            if item is pipeline.STOP:
+                break
+            out.append(item)
+        self.assertEqual(out, [i * 2 for i in range(10)])
+
+    def test_decode_pool(self):
+        raw = make_trip_updates(5, 3).SerializeToString()
+        for processes in (0, 1):
+            pool = pipeline.DecodePool(processes, 'en')
+            try:
+                header, batches, parse_secs, transform_secs = pool.decode(raw).get(10)
+            finally:
+                pool.close()
+            self.assertEqual(pipeline.header_message(header).header.timestamp, 1400000000)
+            self.assertEqual(len(batches.trip_updates), 5)
+            self.assertEqual(len(batches.stop_time_updates), 15)
+            self.assertEqual(batches.entities, 5)
+
+
+class TestLoader(unittest.TestCase):
+    def setUp(self):
+        import tempfile
+        self.path = tempfile.mkdtemp()
+        self.engine = create_engine('sqlite://')
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.path)
+
+    def url(self, name, fm):
+        import os
+        path = os.path.join(self.path, name)
+        with open(path, 'wb') as f:
+            f.write(fm.SerializeToString())
+        return 'file://' + path
+
+    def test_run_once(self):
+        ''' the loader runs in-process, against an engine it's handed
+        '''
+        rt = loader.RealtimeLoader(self.engine, create=True, deleteOld=True,
+                                   tripUpdates=self.url('tu.pb', make_trip_updates(3, 4)),
+                                   vehiclePositions=self.url('vp.pb', make_vehicle_positions(5)))
+        rt.setup()
+        self.assertTrue(rt.run_once())
+        session = rt.Session()
+        self.assertEqual(session.query(model.TripUpdate).filter(generations.is_current(model.TripUpdate, 'trip_updates')).count(), 3)
+        self.assertEqual(session.query(model.VehiclePosition).count(), 5)
+
+        # same bytes the next time around ... nothing new is written
+        self.assertTrue(rt.run_once())
+        self.assertEqual(session.query(model.VehiclePosition).count(), 5)
+        skipped = rt.metrics.get('gtfsrdb_cycles_total')[replay.labels(feed='vehicle_positions', result='skipped')]
+        self.assertEqual(skipped, 1)
+        session.close()
+        rt.close()
+
+        # the engine was the caller's, so it's still good
+        self.assertEqual(self.engine.execute('select count(*) from vehicle_positions').scalar(), 5)
+
+    def test_migrate(self):
+        ''' tables from before generations get their generation column (with -c), and their old rows are still read ...
+            and indexes added to the model on existing columns get created
+        '''
+        self.engine.execute('CREATE TABLE vehicle_positions (oid INTEGER PRIMARY KEY, vehicle_id VARCHAR(10))')
+        self.engine.execute("INSERT INTO vehicle_positions (oid, vehicle_id) VALUES (1, 'old')")
+        model.EntitySelector.__table__.create(self.engine)
+        self.engine.execute('DROP INDEX ix_entity_selectors_stop_id')
+        vp = self.url('vp.pb', make_vehicle_positions(5))
+
+        rt = loader.RealtimeLoader(self.engine, vehiclePositions=vp)
+        self.assertRaises(ValueError, rt.setup)
+        rt = loader.RealtimeLoader(self.engine, create=True, vehiclePositions=vp)
+        rt.setup()
+        columns = [c['name'] for c in inspect(self.engine).get_columns('vehicle_positions')]
+        self.assertTrue('generation' in columns and 'timestamp' in columns)
+        indexes = [i['name'] for i in inspect(self.engine).get_indexes('entity_selectors')]
+        self.assertIn('ix_entity_selectors_stop_id', indexes)
+        self.assertTrue(rt.run_once())
+        self.assertEqual(self.engine.execute('select count(*) from vehicle_positions where generation is not null').scalar(), 5)
+        rt.close()
+
+    def test_settings(self):
+        self.assertRaises(ValueError, loader.RealtimeLoader, self.engine, tripUpdates='file:///x', bogus=True)
+        self.assertRaises(ValueError, loader.RealtimeLoader, self.engine)
+        self.assertRaises(ValueError, loader.RealtimeLoader, self.engine, tripUpdates='file:///x', stream=True, diff=True)
+
+    def test_multi(self):
+        ''' two agencies (each in its own schema) share an engine ... one agency's broken feed doesn't stop the rest
+        '''
+        import os
+        from sqlalchemy import event
+        bart = os.path.join(self.path, 'bart.db')
+
+        @event.listens_for(self.engine, 'connect')
+        def attach(conn, record):
+            conn.execute("ATTACH DATABASE '{0}' AS bart".format(bart))
+
+        agencies = [
+            ('trimet', dict(tripUpdates=self.url('tu.pb', make_trip_updates(3, 4)))),
+            ('bart', dict(schema='bart', vehiclePositions=self.url('vp.pb', make_vehicle_positions(5)),
+                          tripUpdates='file://' + os.path.join(self.path, 'missing.pb'))),
+        ]
+        rt = loader.MultiLoader(agencies, self.engine, create=True)
+        rt.setup()
+        self.assertFalse(rt.run_once())
+        self.assertEqual(self.engine.execute('select count(*) from trip_updates').scalar(), 3)
+        self.assertEqual(self.engine.execute('select count(*) from bart.vehicle_positions').scalar(), 5)
+        self.assertEqual(self.engine.execute('select count(*) from vehicle_positions').scalar(), 0)
+
+        cycles = rt.metrics.get('gtfsrdb_cycles_total')
+        self.assertEqual(cycles[replay.labels(agency='bart', feed='trip_updates', result='failed')], 1)
+        self.assertEqual(cycles[replay.labels(agency='bart', feed='vehicle_positions', result='loaded')], 1)
+        self.assertEqual(rt.metrics.last_cycle['feeds']['trimet/trip_updates']['result'], 'loaded')
+        rt.close()
+
+        # both agencies in the same schema would mix up their feeds
+        self.assertRaises(ValueError, loader.MultiLoader, [('a', dict(tripUpdates='file:///a')), ('b', dict(tripUpdates='file:///b'))], self.engine)
+
+    def test_route_names(self):
+        ''' the alerts' route short names come from one read of the routes table per cycle, not a query per alert
+        '''
+        from sqlalchemy import event
+        from ott.data.gtfsrdb import alerts
+        alerts.ROUTES.create(self.engine)
+        self.engine.execute(alerts.ROUTES.insert(), [
+            dict(route_id='0', route_short_name='4', route_long_name='Division', route_sort_order=2),
+            dict(route_id='1', route_short_name=None, route_long_name='MAX Blue Line', route_sort_order=1),
+        ])
+        queries = []
+
+        @event.listens_for(self.engine, 'before_cursor_execute')
+        def count(conn, cursor, statement, parameters, context, executemany):
+            if 'FROM routes' in statement:
+                queries.append(statement)
+
+        rt = loader.RealtimeLoader(self.engine, create=True, always=True, alerts=self.url('al.pb', make_alerts(50)))
+        rt.setup()
+        self.assertTrue(rt.run_once())
+        self.assertEqual(len(queries), 1)
+        self.assertTrue(rt.run_once())
+        self.assertEqual(len(queries), 2)
+
+        names = [r[0] for r in self.engine.execute('select route_short_names from alerts order by oid limit 3')]
+        self.assertEqual(names, ['4', 'MAX Blue, 4', 'MAX Blue, 4'])
+
+        # new static routes are picked up
+        self.engine.execute(alerts.ROUTES.insert(), [dict(route_id='2', route_short_name='9', route_long_name='Powell', route_sort_order=3)])
+        self.assertEqual(rt.route_names.refresh().short_names(['2', '0']), '4, 9')
+
+        # and so are renamed ones (same count, same first & last route_id)
+        self.engine.execute(alerts.ROUTES.update().where(alerts.ROUTES.c.route_id == '0').values(route_short_name='4X'))
+        self.assertEqual(rt.route_names.refresh().short_names(['2', '0']), '4X, 9')
+        self.assertTrue(rt.run_once())
+        session = rt.Session()
+        q = session.query(model.Alert.route_short_names).filter(generations.is_current(model.Alert, 'alerts'))
+        self.assertEqual([r[0] for r in q.order_by(model.Alert.oid).limit(2)], ['4X', 'MAX Blue, 4X'])
+        session.close()
+        rt.close()
+
+
+class TestFingerprint(FeedServerTestCase):
+    ''' each of the loader's reasons for skipping an unchanged feed, and the fingerprint (and skip count) that
+        outlives the loader
+    '''
+    def setUp(self):
+        super(TestFingerprint, self).setUp()
+        self.engine = create_engine('sqlite://')
+        self.url = self.root + '/vp.pb'
+
+    def serve(self, fm):
+        self.server.body = fm.SerializeToString()
+
+    def loader(self, **kw):
+        rt = loader.RealtimeLoader(self.engine, create=True, vehiclePositions=self.url, **kw)
+        rt.setup()
+        self.addCleanup(rt.close)  # before the server shuts down ... it waits on the loader's keep-alive connection
+        return rt
+
+    def fingerprint(self):
+        session = sessionmaker(bind=self.engine)()
+        try:
+            return session.query(model.FeedFingerprint).get('vehicle_positions')
+        finally:
+            session.close()
+
+    def latitudes(self):
+        return sorted(r[0] for r in self.engine.execute('select position_latitude from vehicle_positions'))
+
+    def skipped(self, rt):
+        return rt.metrics.get('gtfsrdb_cycles_total').get(replay.labels(feed='vehicle_positions', result='skipped'), 0)
+
+    def test_not_modified(self):
+        ''' the last load's ETag & Last-Modified go out with the next request ... and the server's 304 is a skip
+        '''
+        self.serve(make_vehicle_positions(3))
+        rt = self.loader()
+        self.assertTrue(rt.run_once())
+        fp = self.fingerprint()
+        self.assertEqual(fp.etag, etag(self.server.body))
+        self.assertEqual(fp.last_modified, LAST_MODIFIED)
+        self.assertEqual(fp.skipped, 0)
+
+        self.assertTrue(rt.run_once())
+        self.assertEqual(self.server.requests[1]['if-none-match'], fp.etag)
+        self.assertEqual(self.server.requests[1]['if-modified-since'], LAST_MODIFIED)
+        self.assertEqual(self.skipped(rt), 1)
+        self.assertEqual(self.fingerprint().skipped, 1)
+        rt.close()
+
+    def test_same_content(self):
+        ''' the same bytes (from a server without conditional requests) aren't parsed or written again
+        '''
+        self.serve(make_vehicle_positions(3))
+        rt = self.loader()
+        self.assertTrue(rt.run_once())
+        digest = hashlib.sha1(self.server.body).hexdigest()
+        self.assertEqual(self.fingerprint().digest, digest)
+
+        # forget the validators, so the server sends the feed again
+        self.engine.execute('update feed_fingerprints set etag = null, last_modified = null')
+        self.assertTrue(rt.run_once())
+        self.assertEqual(len(self.server.requests), 2)
+        self.assertNotIn('if-none-match', self.server.requests[1])
+        self.assertEqual(self.skipped(rt), 1)
+        fp = self.fingerprint()
+        self.assertEqual((fp.skipped, fp.digest), (1, digest))
+        rt.close()
+
+    def test_same_header(self):
+        ''' different bytes with the same header timestamp (e.g., a feed that's re-serialized for every request) aren't
+            written ... but a new timestamp is
+        '''
+        self.serve(make_vehicle_positions(3))
+        rt = self.loader()
+        self.assertTrue(rt.run_once())
+        self.assertEqual(self.latitudes(), [45.5] * 3)
+
+        fm = make_vehicle_positions(3)
+        fm.entity[0].vehicle.position.latitude = 45.6
+        self.serve(fm)
+        self.assertTrue(rt.run_once())
+        self.assertEqual(self.skipped(rt), 1)
+        fp = self.fingerprint()
+        self.assertEqual((fp.skipped, fp.header_timestamp), (1, 1400000000))
+        self.assertEqual(fp.digest, hashlib.sha1(self.server.body).hexdigest())
+        self.assertEqual(self.latitudes(), [45.5] * 3)
+
+        fm.header.timestamp = 1400000030
+        self.serve(fm)
+        self.assertTrue(rt.run_once())
+        self.assertEqual(self.skipped(rt), 1)
+        self.assertEqual(self.fingerprint().header_timestamp, 1400000030)
+        self.assertAlmostEqual(self.latitudes()[-1], 45.6, places=4)
+        rt.close()
+
+    def test_restart(self):
+        ''' the fingerprint (and skip count) are in the database ... so a new loader picks up where the last one left off
+        '''
+        self.serve(make_vehicle_positions(3))
+        rt = self.loader()
+        self.assertTrue(rt.run_once())
+        self.assertTrue(rt.run_once())
+        rt.close()
+
+        rt = self.loader()
+        self.assertTrue(rt.run_once())
+        self.assertEqual(self.server.requests[2]['if-none-match'], self.fingerprint().etag)
+        self.assertEqual(self.skipped(rt), 1)
+        self.assertEqual(self.fingerprint().skipped, 2)
+        self.assertEqual(self.engine.execute('select count(*) from vehicle_positions').scalar(), 3)
+        rt.close()
+
+        # with always, nothing is skipped (and no validators are sent)
+        rt = self.loader(always=True)
+        self.assertTrue(rt.run_once())
+        self.assertNotIn('if-none-match', self.server.requests[3])
+        self.assertEqual(self.skipped(rt), 0)
+        rt.close()
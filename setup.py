@@ -8,7 +8,7 @@ CHANGES = open(os.path.join(here, 'CHANGES.txt')).read()
 
 requires = [
     'ott.utils',
-    'sqlalchemy',
+    'sqlalchemy>=1.1',
     'transaction',
     'gtfsdb',
     'protobuf',
@@ -59,6 +59,7 @@ setup(
     entry_points="""\
         [console_scripts]
         load_rt = ott.data.gtfsrdb.gtfsrdb:main
+        bench_rt = ott.data.gtfsrdb.synthetic:main
         test_main = ott.data.tests.main:main
     """,
 )